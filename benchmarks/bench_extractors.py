@@ -0,0 +1,183 @@
+"""
+Throughput and output overlap of the extraction engines on a sample WARC.
+
+    python benchmarks/bench_extractors.py [--input sample.warc.gz]
+        [--size-mb 10] [--seed 0] [--repeat 1]
+        [--extractors trafilatura,resiliparse,cascade] [--results results.json]
+
+Generates a WARC with synthetic.py (or uses --input), reads its responses and
+runs every extractor over all of them. Per extractor, reports
+    docs_per_sec, mb_per_sec  of the response bodies, best of --repeat runs
+    extracted                 share of responses it got any text out of
+    passed                    share that then passes the filter rules
+    jaccard                   mean token set Jaccard similarity to the
+                              reference's (the first extractor) text, over
+                              responses either got text out of
+    agreement                 share of responses where it and the reference
+                              agree on passing the rules
+    fallback_rate             for the cascade, share of responses that fell
+                              back to its fallback extractor
+Results are one JSON object, printed and written to --results.
+"""
+import argparse
+import json
+import logging
+import platform
+import shutil
+import tempfile
+import time
+from dataclasses import fields
+from os import path
+
+from ccliz_pipeline.warcprocessing.extraction import (
+    EXTRACTORS,
+    CascadeExtractor,
+    Extractor,
+    get_extractor,
+)
+from ccliz_pipeline.warcprocessing.preprocessing import compute_stats, passes_rules
+from bench_pipeline import _git_commit, _peak_rss_mb, _read_responses
+from synthetic import DEFAULT_MIX, parse_mix, write_synthetic_warc
+
+
+def _tokens(text: str | None) -> set[str]:
+    return set(text.split()) if text else set()
+
+
+def _jaccard(a: set[str], b: set[str]) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+class _CountingCascade(CascadeExtractor):
+    # counts the documents that fall back, without changing what's extracted
+    fallbacks = 0
+
+    def looks_poor(self, text: str | None) -> bool:
+        poor = super().looks_poor(text)
+        type(self).fallbacks += poor
+        return poor
+
+
+def run_extractor(
+    extractor: Extractor, bodies: list[bytes], repeat: int = 1
+) -> tuple[dict, list[str | None]]:
+    settings = extractor.settings
+    counting = isinstance(extractor, CascadeExtractor)
+    if counting:
+        extractor = _CountingCascade(
+            **{f.name: getattr(extractor, f.name) for f in fields(extractor)}
+        )
+    best = float("inf")
+    for _ in range(repeat):
+        _CountingCascade.fallbacks = 0
+        start = time.perf_counter()
+        texts = [extractor(body) for body in bodies]
+        best = min(best, time.perf_counter() - start)
+    body_mb = sum(map(len, bodies)) / (1 << 20)
+    stats = {
+        "extractor": extractor.name,
+        "settings": settings,
+        "docs": len(bodies),
+        "seconds": best,
+        "docs_per_sec": len(bodies) / best if best else None,
+        "mb_per_sec": body_mb / best if best else None,
+        "extracted": sum(1 for t in texts if t) / len(bodies),
+        "fallback_rate": (
+            _CountingCascade.fallbacks / len(bodies) if counting else None
+        ),
+    }
+    return stats, texts
+
+
+def run(input_path: str, extractors: list[str], repeat: int = 1) -> list[dict]:
+    # HTML responses only, the prefilter drops the rest before extraction
+    bodies = [
+        body
+        for headers, body in _read_responses(input_path)
+        if any(
+            k == "WARC-Identified-Payload-Type" and v == "text/html"
+            for k, v in headers
+        )
+    ]
+    results = []
+    reference_tokens = reference_passed = None
+    for name in extractors:
+        extractor = get_extractor(name)
+        stats, texts = run_extractor(extractor, bodies, repeat)
+        passed = [bool(t) and passes_rules(compute_stats(t)) for t in texts]
+        tokens = [_tokens(t) for t in texts]
+        stats["passed"] = sum(passed) / len(bodies)
+        if reference_tokens is None:
+            reference_tokens, reference_passed = tokens, passed
+        similarities = [
+            _jaccard(a, b) for a, b in zip(tokens, reference_tokens) if a or b
+        ]
+        stats["jaccard"] = (
+            sum(similarities) / len(similarities) if similarities else None
+        )
+        stats["agreement"] = sum(
+            a == b for a, b in zip(passed, reference_passed)
+        ) / len(bodies)
+        results.append(stats)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--input", help="existing .warc or .warc.gz to use instead")
+    parser.add_argument("--size-mb", type=float, default=10.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument(
+        "--extractors",
+        type=lambda s: s.split(","),
+        default=list(EXTRACTORS),
+        help="comma separated, the first is the reference for overlap",
+    )
+    parser.add_argument("--results", help="also write the results JSON here")
+    parser.add_argument("--verbose", action="store_true", help="keep the logs")
+    args = parser.parse_args()
+    if not args.verbose:
+        # trafilatura logs every page it can't parse, of which there are many
+        logging.disable(logging.ERROR)
+
+    work_dir = tempfile.mkdtemp(prefix="ccbench-extractors-")
+    try:
+        input_path = args.input
+        responses = None
+        if input_path is None:
+            input_path = path.join(work_dir, "synthetic.warc")
+            responses = write_synthetic_warc(
+                input_path, args.size_mb, args.seed, args.mix
+            )
+        extractors = run(input_path, args.extractors, args.repeat)
+        results = {
+            "benchmark": "extractors",
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "input": {
+                "path": args.input,
+                "bytes": path.getsize(input_path),
+                "size_mb": args.size_mb if args.input is None else None,
+                "seed": args.seed if args.input is None else None,
+                "mix": args.mix if args.input is None else None,
+                "responses": responses,
+            },
+            "options": {"repeat": args.repeat, "reference": args.extractors[0]},
+            "extractors": extractors,
+            "peak_rss_mb": _peak_rss_mb(),
+        }
+    finally:
+        shutil.rmtree(work_dir)
+
+    print(json.dumps(results, indent=2))
+    if args.results:
+        with open(args.results, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
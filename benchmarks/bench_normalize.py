@@ -0,0 +1,125 @@
+"""
+Microbenchmark of utils.normalize_text_ against the original regex version.
+
+    python benchmarks/bench_normalize.py [prepared.jsonl ...]
+
+Uses the raw_text of the given TextDocument shards, or a generated mixed-script
+corpus if none are given. Checks that both versions agree on every document
+(and on every codepoint) before timing them.
+"""
+import argparse
+import json
+import random
+import re
+import sys
+import time
+import unicodedata
+
+import msgspec
+
+from ccliz_pipeline.utils.utils import normalize_many, normalize_text_
+
+punctuation_pattern = re.compile(r"[^\w\s]")
+whitespace_pattern = re.compile(r"\s+")
+number_pattern = re.compile(r"\d")
+
+
+def reference_normalize_text_(s: str) -> str:
+    if s:
+        s = s.lower()
+        s = punctuation_pattern.sub("", s)
+        s = whitespace_pattern.sub(" ", s).strip()
+        s = number_pattern.sub("", s)
+        s = unicodedata.normalize("NFD", s)
+        return "".join([c for c in s if not unicodedata.combining(c)])
+    return ""
+
+
+class _RawText(msgspec.Struct):
+    raw_text: str
+
+
+def load_corpus(paths: list[str]) -> list[str]:
+    decoder = msgspec.json.Decoder(_RawText)
+    texts = []
+    for p in paths:
+        with open(p, "rb") as f:
+            texts.extend(decoder.decode(line).raw_text for line in f if line.strip())
+    return texts
+
+
+def synthetic_corpus(n: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    ascii_words = "the quick brown fox jumps over lazy dog 2023 e-mail U.S.A. don't".split()
+    other_words = "café naïve Ångström Straße ΣΟΦΊΑ σοφός Москва 東京 서울 ٣٤٥ १२३ ﬁne ǅemal".split()
+    spaces = [" ", "  ", "\n", "\t", " ", " ", " \x1c "]
+    punct = ["", "", ",", ".", "!", "...", "—", "«", "»", "#", "•"]
+    texts = []
+    for i in range(n):
+        words = ascii_words if i % 2 else ascii_words + other_words
+        texts.append(
+            "".join(
+                rng.choice(words) + rng.choice(punct) + rng.choice(spaces)
+                for _ in range(rng.randint(50, 400))
+            )
+        )
+    return texts
+
+
+def check_codepoints() -> list[int]:
+    mismatched = []
+    for cp in range(sys.maxunicode + 1):
+        c = chr(cp)
+        if 0xD800 <= cp <= 0xDFFF:
+            continue
+        for s in (c, f"a{c}b", f"x {c} 1{c}2 y", f"{c} Ä"):
+            if normalize_text_(s) != reference_normalize_text_(s):
+                mismatched.append(cp)
+                break
+    return mismatched
+
+
+def bench(fn, texts: list[str], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(texts)
+        best = min(best, time.perf_counter() - start)
+    return len(texts) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("shards", nargs="*", help="TextDocument .jsonl files")
+    parser.add_argument("-n", type=int, default=5000, help="synthetic documents")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-codepoints", action="store_true")
+    args = parser.parse_args()
+
+    texts = load_corpus(args.shards) if args.shards else synthetic_corpus(args.n)
+    mismatched_docs = sum(
+        a != b
+        for a, b in zip(normalize_many(texts), map(reference_normalize_text_, texts))
+    )
+    mismatched_codepoints = [] if args.skip_codepoints else check_codepoints()
+
+    reference = bench(lambda t: [reference_normalize_text_(s) for s in t], texts, args.repeat)
+    fast = bench(normalize_many, texts, args.repeat)
+    print(
+        json.dumps(
+            {
+                "documents": len(texts),
+                "mismatched_documents": mismatched_docs,
+                "mismatched_codepoints": [hex(cp) for cp in mismatched_codepoints],
+                "reference_docs_per_sec": reference,
+                "docs_per_sec": fast,
+                "speedup": fast / reference,
+            }
+        )
+    )
+    if mismatched_docs or mismatched_codepoints:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
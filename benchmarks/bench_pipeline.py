@@ -0,0 +1,362 @@
+"""
+Throughput of each preprocessing stage and of process_record on synthetic WARCs.
+
+    python benchmarks/bench_pipeline.py [--size-mb 20] [--seed 0] [--gz]
+        [--repeat 3] [--output-format jsonl] [--results results.json]
+        [--compare baseline.json --max-regression 0.1]
+
+Generates a WARC with synthetic.py (or uses --input), runs process_record on
+it, then times every stage on its own over the same responses:
+    iterate   ArchiveIterator over the file, reading each response body
+    header    make_warc_header_from_tuples
+    extract   preprocess_raw_bytes
+    filter    compute_stats and passes_rules on the extracted texts
+    encode    msgspec encoding of the TextDocuments that pass
+    write     DocumentWriter, from the encoded lines
+Each is reported in docs/sec and MB/s (of its input) using the best of
+--repeat runs. process_record runs first, so peak_rss_mb after it is its own
+peak; later stages hold all bodies in memory and the peak only grows from there.
+
+Results are one JSON object, printed and written to --results. With --compare,
+docs/sec is compared to an earlier results file, and the exit status is 1 if
+any stage got slower by more than --max-regression.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from os import path
+
+from fastwarc.warc import ArchiveIterator, WarcRecordType
+
+from ccliz_pipeline.warcprocessing.output import open_output_writer, output_path_for
+from ccliz_pipeline.warcprocessing.pipeline import CCRecord
+from ccliz_pipeline.warcprocessing.preprocessing import (
+    compute_stats,
+    passes_rules,
+    preprocess_raw_bytes,
+)
+from ccliz_pipeline.warcprocessing.recordprocessing import (
+    encoder,
+    process_record,
+    stream_from_cc_file,
+)
+from ccliz_pipeline.warcprocessing.types import CCRecordStage, LocalConfig, TextDocument
+from ccliz_pipeline.warcprocessing.utils import (
+    make_warc_header_from_tuples,
+    stage_converter,
+)
+from synthetic import DEFAULT_MIX, parse_mix, write_synthetic_warc
+
+
+def _peak_rss_mb() -> dict[str, float]:
+    # ru_maxrss is in KiB on Linux
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=path.dirname(path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _timed(name: str, repeat: int, run, docs: int, input_bytes: int):
+    # best of repeat runs; run returns its result, the last one is kept
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = run()
+        best = min(best, time.perf_counter() - start)
+    stats = {
+        "stage": name,
+        "docs": docs,
+        "input_mb": input_bytes / (1 << 20),
+        "seconds": best,
+        "docs_per_sec": docs / best if best else None,
+        "mb_per_sec": input_bytes / (1 << 20) / best if best else None,
+        "peak_rss_mb": _peak_rss_mb()["self"],
+    }
+    return stats, result
+
+
+def _make_record(cc_path: str, source_file: str) -> CCRecord:
+    record = CCRecord(
+        snapshot="bench",
+        segment="0",
+        file_num="00000",
+        raw=source_file,
+        record_id="bench/0/00000",
+        config=LocalConfig(
+            cc_path=cc_path, URL_Appendix="default", stage_converter=stage_converter
+        ),
+        stage=CCRecordStage.SOURCE,
+    )
+    # .warc.gz files are streamed from SOURCE, .warc files read as STAGED
+    if not source_file.endswith(".gz"):
+        record.stage = CCRecordStage.STAGED
+    input_path = record.get_path()
+    os.makedirs(path.dirname(input_path), exist_ok=True)
+    os.symlink(path.abspath(source_file), input_path)
+    return record
+
+
+def _read_responses(input_path: str) -> list[tuple[tuple, bytes]]:
+    def handler(stream):
+        return [
+            (document.headers.astuples(), document.reader.read())
+            for document in ArchiveIterator(
+                stream, parse_http=False, record_types=WarcRecordType.response
+            )
+        ]
+
+    return stream_from_cc_file(input_path, handler)
+
+
+def run(
+    input_path: str,
+    work_dir: str,
+    repeat: int = 3,
+    output_format: str = "jsonl",
+    process_kwargs: dict | None = None,
+) -> list[dict]:
+    input_bytes = path.getsize(input_path)
+    stages = []
+
+    def full():
+        cc_path = tempfile.mkdtemp(dir=work_dir)
+        try:
+            record = _make_record(cc_path, input_path)
+            process_record(
+                record,
+                stream_source=input_path.endswith(".gz"),
+                output_format=output_format,
+                **(process_kwargs or {}),
+            )
+            if record.stage != CCRecordStage.PREPROCESSED:
+                raise RuntimeError(f"process_record ended in {record.stage}")
+        finally:
+            shutil.rmtree(cc_path)
+
+    responses = _read_responses(input_path)
+    stats, _ = _timed("process_record", repeat, full, len(responses), input_bytes)
+    stats["peak_children_rss_mb"] = _peak_rss_mb()["children"]
+    stages.append(stats)
+
+    stats, responses = _timed(
+        "iterate",
+        repeat,
+        lambda: _read_responses(input_path),
+        len(responses),
+        input_bytes,
+    )
+    stages.append(stats)
+    bodies = [body for _, body in responses]
+    body_bytes = sum(map(len, bodies))
+
+    stats, headers = _timed(
+        "header",
+        repeat,
+        lambda: [make_warc_header_from_tuples(t) for t, _ in responses],
+        len(responses),
+        sum(len(k) + len(v) for t, _ in responses for k, v in t),
+    )
+    stages.append(stats)
+
+    stats, texts = _timed(
+        "extract",
+        repeat,
+        lambda: [preprocess_raw_bytes(body) for body in bodies],
+        len(bodies),
+        body_bytes,
+    )
+    stages.append(stats)
+
+    extracted = [(h, t) for h, t in zip(headers, texts) if t]
+
+    def filter_texts():
+        passed = []
+        for header, text in extracted:
+            doc_stats = compute_stats(text)
+            if passes_rules(doc_stats):
+                passed.append((header, text, doc_stats))
+        return passed
+
+    stats, passed = _timed(
+        "filter",
+        repeat,
+        filter_texts,
+        len(extracted),
+        sum(len(t.encode()) for _, t in extracted),
+    )
+    stages.append(stats)
+
+    documents = [
+        TextDocument(
+            id=f"bench/0/00000/{n}",
+            header=header,
+            raw_text=text,
+            pipeline_status="raw",
+            stats=doc_stats,
+        )
+        for n, (header, text, doc_stats) in enumerate(passed)
+    ]
+    stats, lines = _timed(
+        "encode",
+        repeat,
+        lambda: [encoder.encode(d) + b"\n" for d in documents],
+        len(documents),
+        sum(len(d.raw_text.encode()) for d in documents),
+    )
+    stages.append(stats)
+
+    def write():
+        output_dir = tempfile.mkdtemp(dir=work_dir)
+        try:
+            writer = open_output_writer(
+                output_path_for(path.join(output_dir, "out.jsonl"), output_format),
+                output_format,
+            )
+            if output_format == "parquet":
+                # parquet rows are built from the documents, not encoded lines
+                for document in documents:
+                    writer.write(document)
+            else:
+                for line in lines:
+                    writer.write_encoded(line, 1)
+            return writer.close()
+        finally:
+            shutil.rmtree(output_dir)
+
+    stats, manifest = _timed("write", repeat, write, len(lines), sum(map(len, lines)))
+    stats["output_mb"] = manifest.bytes / (1 << 20)
+    stages.append(stats)
+    return stages
+
+
+def compare(results: dict, baseline: dict, max_regression: float) -> bool:
+    """Prints docs/sec against baseline per stage; False if any regressed"""
+    for key in ("input", "options"):
+        if {k: v for k, v in baseline[key].items() if k != "path"} != {
+            k: v for k, v in results[key].items() if k != "path"
+        }:
+            print(f"note: {key} differs from the baseline's", file=sys.stderr)
+    before = {s["stage"]: s for s in baseline["stages"]}
+    ok = True
+    for stage in results["stages"]:
+        old = before.get(stage["stage"])
+        if not old or not old["docs_per_sec"] or not stage["docs_per_sec"]:
+            continue
+        ratio = stage["docs_per_sec"] / old["docs_per_sec"]
+        regressed = ratio < 1 - max_regression
+        ok = ok and not regressed
+        print(
+            f"{stage['stage']:>15}: {old['docs_per_sec']:10.1f} -> "
+            f"{stage['docs_per_sec']:10.1f} docs/s ({ratio:.2f}x)"
+            + (" REGRESSION" if regressed else ""),
+            file=sys.stderr,
+        )
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--input", help="existing .warc or .warc.gz to use instead")
+    parser.add_argument("--size-mb", type=float, default=20.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX)
+    parser.add_argument("--gz", action="store_true", help="generate a .warc.gz")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--output-format",
+        default="jsonl",
+        choices=["jsonl", "jsonl.gz", "jsonl.zst", "parquet"],
+    )
+    parser.add_argument("--extraction-workers", type=int, default=0)
+    parser.add_argument("--split-workers", type=int, default=0)
+    parser.add_argument("--results", help="also write the results JSON here")
+    parser.add_argument("--compare", help="earlier results JSON to compare to")
+    parser.add_argument("--max-regression", type=float, default=0.1)
+    parser.add_argument("--verbose", action="store_true", help="keep the logs")
+    args = parser.parse_args()
+    if not args.verbose:
+        # trafilatura logs every page it can't parse, of which there are many
+        logging.disable(logging.ERROR)
+
+    work_dir = tempfile.mkdtemp(prefix="ccbench-pipeline-")
+    try:
+        input_path = args.input
+        responses = None
+        if input_path is None:
+            input_path = path.join(
+                work_dir, "synthetic.warc" + (".gz" if args.gz else "")
+            )
+            responses = write_synthetic_warc(
+                input_path, args.size_mb, args.seed, args.mix
+            )
+        stages = run(
+            input_path,
+            work_dir,
+            args.repeat,
+            args.output_format,
+            {
+                "extraction_workers": args.extraction_workers,
+                "split_workers": args.split_workers,
+                "checkpoint": False,
+            },
+        )
+        results = {
+            "benchmark": "pipeline",
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "input": {
+                "path": args.input,
+                "bytes": path.getsize(input_path),
+                "size_mb": args.size_mb if args.input is None else None,
+                "seed": args.seed if args.input is None else None,
+                "mix": args.mix if args.input is None else None,
+                "responses": responses,
+            },
+            "options": {
+                "repeat": args.repeat,
+                "output_format": args.output_format,
+                "extraction_workers": args.extraction_workers,
+                "split_workers": args.split_workers,
+            },
+            "stages": stages,
+            "peak_rss_mb": _peak_rss_mb(),
+        }
+    finally:
+        shutil.rmtree(work_dir)
+
+    print(json.dumps(results, indent=2))
+    if args.results:
+        with open(args.results, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.max_regression):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Planning cost of a snapshot's warc.paths manifest: RecordTable.from_paths
+against a CCRecord.create_from_URL per line.
+
+    python benchmarks/bench_recordtable.py [warc.paths.gz ...]
+
+Uses the given manifests, or generates one of --files paths if none are
+given. Reports wall time and peak traced memory of each, and checks that the
+table's records match the ones made one at a time.
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from xopen import xopen
+
+from ccliz_pipeline.warcprocessing.pipeline import CCRecord
+from ccliz_pipeline.warcprocessing.recordtable import RecordTable
+
+
+def synthetic_manifest(files: int, segments: int = 100, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    names = [f"17006{rng.randrange(10**8):08d}.{k:02d}" for k in range(segments)]
+    fd, manifest = tempfile.mkstemp(suffix=".warc.paths.gz")
+    with gzip.open(os.fdopen(fd, "wb"), "wt") as f:
+        for num in range(files):
+            start = 20231128083443 + rng.randrange(10**6)
+            f.write(
+                f"crawl-data/CC-MAIN-2023-50/segments/"
+                f"{names[num * segments // files]}/warc/"
+                f"CC-MAIN-{start}-{start + 30000}-{num:05d}.warc.gz\n"
+            )
+    return manifest
+
+
+def _measured(run) -> tuple[object, float, float]:
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = run()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak / 1e6
+
+
+def _records_one_by_one(manifests: list[str]) -> list[CCRecord]:
+    records = []
+    for manifest in manifests:
+        with xopen(manifest, "rt") as f:
+            records.extend(
+                CCRecord.create_from_URL(line.strip()) for line in f if line.strip()
+            )
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("manifests", nargs="*")
+    parser.add_argument("--files", type=int, default=90000)
+    args = parser.parse_args()
+    manifests = args.manifests or [synthetic_manifest(args.files)]
+
+    # tracemalloc slows allocations down, so times are taken separately
+    start = time.perf_counter()
+    RecordTable.concat([RecordTable.from_paths(m) for m in manifests])
+    table_seconds = time.perf_counter() - start
+    table, _, table_mb = _measured(
+        lambda: RecordTable.concat([RecordTable.from_paths(m) for m in manifests])
+    )
+    start = time.perf_counter()
+    _records_one_by_one(manifests)
+    records_seconds = time.perf_counter() - start
+    records, _, records_mb = _measured(lambda: _records_one_by_one(manifests))
+
+    assert len(table) == len(records)
+    for row in range(0, len(records), max(len(records) // 1000, 1)):
+        a, b = table[row], records[row]
+        assert (a.record_id, a.raw) == (b.record_id, b.raw), (a, b)
+    print(
+        json.dumps(
+            {
+                "files": len(table),
+                "snapshots": len(table.snapshots),
+                "segments": len(table.segments),
+                "table": {
+                    "seconds": round(table_seconds, 4),
+                    "peak_mb": round(table_mb, 1),
+                    "columns_mb": round(table.nbytes / 1e6, 2),
+                },
+                "create_from_URL": {
+                    "seconds": round(records_seconds, 4),
+                    "peak_mb": round(records_mb, 1),
+                },
+            },
+            indent=2,
+        )
+    )
+    if not args.manifests:
+        os.remove(manifests[0])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Compares the stage-then-process path against streaming straight from the
+.warc.gz source (process_record(..., stream_source=True)).
+
+    python benchmarks/bench_staging.py path/to/CC-MAIN-...-00000.warc.gz [...]
+
+Reports wall time and bytes written to disk for each mode.
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from os import path
+
+from ccliz_pipeline.warcprocessing.download import stage_record
+from ccliz_pipeline.warcprocessing.pipeline import CCRecord
+from ccliz_pipeline.warcprocessing.recordprocessing import process_record
+from ccliz_pipeline.warcprocessing.types import CCRecordStage, LocalConfig
+from ccliz_pipeline.warcprocessing.utils import stage_converter
+
+
+def _make_record(cc_path: str, source_file: str, num: int) -> CCRecord:
+    record_id = f"bench/0/{num:05d}"
+    record = CCRecord(
+        snapshot="bench",
+        segment="0",
+        file_num=f"{num:05d}",
+        raw=source_file,
+        record_id=record_id,
+        config=LocalConfig(
+            cc_path=cc_path, URL_Appendix="default", stage_converter=stage_converter
+        ),
+        stage=CCRecordStage.SOURCE,
+    )
+    source_path = record.get_path(CCRecordStage.SOURCE)
+    os.makedirs(path.dirname(source_path), exist_ok=True)
+    os.symlink(path.abspath(source_file), source_path)
+    return record
+
+
+def _bytes_written(record: CCRecord) -> int:
+    written = 0
+    for stage in (CCRecordStage.STAGED, CCRecordStage.PREPROCESSED):
+        if path.exists(record.get_path(stage)):
+            written += path.getsize(record.get_path(stage))
+    return written
+
+
+def run(source_files: list[str], mode: str) -> dict:
+    cc_path = tempfile.mkdtemp(prefix=f"ccbench-{mode}-")
+    try:
+        records = [_make_record(cc_path, f, i) for i, f in enumerate(source_files)]
+        start = time.perf_counter()
+        for record in records:
+            if mode == "staged":
+                stage_record(record)
+                process_record(record)
+            else:
+                process_record(record, stream_source=True)
+            if record.stage != CCRecordStage.PREPROCESSED:
+                raise RuntimeError(f"{record.record_id} ended in {record.stage}")
+        elapsed = time.perf_counter() - start
+        return {
+            "mode": mode,
+            "files": len(records),
+            "seconds": elapsed,
+            "bytes_written": sum(_bytes_written(r) for r in records),
+        }
+    finally:
+        shutil.rmtree(cc_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("source_files", nargs="+", help=".warc.gz files")
+    args = parser.parse_args()
+    for mode in ("staged", "streamed"):
+        print(json.dumps(run(args.source_files, mode)))
+
+
+if __name__ == "__main__":
+    main()
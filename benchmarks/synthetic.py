@@ -0,0 +1,284 @@
+"""
+Deterministic synthetic Common Crawl WARC files for the benchmarks.
+
+    python benchmarks/synthetic.py out.warc.gz --size-mb 50 [--seed 0]
+        [--mix html=0.75,non_html=0.1,junk=0.15]
+
+Writes a warcinfo record and then request/response/metadata triples like a
+CC WARC, with the response headers in CC's order (make_warc_header relies on
+it). .gz output gets one gzip member per record. Responses are a mix of
+    html      article pages with navigation, lists, scripts and footers
+    non_html  PDFs, images and JSON, with binary or structured bodies
+    junk      pages the rules should drop: near-empty pages, link farms,
+              hashtag spam, random bytes, and exact duplicates of earlier pages
+The same arguments always produce the same bytes.
+"""
+import argparse
+import base64
+import gzip
+import hashlib
+import itertools
+import json
+import random
+import uuid
+from os import makedirs, path
+
+COMMON_WORDS = (
+    "the of and to a in is that for it as was with be by on not he this are "
+    "or his from at which but have an they you were her she there can all "
+    "one been if more when will would who so no we out up said what about "
+    "their into them time only new some could these two may first then do "
+    "any like my now over such our man me even most made after also did "
+    "many before must through back years where much your way well down"
+).split()
+DEFAULT_MIX = {"html": 0.75, "non_html": 0.1, "junk": 0.15}
+
+
+class _Vocabulary:
+    # common words plus generated ones, drawn with a Zipf-like distribution
+    def __init__(self, rng: random.Random, size: int = 5000):
+        letters = "etaoinshrdlcumwfgypbvkjxqz"
+        letter_weights = [26 - i for i in range(26)]
+        words = list(COMMON_WORDS)
+        while len(words) < size:
+            length = max(2, min(14, int(rng.gauss(6, 2.5))))
+            words.append("".join(rng.choices(letters, letter_weights, k=length)))
+        self.words = words
+        self.cum_weights = list(
+            itertools.accumulate(1 / (rank + 1) for rank in range(len(words)))
+        )
+
+    def sample(self, rng: random.Random, k: int) -> list[str]:
+        return rng.choices(self.words, cum_weights=self.cum_weights, k=k)
+
+
+def _sentence(rng: random.Random, vocabulary: _Vocabulary) -> str:
+    words = vocabulary.sample(rng, rng.randint(6, 28))
+    punctuation = rng.choice([".", ".", ".", "?", "!", ":"])
+    return " ".join(words).capitalize() + punctuation
+
+
+def _paragraph(rng: random.Random, vocabulary: _Vocabulary) -> str:
+    return " ".join(_sentence(rng, vocabulary) for _ in range(rng.randint(2, 8)))
+
+
+def html_page(rng: random.Random, vocabulary: _Vocabulary) -> bytes:
+    title = _sentence(rng, vocabulary)[:60]
+    nav = "".join(
+        f'<li><a href="/{w}">{w}</a></li>' for w in vocabulary.sample(rng, 8)
+    )
+    body = []
+    for _ in range(rng.randint(2, 12)):
+        kind = rng.random()
+        if kind < 0.7:
+            body.append(f"<p>{_paragraph(rng, vocabulary)}</p>")
+        elif kind < 0.85:
+            body.append(f"<h2>{_sentence(rng, vocabulary)}</h2>")
+        else:
+            items = "".join(
+                f"<li>{_sentence(rng, vocabulary)}</li>" for _ in range(rng.randint(2, 6))
+            )
+            body.append(f"<ul>{items}</ul>")
+    script = "var x = " + json.dumps(vocabulary.sample(rng, 40)) + ";"
+    return (
+        "<!DOCTYPE html><html><head><meta charset=\"utf-8\">"
+        f"<title>{title}</title><style>body {{ margin: 0 }}</style>"
+        f"<script>{script}</script></head><body>"
+        f"<header><nav><ul>{nav}</ul></nav></header>"
+        f"<main><article><h1>{title}</h1>{''.join(body)}</article></main>"
+        f"<footer><p>Copyright 2023. {_sentence(rng, vocabulary)}</p></footer>"
+        "</body></html>"
+    ).encode()
+
+
+def non_html_payload(rng: random.Random, vocabulary: _Vocabulary) -> tuple[str, bytes]:
+    kind = rng.choice(["application/pdf", "image/jpeg", "application/json"])
+    if kind == "application/json":
+        data = {w: vocabulary.sample(rng, 5) for w in vocabulary.sample(rng, 30)}
+        return kind, json.dumps(data).encode()
+    magic = b"%PDF-1.4\n" if kind == "application/pdf" else b"\xff\xd8\xff\xe0"
+    return kind, magic + rng.randbytes(rng.randint(2000, 60000))
+
+
+def junk_page(
+    rng: random.Random, vocabulary: _Vocabulary, earlier: list[bytes]
+) -> bytes:
+    kind = rng.choice(["short", "links", "hashtags", "garbage", "duplicate"])
+    if kind == "duplicate" and earlier:
+        return rng.choice(earlier)
+    if kind == "short":
+        text = " ".join(vocabulary.sample(rng, rng.randint(1, 12)))
+        return f"<html><body><p>{text}</p></body></html>".encode()
+    if kind == "links":
+        links = "".join(
+            f'<li>• <a href="/{w}">{w}</a></li>' for w in vocabulary.sample(rng, 80)
+        )
+        return f"<html><body><ul>{links}</ul></body></html>".encode()
+    if kind == "hashtags":
+        tags = " ".join(f"#{w}" for w in vocabulary.sample(rng, 120))
+        return f"<html><body><p>{tags}</p></body></html>".encode()
+    return rng.randbytes(rng.randint(200, 5000))
+
+
+def _digest(data: bytes) -> str:
+    return "sha1:" + base64.b32encode(hashlib.sha1(data).digest()).decode()
+
+
+def _record(headers: list[tuple[str, str]], block: bytes) -> bytes:
+    head = "".join(f"{k}: {v}\r\n" for k, v in headers)
+    return b"WARC/1.0\r\n" + head.encode() + b"\r\n" + block + b"\r\n\r\n"
+
+
+def _record_id(rng: random.Random) -> str:
+    return f"<urn:uuid:{uuid.UUID(int=rng.getrandbits(128), version=4)}>"
+
+
+def write_synthetic_warc(
+    output_path: str,
+    size_mb: float = 10.0,
+    seed: int = 0,
+    mix: dict[str, float] | None = None,
+) -> dict[str, int]:
+    """
+    Writes records until the file is at least size_mb, returns counts of the
+    kinds of responses written
+    """
+    rng = random.Random(seed)
+    vocabulary = _Vocabulary(rng)
+    mix = mix or DEFAULT_MIX
+    kinds, weights = zip(*mix.items())
+    compress = output_path.endswith(".gz")
+    warcinfo_id = _record_id(rng)
+    counts = {kind: 0 for kind in kinds}
+    earlier: list[bytes] = []
+    target = int(size_mb * (1 << 20))
+    if path.dirname(output_path):
+        makedirs(path.dirname(output_path), exist_ok=True)
+
+    def encode(data: bytes) -> bytes:
+        # mtime=0 so the output doesn't depend on when it was written
+        return gzip.compress(data, compresslevel=6, mtime=0) if compress else data
+
+    with open(output_path, "wb") as f:
+        info = b"software: ccliz-pipeline synthetic benchmark\r\n"
+        f.write(
+            encode(
+                _record(
+                    [
+                        ("WARC-Type", "warcinfo"),
+                        ("WARC-Date", "2023-11-28T08:34:43Z"),
+                        ("WARC-Record-ID", warcinfo_id),
+                        ("Content-Length", str(len(info))),
+                        ("Content-Type", "application/warc-fields"),
+                    ],
+                    info,
+                )
+            )
+        )
+        for n in itertools.count():
+            if f.tell() >= target:
+                break
+            kind = rng.choices(kinds, weights)[0]
+            counts[kind] += 1
+            if kind == "html":
+                content_type, payload = "text/html", html_page(rng, vocabulary)
+                if len(earlier) < 256:
+                    earlier.append(payload)
+            elif kind == "non_html":
+                content_type, payload = non_html_payload(rng, vocabulary)
+            else:
+                content_type, payload = "text/html", junk_page(rng, vocabulary, earlier)
+            uri = f"https://site{rng.randint(0, 5000)}.example.com/{n}"
+            date = f"2023-11-28T{8 + n // 3600 % 12:02d}:{n // 60 % 60:02d}:{n % 60:02d}Z"
+            request_id, response_id = _record_id(rng), _record_id(rng)
+            ip = f"10.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+            request = (
+                f"GET /{n} HTTP/1.1\r\nHost: example.com\r\n"
+                "User-Agent: CCBot/2.0\r\n\r\n"
+            ).encode()
+            http = (
+                f"HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(payload)}\r\n\r\n"
+            ).encode() + payload
+            metadata = f"fetchTimeMs: {rng.randint(20, 2000)}\r\n".encode()
+            f.write(
+                encode(
+                    _record(
+                        [
+                            ("WARC-Type", "request"),
+                            ("WARC-Date", date),
+                            ("WARC-Record-ID", request_id),
+                            ("Content-Length", str(len(request))),
+                            ("Content-Type", "application/http; msgtype=request"),
+                            ("WARC-Warcinfo-ID", warcinfo_id),
+                            ("WARC-IP-Address", ip),
+                            ("WARC-Target-URI", uri),
+                        ],
+                        request,
+                    )
+                )
+            )
+            f.write(
+                encode(
+                    _record(
+                        [
+                            ("WARC-Type", "response"),
+                            ("WARC-Date", date),
+                            ("WARC-Record-ID", response_id),
+                            ("Content-Length", str(len(http))),
+                            ("Content-Type", "application/http; msgtype=response"),
+                            ("WARC-Warcinfo-ID", warcinfo_id),
+                            ("WARC-Concurrent-To", request_id),
+                            ("WARC-IP-Address", ip),
+                            ("WARC-Target-URI", uri),
+                            ("WARC-Payload-Digest", _digest(payload)),
+                            ("WARC-Block-Digest", _digest(http)),
+                            ("WARC-Identified-Payload-Type", content_type),
+                        ],
+                        http,
+                    )
+                )
+            )
+            f.write(
+                encode(
+                    _record(
+                        [
+                            ("WARC-Type", "metadata"),
+                            ("WARC-Date", date),
+                            ("WARC-Record-ID", _record_id(rng)),
+                            ("Content-Length", str(len(metadata))),
+                            ("Content-Type", "application/warc-fields"),
+                            ("WARC-Warcinfo-ID", warcinfo_id),
+                            ("WARC-Concurrent-To", response_id),
+                            ("WARC-Target-URI", uri),
+                        ],
+                        metadata,
+                    )
+                )
+            )
+    return counts
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    parsed = {}
+    for part in mix.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in DEFAULT_MIX:
+            raise ValueError(f"unknown kind {kind}, expected one of {list(DEFAULT_MIX)}")
+        parsed[kind] = float(weight)
+    return parsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("output", help=".warc or .warc.gz path")
+    parser.add_argument("--size-mb", type=float, default=10.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX)
+    args = parser.parse_args()
+    counts = write_synthetic_warc(args.output, args.size_mb, args.seed, args.mix)
+    print(json.dumps({"output": args.output, "responses": counts}))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,48 @@
-from collections import deque
-from dataclasses import dataclass
-from enum import Enum, auto
-from typing import Deque, Protocol, TypedDict
+from typing import Iterable, Iterator
 
-from .warcprocessing.types import CCRecord, CCRecordStage
+from .warcprocessing.pipeline import CCRecord
+from .warcprocessing.recordstore import RecordStore, StoredRecord
+from .warcprocessing.types import CCRecordStage
+
+# attributes of the old CCPipeline whose name isn't the stage's
+OLD_ATTRIBUTES = {"staging": CCRecordStage.STAGED}
 
 
-@dataclass
 class CCPipeline:
-    void: Deque[CCRecord] = deque()
-    source: Deque[CCRecord] = deque()
-    staging: Deque[CCRecord] = deque()
-    preprocessing: Deque[CCRecord] = deque()
-    preprocessed: Deque[CCRecord] = deque()
-    filtering: Deque[CCRecord] = deque()
-    filtered: Deque[CCRecord] = deque()
-    deduplicating: Deque[CCRecord] = deque()
-    deduplicated: Deque[CCRecord] = deque()
-    final: Deque[CCRecord] = deque()
-    error: Deque[CCRecord] = deque()
+    """
+    State of a pipeline run. Records live in a RecordStore at db_path instead
+    of one in-memory deque per stage, so the state survives restarts and is
+    shared by every process opening the same file. The old per-stage deques
+    (pipeline.staging, pipeline.error, ...) are now iterators over the
+    records at that stage, as are the attributes of stages added since
+    (pipeline.staged, pipeline.identified, ...).
+    """
+
+    def __init__(self, db_path: str, **kwargs):
+        self.store = RecordStore(db_path, **kwargs)
+
+    def add(
+        self, urls: Iterable[str], stage: CCRecordStage = CCRecordStage.VOID
+    ) -> int:
+        return self.store.add(urls, stage)
+
+    def claim(
+        self,
+        stage: CCRecordStage,
+        limit: int,
+        to_stage: CCRecordStage | None = None,
+    ) -> list[CCRecord]:
+        return self.store.claim(stage, limit, to_stage)
+
+    def save(self, record: CCRecord, claimed_as: CCRecordStage) -> bool:
+        return self.store.save(record, claimed_as)
+
+    def counts(self) -> dict[CCRecordStage, int]:
+        return self.store.counts()
+
+    def __getattr__(self, name: str) -> Iterator[StoredRecord]:
+        try:
+            stage = OLD_ATTRIBUTES.get(name) or CCRecordStage[name.upper()]
+        except KeyError:
+            raise AttributeError(name) from None
+        return self.store.records(stage)
@@ -9,3 +9,10 @@ def dump_bytes_to_gz(path: str, data: bytes, **kwargs):
 def dump_bytes_to_file(path: str, data: bytes, **kwargs):
     with open(path, "wb", **kwargs) as f:
         f.write(data)
+
+
+def append_bytes_to_file(path: str, data: bytes, **kwargs):
+    # for compressed formats every call appends a separate gzip member / zstd
+    # frame, and the file decompresses as the concatenation of all of them
+    with xopen(path, "ab", **kwargs) as f:
+        f.write(data)
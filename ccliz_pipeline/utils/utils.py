@@ -1,5 +1,6 @@
 import re
 import unicodedata
+from typing import Iterable
 
 import trafilatura as tf
 
@@ -8,21 +9,84 @@ whitespace_pattern = re.compile(r"\s+")
 number_pattern = re.compile(r"\d")
 
 
+def _ascii_tables() -> tuple[bytes, bytes]:
+    table = bytearray(range(256))
+    delete = bytearray()
+    for i in range(128):
+        c = chr(i)
+        if c.isspace():
+            table[i] = ord(" ")
+        elif c.isalnum() or c == "_":
+            table[i] = ord(c.lower())
+        else:
+            delete.append(i)
+    return bytes(table), bytes(delete)
+
+
+_ascii_table, _ascii_delete = _ascii_tables()
+_ascii_digits = b"0123456789"
+
+
+def _strip_combining(c: str) -> str:
+    return "".join(d for d in unicodedata.normalize("NFD", c) if not unicodedata.combining(d))
+
+
+class _CharTable(dict):
+    """
+    str.translate table filled in one codepoint at a time as they are first seen:
+    punctuation goes, word characters become their NFD form without combining
+    marks. Digits are kept here, they only go once whitespace has been collapsed.
+    """
+
+    def __missing__(self, codepoint: int) -> str | None:
+        c = chr(codepoint)
+        if not (c.isalnum() or c == "_"):
+            value = None
+        elif c.isdecimal():
+            value = c
+        else:
+            value = _strip_combining(c)
+        self[codepoint] = value
+        return value
+
+
+class _TokenTable(dict):
+    """
+    Normalized form of each whitespace separated (lowercased) token, followed by
+    the space that joins it to the next one. Tokens that were all punctuation
+    map to "" and vanish along with their space, tokens that were all digits
+    map to " " and leave a double space behind, same as the regex version.
+    """
+
+    def __missing__(self, token: str) -> str:
+        value = token.translate(_char_table)
+        if value:
+            value = number_pattern.sub("", value) + " "
+        self[token] = value
+        return value
+
+
+_char_table = _CharTable()
+_token_table = _TokenTable()
+_token_table_max_size = 1 << 20
+
+
 def normalize_text_(s: str) -> str:
     """
     Preprocesses a string for tokenization
     Turns to lowercase, removes punctuation, normalizes whitespace, normalizes unicode
+    (same result as lower -> drop [^\w\s] -> collapse \s+ and strip -> drop \d ->
+    NFD -> drop combining marks)
     """
-    if s:
-        s = s.lower()
-        s = punctuation_pattern.sub("", s)
-        # Normalize whitespace
-        s = whitespace_pattern.sub(" ", s).strip()
-
-        s = number_pattern.sub("", s)
+    if not s:
+        return ""
+    if s.isascii():
+        b = s.encode("ascii").translate(_ascii_table, _ascii_delete)
+        return b" ".join(b.split()).translate(None, _ascii_digits).decode("ascii")
+    if len(_token_table) > _token_table_max_size:
+        _token_table.clear()
+    return "".join(map(_token_table.__getitem__, s.lower().split()))[:-1]
 
-        # Normalize unicode
-        s = unicodedata.normalize("NFD", s)
 
-        return "".join([c for c in s if not unicodedata.combining(c)])
-    return ""
+def normalize_many(texts: Iterable[str]) -> list[str]:
+    return [normalize_text_(s) for s in texts]
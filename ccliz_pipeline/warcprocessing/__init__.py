@@ -1 +1,25 @@
-from . import download, pipeline, recordprocessing, types, utils
+from . import (
+    checkpoint,
+    deduplication,
+    digestindex,
+    documentreader,
+    download,
+    extraction,
+    extractioncache,
+    filtering,
+    langid,
+    leases,
+    linededup,
+    metrics,
+    output,
+    pipeline,
+    prefilter,
+    recordindex,
+    recordprocessing,
+    recordstore,
+    recordtable,
+    sandbox,
+    scheduler,
+    types,
+    utils,
+)
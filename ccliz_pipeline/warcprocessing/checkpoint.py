@@ -0,0 +1,79 @@
+import os
+from os import path
+
+import msgspec
+from msgspec import Struct
+
+from .output import DocumentWriter, ShardInfo
+
+
+class Checkpoint(Struct):
+    output_path: str
+    output_format: str
+    shards: list[ShardInfo]  # output covered by the checkpoint, as written
+    input_offset: int  # stream_pos of the last record covered by the checkpoint
+    next_id: int  # document id (response record number) after that record
+
+
+def load_checkpoint(checkpoint_path: str) -> Checkpoint | None:
+    if not path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path, "rb") as f:
+        return msgspec.json.decode(f.read(), type=Checkpoint)
+
+
+class Checkpointer:
+    """
+    Persists how far process_record got through a file, after output flushes.
+
+    Each save() flushes and fsyncs the writer and then atomically replaces the
+    checkpoint file, so a checkpoint never points past data that isn't on
+    disk. Flushes end a compressed frame, so the shards can be truncated back
+    to any checkpoint. With min_interval_bytes, saves are skipped until the
+    output has grown by at least that much (uncompressed).
+
+    When resuming, skip_through and first_id tell the handler which records are
+    already done: if the input was seeked to the checkpoint's record the ids
+    carry on from it, otherwise the handler counts from 0 and skips ahead.
+    """
+
+    def __init__(
+        self,
+        checkpoint_path: str,
+        writer: DocumentWriter,
+        resume_from: Checkpoint | None = None,
+        seeked: bool = False,
+        min_interval_bytes: int = 0,
+    ):
+        self.checkpoint_path = checkpoint_path
+        self.writer = writer
+        self.min_interval_bytes = min_interval_bytes
+        self.skip_through = resume_from.input_offset if resume_from else -1
+        self.first_id = resume_from.next_id - 1 if resume_from and seeked else 0
+        self._last_raw_bytes = writer.raw_bytes
+
+    def save(self, input_offset: int, next_id: int, force: bool = True):
+        if not force and (
+            self.writer.raw_bytes - self._last_raw_bytes < self.min_interval_bytes
+        ):
+            return
+        self.writer.flush()
+        self.writer.sync()
+        checkpoint = Checkpoint(
+            output_path=self.writer.output_path,
+            output_format=self.writer.format,
+            shards=self.writer.shards,
+            input_offset=input_offset,
+            next_id=next_id,
+        )
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(msgspec.json.encode(checkpoint))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+        self._last_raw_bytes = self.writer.raw_bytes
+
+    def remove(self):
+        if path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
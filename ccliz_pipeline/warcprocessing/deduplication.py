@@ -0,0 +1,364 @@
+import json
+import logging as log
+import os
+import re
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from os import path
+from typing import Literal
+
+import numpy as np
+import numpy.typing as npt
+
+from ..utils.utils import normalize_text_
+from .documentreader import DocumentReader
+from .output import iter_document_lines, output_fingerprint
+from .pipeline import CCRecord
+from .types import CCRecordStage
+from .utils import check_and_makedirs
+
+SEGMENT_RE = re.compile(r"segment-(\d+)\.json")
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+SHINGLE_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def shingle_hashes(text: str, ngram: int = 5) -> npt.NDArray[np.uint64]:
+    """32 bit hashes (stored as uint64) of the unique word ngrams in text"""
+    words = normalize_text_(text).split()
+    word_hashes = np.fromiter(
+        (zlib.crc32(w.encode()) for w in words), dtype=np.uint64, count=len(words)
+    )
+    if len(word_hashes) < ngram:
+        ngram = max(len(word_hashes), 1)
+        word_hashes = np.pad(word_hashes, (0, ngram - len(word_hashes)))
+    num_shingles = len(word_hashes) - ngram + 1
+    hashes = np.zeros(num_shingles, dtype=np.uint64)
+    for k in range(ngram):
+        # uint64 arithmetic wraps, which is all we want from it here
+        hashes = hashes * SHINGLE_MULTIPLIER + word_hashes[k : k + num_shingles]
+    return np.unique((hashes ^ (hashes >> np.uint64(32))) & MAX_HASH)
+
+
+class MinHasher:
+    """
+    Vectorized MinHash over batches of shingle sets.
+
+    Each permutation is (a * x + b) mod (2^61 - 1), evaluated for every shingle
+    of a chunk of documents at once, with the per-document minimum taken by
+    np.minimum.reduceat. max_rows bounds the (shingles x permutations) matrix.
+    """
+
+    def __init__(self, num_perm: int = 128, seed: int = 1, max_rows: int = 1 << 16):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.max_rows = max_rows
+        self.a = rng.integers(1, MAX_HASH, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, MAX_HASH, num_perm, dtype=np.uint64)
+
+    def _signatures(self, shingles: list[npt.NDArray[np.uint64]]) -> npt.NDArray:
+        offsets = np.cumsum([0] + [len(s) for s in shingles[:-1]])
+        hashed = (np.concatenate(shingles)[:, None] * self.a + self.b) % MERSENNE_PRIME
+        return np.minimum.reduceat(hashed & MAX_HASH, offsets, axis=0).astype(
+            np.uint32
+        )
+
+    def signatures(self, shingles: list[npt.NDArray[np.uint64]]) -> npt.NDArray:
+        """(len(shingles), num_perm) uint32 signature matrix"""
+        out = np.empty((len(shingles), self.num_perm), dtype=np.uint32)
+        start = rows = 0
+        for i, s in enumerate(shingles):
+            if rows and rows + len(s) > self.max_rows:
+                out[start:i] = self._signatures(shingles[start:i])
+                start, rows = i, 0
+            rows += len(s)
+        if start < len(shingles):
+            out[start:] = self._signatures(shingles[start:])
+        return out
+
+
+def band_keys(signatures: npt.NDArray[np.uint32], bands: int) -> npt.NDArray:
+    """Collapses each band of rows into one uint64 key, (n, bands)"""
+    n, num_perm = signatures.shape
+    if num_perm % bands:
+        raise ValueError(f"{num_perm} permutations can't be split into {bands} bands")
+    rows = signatures.reshape(n, bands, num_perm // bands).astype(np.uint64)
+    keys = np.zeros((n, bands), dtype=np.uint64)
+    for r in range(rows.shape[2]):
+        keys = keys * SHINGLE_MULTIPLIER + rows[:, :, r]
+    return keys
+
+
+class LSHIndex:
+    """
+    Banded LSH index persisted as a directory of segments.
+
+    Each segment holds the document ids and (n, bands) band keys of one
+    record, as plain .npy files so they can be memory mapped, and a
+    segment-<seq>.json with its name, size and the fingerprint of the output it
+    was read from (see output_fingerprint). Sequence numbers are claimed by
+    creating that json with O_EXCL, so several processes can add segments to
+    the same index at once. Segments are kept in the order of their sequence
+    numbers, and that order decides which document of a cluster is kept, so
+    documents from earlier runs win over new ones. Adding a segment under a
+    name already in the index replaces the old one.
+    """
+
+    def __init__(self, index_dir: str, bands: int = 16):
+        self.index_dir = index_dir
+        self.bands = bands
+        os.makedirs(index_dir, exist_ok=True)
+        self._migrate_manifest()
+        self.segments: list[dict] = self._read_segments()
+        self._labels: npt.NDArray[np.int64] | None = None
+
+    def _migrate_manifest(self):
+        # indexes written before segments had their own json
+        manifest_path = path.join(self.index_dir, "segments.json")
+        if not path.exists(manifest_path):
+            return
+        with open(manifest_path) as f:
+            for seq, segment in enumerate(json.load(f)):
+                with open(self._segment_path(seq, "json"), "w") as f_seg:
+                    json.dump(segment | {"source": None}, f_seg)
+        os.remove(manifest_path)
+
+    def _read_segments(self) -> list[dict]:
+        latest: dict[str, dict] = {}
+        for name in sorted(os.listdir(self.index_dir)):
+            match = SEGMENT_RE.fullmatch(name)
+            if not match:
+                continue
+            try:
+                with open(path.join(self.index_dir, name)) as f:
+                    segment = json.load(f)
+            except (OSError, ValueError):
+                # claimed, not written yet
+                continue
+            # of segments of the same name, the last one added counts
+            latest[segment["name"]] = segment | {"seq": int(match.group(1))}
+        return sorted(latest.values(), key=lambda s: s["seq"])
+
+    def __contains__(self, name: str) -> bool:
+        return self.segment(name) is not None
+
+    def __len__(self) -> int:
+        return sum(s["size"] for s in self.segments)
+
+    def segment(self, name: str) -> dict | None:
+        return next((s for s in self.segments if s["name"] == name), None)
+
+    def _segment_path(self, seq: int, kind: str) -> str:
+        extension = "json" if kind == "json" else f"{kind}.npy"
+        return path.join(self.index_dir, f"segment-{seq:06d}.{extension}")
+
+    def _claim_seq(self) -> int:
+        claimed = [
+            int(match.group(1))
+            for name in os.listdir(self.index_dir)
+            if (match := SEGMENT_RE.fullmatch(name))
+        ]
+        seq = max(claimed, default=-1) + 1
+        while True:
+            try:
+                os.close(
+                    os.open(
+                        self._segment_path(seq, "json"),
+                        os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                    )
+                )
+                return seq
+            except FileExistsError:
+                seq += 1
+
+    def _remove_segment(self, seq: int):
+        for kind in ("json", "ids", "keys"):
+            try:
+                os.remove(self._segment_path(seq, kind))
+            except FileNotFoundError:
+                pass
+
+    def add(
+        self,
+        name: str,
+        ids: list[str],
+        keys: npt.NDArray[np.uint64],
+        source: list | None = None,
+    ):
+        """Adds a segment, in place of any segment of the same name"""
+        seq = self._claim_seq()
+        np.save(self._segment_path(seq, "ids"), np.array(ids, dtype=np.bytes_))
+        np.save(self._segment_path(seq, "keys"), keys)
+        segment = {"name": name, "size": len(ids), "source": source}
+        tmp_path = self._segment_path(seq, "json") + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(segment, f)
+        os.replace(tmp_path, self._segment_path(seq, "json"))
+        for old in self.segments:
+            if old["name"] == name:
+                self._remove_segment(old["seq"])
+        self.segments = [s for s in self.segments if s["name"] != name]
+        self.segments.append(segment | {"seq": seq})
+        self._labels = None
+
+    def segment_offset(self, name: str) -> int:
+        offset = 0
+        for s in self.segments:
+            if s["name"] == name:
+                return offset
+            offset += s["size"]
+        raise KeyError(name)
+
+    def band_column(self, band: int) -> npt.NDArray[np.uint64]:
+        return np.concatenate(
+            [
+                np.load(self._segment_path(s["seq"], "keys"), mmap_mode="r")[:, band]
+                for s in self.segments
+            ]
+            or [np.empty(0, dtype=np.uint64)]
+        )
+
+    def band_edges(self, band: int) -> tuple[npt.NDArray, npt.NDArray]:
+        """Links every document to the first document sharing its key in band"""
+        keys = self.band_column(band)
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        first = np.repeat(order[starts], np.diff(np.r_[starts, len(keys)]))
+        linked = first != order
+        return first[linked], order[linked]
+
+    def labels(self, processes: int = 1) -> npt.NDArray[np.int64]:
+        """
+        Cluster label (index of the first document in the cluster) for every
+        document in the index. Bands are independent, so with processes > 1
+        they are resolved on a pool.
+        """
+        if self._labels is not None:
+            return self._labels
+        if processes > 1:
+            with ProcessPoolExecutor(processes) as executor:
+                edges = list(executor.map(self.band_edges, range(self.bands)))
+        else:
+            edges = [self.band_edges(band) for band in range(self.bands)]
+        src = np.concatenate([e[0] for e in edges] or [np.empty(0, np.int64)])
+        dst = np.concatenate([e[1] for e in edges] or [np.empty(0, np.int64)])
+
+        labels = np.arange(len(self), dtype=np.int64)
+        while True:
+            previous = labels.copy()
+            np.minimum.at(labels, dst, labels[src])
+            np.minimum.at(labels, src, labels[dst])
+            # pointer jumping until every label points at a root
+            while not np.array_equal(labels, labels[labels]):
+                labels = labels[labels]
+            if np.array_equal(labels, previous):
+                break
+        self._labels = labels
+        return labels
+
+
+def _read_documents(file_path: str) -> tuple[list[str], list[str]]:
+    ids, texts = [], []
+    # only the fields dedup needs, the rest of the TextDocument is skipped
+    for doc in DocumentReader(file_path, fields=("id", "raw_text")):
+        ids.append(doc.id)
+        texts.append(doc.raw_text)
+    return ids, texts
+
+
+def index_record(
+    record: CCRecord,
+    index: LSHIndex,
+    hasher: MinHasher,
+    ngram: int = 5,
+    batch_size: int = 1024,
+):
+    """First pass: signs every document of a PREPROCESSED or FILTERED record"""
+    if record.stage not in (CCRecordStage.PREPROCESSED, CCRecordStage.FILTERED):
+        raise ValueError(f"Record {record.record_id} is not ready to be deduplicated")
+    input_path = record.get_path(record.stage)
+    record.update_stage(CCRecordStage.DEDUPLICATING)
+    source = output_fingerprint(input_path)
+    segment = index.segment(record.record_id)
+    if segment is not None and segment["source"] == source:
+        log.info(f"Record {record.record_id} already indexed")
+        return
+    if segment is not None:
+        log.info(f"Output of {record.record_id} changed since indexed, indexing again")
+    ids, texts = _read_documents(input_path)
+    keys = np.empty((len(ids), index.bands), dtype=np.uint64)
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start : start + batch_size]
+        signatures = hasher.signatures([shingle_hashes(t, ngram) for t in batch])
+        keys[start : start + len(batch)] = band_keys(signatures, index.bands)
+    index.add(record.record_id, ids, keys, source)
+
+
+def write_representatives(
+    record: CCRecord,
+    index: LSHIndex,
+    overwrite: Literal["always", "never", "rename"] = "rename",
+) -> int:
+    """Second pass: copies the documents that represent their cluster"""
+    # the stage before DEDUPLICATING is where the documents were read from
+    input_path = record.get_path(record.stage_history[-1])
+    # labels go by position, so they only fit the output that was indexed
+    if index.segment(record.record_id)["source"] != output_fingerprint(input_path):
+        raise ValueError(f"Output of {record.record_id} changed since indexed")
+    labels = index.labels()
+    offset = index.segment_offset(record.record_id)
+    dest = check_and_makedirs(record.get_path(CCRecordStage.DEDUPLICATED), overwrite)
+    kept = position = 0
+    with open(dest, "wb") as f_out:
+        for line in iter_document_lines(input_path):
+            if not line.strip():
+                continue
+            if labels[offset + position] == offset + position:
+                f_out.write(line)
+                kept += 1
+            position += 1
+    return kept
+
+
+def deduplicate_records(
+    records: list[CCRecord],
+    index_dir: str,
+    num_perm: int = 128,
+    bands: int = 16,
+    ngram: int = 5,
+    seed: int = 1,
+    processes: int = 1,
+    overwrite: Literal["always", "never", "rename"] = "rename",
+) -> list[CCRecord]:
+    """
+    MinHash/LSH near-duplicate removal over PREPROCESSED or FILTERED records.
+
+    Every document is signed and added to the LSH index at index_dir, then each
+    record is rewritten to DEDUPLICATED with only the first document of each
+    cluster. The index is kept between runs, so documents that duplicate
+    anything indexed before (in any earlier run) are dropped too.
+    """
+    index = LSHIndex(index_dir, bands)
+    hasher = MinHasher(num_perm, seed)
+    indexed = []
+    for record in records:
+        try:
+            index_record(record, index, hasher, ngram)
+        except Exception as e:
+            log.error(f"Error deduplicating record {record.record_id}: {e}")
+            record.update_stage(CCRecordStage.ERROR)
+        else:
+            indexed.append(record)
+
+    index.labels(processes)
+    for record in indexed:
+        try:
+            kept = write_representatives(record, index, overwrite)
+        except Exception as e:
+            log.error(f"Error deduplicating record {record.record_id}: {e}")
+            record.update_stage(CCRecordStage.ERROR)
+        else:
+            log.info(f"Kept {kept} documents of {record.record_id}")
+            record.update_stage(CCRecordStage.DEDUPLICATED)
+    return records
@@ -0,0 +1,229 @@
+import base64
+import hashlib
+import math
+import os
+import time
+import uuid
+from glob import glob
+from os import path
+
+import numpy as np
+import numpy.typing as npt
+
+
+def digest_key(payload_digest: str) -> int:
+    """
+    Folds a WARC payload digest ("sha1:<base32>") into a 64 bit key. Anything
+    that isn't base32 sha1 is hashed instead.
+    """
+    algorithm, _, value = payload_digest.partition(":")
+    if algorithm == "sha1" and len(value) == 32:
+        try:
+            return int.from_bytes(base64.b32decode(value)[:8], "big")
+        except ValueError:
+            pass
+    return int.from_bytes(
+        hashlib.blake2b(payload_digest.encode(), digest_size=8).digest(), "big"
+    )
+
+
+def owner_key(owner: str) -> int:
+    """64 bit key of the record owning a digest; 0 is left for unknown owners"""
+    key = int.from_bytes(hashlib.blake2b(owner.encode(), digest_size=8).digest(), "big")
+    return key or 1
+
+
+class DigestIndex:
+    """
+    Persistent map of the payload digests seen so far to the record that first
+    had them.
+
+    Stored as a directory of .npy shards of (digest, owner) uint64 rows sorted
+    by digest, which are memory mapped and binary searched, so the index costs
+    16 bytes per digest on disk and next to nothing in memory. New digests are
+    held in a dict until flush() writes them out as another shard, so several
+    workers can share one directory and each add their own shards.
+
+    Shards are merged as they pile up, size-tiered: once fanout shards of
+    about the same size (the same power of fanout rows) are there, a flush
+    merges them into one of the next tier, so a directory holds at most
+    fanout shards per tier and a lookup searches a few dozen shards however
+    many records were flushed. One worker merges at a time, the others skip
+    it while compact.lock exists; compact() merges everything into one.
+
+    A digest is a duplicate unless it was flushed as owned by the record
+    asking, and hasn't been asked for again since the last flush: a record
+    that is run again keeps its documents, but still drops its own repeats.
+    Digests flushed by other workers are seen from this index's next flush
+    on, when it opens the directory's shards again.
+    """
+
+    def __init__(self, index_dir: str, fanout: int = 8, lock_seconds: float = 600):
+        self.index_dir = index_dir
+        self.fanout = fanout
+        # a lock older than this was left by a worker that died merging
+        self.lock_seconds = lock_seconds
+        os.makedirs(index_dir, exist_ok=True)
+        self._shards: dict[str, npt.NDArray[np.uint64]] = {}
+        self._open_shards()
+        self._pending: dict[int, int] = {}
+        # digests of their own owner seen again since the last flush
+        self._reclaimed: set[int] = set()
+        self.lookups = 0
+        self.hits = 0
+
+    def __getstate__(self):
+        # shards are reopened on the other side instead of being pickled
+        return {
+            "index_dir": self.index_dir,
+            "fanout": self.fanout,
+            "lock_seconds": self.lock_seconds,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _shard_paths(self) -> list[str]:
+        return sorted(glob(path.join(self.index_dir, "digests-*.npy")))
+
+    def _open_shards(self):
+        # maps the directory's shards, keeping the maps of those still there;
+        # a shard merged away between listing and loading is in the merged one
+        while True:
+            try:
+                self._shards = {p: self._load(p) for p in self._shard_paths()}
+                return
+            except FileNotFoundError:
+                continue
+
+    def _load(self, shard_path: str) -> npt.NDArray[np.uint64]:
+        shard = self._shards.get(shard_path)
+        if shard is None:
+            shard = np.load(shard_path, mmap_mode="r")
+        return shard
+
+    def __len__(self) -> int:
+        return sum(len(s) for s in self._shards.values()) + len(self._pending)
+
+    def __contains__(self, payload_digest: str) -> bool:
+        return self._owner_of(digest_key(payload_digest)) is not None
+
+    def _owner_of(self, key: int) -> int | None:
+        if key in self._pending:
+            return self._pending[key]
+        value = np.uint64(key)
+        for shard in self._shards.values():
+            # shards of an older index hold digests only, of unknown owners
+            keys = shard[:, 0] if shard.ndim == 2 else shard
+            i = np.searchsorted(keys, value)
+            if i < len(keys) and keys[i] == value:
+                return int(shard[i, 1]) if shard.ndim == 2 else 0
+        return None
+
+    def check_and_add(self, payload_digest: str, owner: str = "") -> bool:
+        """
+        Returns whether the digest is a duplicate for owner (a record id), and
+        records it as owner's if it wasn't seen at all
+        """
+        key = digest_key(payload_digest)
+        self.lookups += 1
+        found = self._owner_of(key)
+        if found is None:
+            self._pending[key] = owner_key(owner)
+            return False
+        if (
+            key not in self._pending
+            and key not in self._reclaimed
+            and found == owner_key(owner)
+        ):
+            self._reclaimed.add(key)
+            return False
+        self.hits += 1
+        return True
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    def _write_shard(self, rows: npt.NDArray[np.uint64]) -> str:
+        shard_path = path.join(self.index_dir, f"digests-{uuid.uuid4().hex}.npy")
+        tmp_path = shard_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, rows)
+        os.replace(tmp_path, shard_path)
+        return shard_path
+
+    def flush(self):
+        self._reclaimed.clear()
+        if not self._pending:
+            return
+        rows = np.array(list(self._pending.items()), dtype=np.uint64)
+        rows = rows[np.argsort(rows[:, 0])]
+        self._write_shard(rows)
+        self._pending.clear()
+        self._merge_tiers()
+        self._open_shards()
+
+    def _lock(self) -> bool:
+        lock_path = path.join(self.index_dir, "compact.lock")
+        for _ in range(2):
+            try:
+                os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except FileExistsError:
+                try:
+                    if time.time() - path.getmtime(lock_path) < self.lock_seconds:
+                        return False
+                    os.remove(lock_path)
+                except FileNotFoundError:
+                    pass
+        return False
+
+    def _unlock(self):
+        os.remove(path.join(self.index_dir, "compact.lock"))
+
+    def _merge(self, paths: list[str]):
+        # one shard of the rows of paths, then paths removed; the first owner
+        # of a digest, in path order, keeps it
+        shards = [np.load(p) for p in paths]
+        rows = np.concatenate(
+            [s if s.ndim == 2 else np.c_[s, np.zeros_like(s)] for s in shards]
+        )
+        _, first = np.unique(rows[:, 0], return_index=True)
+        self._write_shard(rows[first])
+        for p in paths:
+            os.remove(p)
+
+    def _tier(self, shard_path: str) -> int:
+        return int(math.log(max(len(self._load(shard_path)), 1), self.fanout))
+
+    def _merge_tiers(self):
+        if len(self._shard_paths()) < self.fanout or not self._lock():
+            return
+        try:
+            while True:
+                tiers: dict[int, list[str]] = {}
+                for p in self._shard_paths():
+                    tiers.setdefault(self._tier(p), []).append(p)
+                full = [paths for paths in tiers.values() if len(paths) >= self.fanout]
+                if not full:
+                    return
+                self._merge(full[0])
+        finally:
+            self._unlock()
+
+    def compact(self) -> bool:
+        """
+        Merges every shard in the directory (including other workers') into
+        one; False if another worker is merging
+        """
+        self.flush()
+        if not self._lock():
+            return False
+        try:
+            if len(self._shard_paths()) > 1:
+                self._merge(self._shard_paths())
+        finally:
+            self._unlock()
+        self._open_shards()
+        return True
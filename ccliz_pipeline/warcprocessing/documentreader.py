@@ -0,0 +1,292 @@
+import io
+import mmap
+import os
+from functools import lru_cache
+from os import path
+from typing import Any, Iterator, Sequence
+
+import msgspec
+import numpy as np
+from msgspec import Struct
+from xopen import xopen
+
+from .output import ShardInfo, encoder, output_stem, read_manifest
+from .types import TextDocument, WARCHeader
+
+INDEX_DTYPE = np.dtype([("shard", "<i4"), ("frame", "<i4"), ("offset", "<i8")])
+
+
+def _field_spec(struct_type: type[Struct], names: Sequence[str]) -> list[tuple]:
+    fields = {f.name: f for f in msgspec.structs.fields(struct_type)}
+    spec = []
+    for name in names:
+        if name not in fields:
+            raise ValueError(f"{struct_type.__name__} has no field {name}")
+        field = fields[name]
+        if field.default is msgspec.NODEFAULT:
+            spec.append((name, field.type))
+        else:
+            spec.append((name, field.type, field.default))
+    return spec
+
+
+@lru_cache(maxsize=None)
+def projection(fields: tuple[str, ...]) -> type[Struct]:
+    """
+    Struct type with only the given TextDocument fields, so decoding skips the
+    rest. Header fields are given as "header.<name>", e.g.
+    projection(("id", "header.target_uri")).
+    """
+    header_fields = [f.split(".", 1)[1] for f in fields if f.startswith("header.")]
+    spec = _field_spec(
+        TextDocument,
+        [f for f in fields if not f.startswith("header.") and f != "header"],
+    )
+    if "header" in fields:
+        spec.append(("header", WARCHeader))
+    elif header_fields:
+        header_type = msgspec.defstruct(
+            "HeaderProjection", _field_spec(WARCHeader, header_fields)
+        )
+        spec.append(("header", header_type))
+    return msgspec.defstruct("DocumentProjection", spec)
+
+
+@lru_cache(maxsize=None)
+def _decoder(document_type: type) -> msgspec.json.Decoder:
+    # not strict, outputs from before content_length was written as an int
+    # have it as a string
+    return msgspec.json.Decoder(document_type, strict=False)
+
+
+def _document_number(document_id: str) -> int:
+    return int(document_id.rsplit("/", 1)[1])
+
+
+def _compressed(shard_path: str) -> bool:
+    return shard_path.endswith((".gz", ".zst"))
+
+
+def _line_chunks(
+    data: mmap.mmap, start: int, end: int, chunk_bytes: int
+) -> Iterator[tuple[int, memoryview]]:
+    # (offset from start, view) pieces of data[start:end] of about chunk_bytes,
+    # each cut after a newline
+    view = memoryview(data)
+    position = start
+    while position < end:
+        cut = data.find(b"\n", min(position + chunk_bytes, end) - 1, end)
+        cut = end if cut == -1 else cut + 1
+        yield position - start, view[position:cut]
+        position = cut
+
+
+class DocumentReader:
+    """
+    Reads back the TextDocuments of a process_record output: every shard
+    listed in its manifest, or output_path alone if it has none.
+
+    Documents are decoded with a typed msgspec decoder a chunk of lines at a
+    time, straight from an mmap for uncompressed shards and from the
+    decompressed stream for .gz/.zst shards. With fields, only those fields are
+    decoded (see projection). Parquet shards need pyarrow.
+
+    get() looks a document up by id through a sidecar index (<stem>.docidx.npy),
+    a dense array by document number of (shard, frame, offset within the
+    frame), built on first use. A lookup seeks straight to the document's line
+    in an uncompressed shard, and only decompresses its frame, one flush of
+    the writer, up to the line in a compressed one.
+    """
+
+    def __init__(
+        self,
+        output_path: str,
+        fields: Sequence[str] | None = None,
+        chunk_bytes: int = 8 << 20,
+    ):
+        self.output_path = output_path
+        self.document_type = projection(tuple(fields)) if fields else TextDocument
+        self.fields = tuple(fields) if fields else None
+        self.chunk_bytes = chunk_bytes
+        self.manifest = read_manifest(output_path)
+        if self.manifest is not None:
+            self.shards = self.manifest.shards
+        else:
+            self.shards = [
+                ShardInfo(
+                    path=output_path, bytes=path.getsize(output_path), frames=[0]
+                )
+            ]
+        self._index: np.ndarray | None = None
+
+    def __len__(self) -> int:
+        if self.manifest is not None:
+            return self.manifest.documents
+        return sum(len(batch) for batch in self.iter_batches())
+
+    def __iter__(self) -> Iterator[Any]:
+        for batch in self.iter_batches():
+            yield from batch
+
+    def iter_batches(self) -> Iterator[list]:
+        """Decoded documents, a list per chunk of lines"""
+        decoder = _decoder(self.document_type)
+        for shard in self.shards:
+            if shard.path.endswith(".parquet"):
+                yield from self._parquet_batches(shard.path)
+                continue
+            for _, _, chunk in self._shard_chunks(shard):
+                yield decoder.decode_lines(chunk)
+
+    def iter_line_batches(self) -> Iterator[tuple[list, list[bytes]]]:
+        """
+        Decoded documents with the JSON lines they were decoded from, a chunk
+        at a time, so they can be written on without encoding them again
+        """
+        decoder = _decoder(self.document_type)
+        for shard in self.shards:
+            if shard.path.endswith(".parquet"):
+                import pyarrow.parquet as pq
+
+                for batch in pq.ParquetFile(shard.path).iter_batches():
+                    lines = [encoder.encode(row) + b"\n" for row in batch.to_pylist()]
+                    yield decoder.decode_lines(b"".join(lines)), lines
+                continue
+            for _, _, chunk in self._shard_chunks(shard):
+                lines = bytes(chunk).splitlines(keepends=True)
+                yield decoder.decode_lines(chunk), lines
+
+    def _shard_chunks(self, shard: ShardInfo) -> Iterator[tuple[int, int, Any]]:
+        # (frame, offset in the frame, chunk of whole lines)
+        if not shard.bytes:
+            return
+        frames = shard.frames or [0]
+        ends = frames[1:] + [shard.bytes]
+        with open(shard.path, "rb") as f:
+            if not _compressed(shard.path):
+                # left to be unmapped once the last view of it is gone
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                for frame, (start, end) in enumerate(zip(frames, ends)):
+                    for offset, chunk in _line_chunks(
+                        data, start, end, self.chunk_bytes
+                    ):
+                        yield frame, offset, chunk
+                return
+            for frame, (start, end) in enumerate(zip(frames, ends)):
+                f.seek(start)
+                with xopen(io.BytesIO(f.read(end - start)), "rb") as decompressed:
+                    yield from self._stream_chunks(frame, decompressed)
+
+    def _stream_chunks(self, frame: int, stream) -> Iterator[tuple[int, int, bytes]]:
+        offset = 0
+        rest = b""
+        while data := stream.read(self.chunk_bytes):
+            data = rest + data
+            cut = data.rfind(b"\n") + 1
+            if cut:
+                yield frame, offset, data[:cut]
+                offset += cut
+            rest = data[cut:]
+        if rest:
+            yield frame, offset, rest
+
+    def _parquet_batches(self, shard_path: str) -> Iterator[list]:
+        import pyarrow.parquet as pq
+
+        columns = None
+        if self.fields:
+            columns = sorted({f.split(".", 1)[0] for f in self.fields})
+        for batch in pq.ParquetFile(shard_path).iter_batches(columns=columns):
+            yield msgspec.convert(batch.to_pylist(), list[self.document_type])
+
+    def index_path(self) -> str:
+        return output_stem(self.output_path) + ".docidx.npy"
+
+    def build_index(self) -> np.ndarray:
+        id_decoder = _decoder(projection(("id",)))
+        numbers, entries = [], []
+        for shard_number, shard in enumerate(self.shards):
+            if shard.path.endswith(".parquet"):
+                self._index_parquet(shard_number, shard.path, numbers, entries)
+                continue
+            for frame, offset, chunk in self._shard_chunks(shard):
+                ids = id_decoder.decode_lines(chunk)
+                ends = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == 10)
+                starts = np.r_[0, ends[: len(ids) - 1] + 1] + offset
+                numbers.extend(_document_number(d.id) for d in ids)
+                entries.extend((shard_number, frame, int(s)) for s in starts)
+        index = np.zeros(max(numbers, default=-1) + 1, dtype=INDEX_DTYPE)
+        index["shard"] = -1
+        if numbers:
+            index[np.array(numbers)] = np.array(entries, dtype=INDEX_DTYPE)
+        return index
+
+    def _index_parquet(self, shard_number: int, shard_path: str, numbers, entries):
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(shard_path)
+        for frame in range(parquet_file.num_row_groups):
+            ids = parquet_file.read_row_group(frame, columns=["id"])["id"]
+            numbers.extend(_document_number(d) for d in ids.to_pylist())
+            entries.extend((shard_number, frame, row) for row in range(len(ids)))
+
+    def load_index(self) -> np.ndarray:
+        """The sidecar index, built and saved first if missing or stale"""
+        if self._index is not None:
+            return self._index
+        index_path = self.index_path()
+        newest = max(path.getmtime(s.path) for s in self.shards)
+        if path.exists(index_path) and path.getmtime(index_path) >= newest:
+            self._index = np.load(index_path)
+            return self._index
+        self._index = self.build_index()
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, self._index)
+        os.replace(tmp_path, index_path)
+        return self._index
+
+    def _read_line(self, shard: ShardInfo, frame: int, offset: int) -> bytes:
+        frames = shard.frames or [0]
+        start = frames[frame]
+        with open(shard.path, "rb") as f:
+            if not _compressed(shard.path):
+                f.seek(start + offset)
+                return f.readline()
+            end = frames[frame + 1] if frame + 1 < len(frames) else shard.bytes
+            f.seek(start)
+            with xopen(io.BytesIO(f.read(end - start)), "rb") as decompressed:
+                decompressed.read(offset)
+                return decompressed.readline()
+
+    def get(self, document_id: str):
+        """
+        The document with the given id, or None if the output doesn't have it,
+        e.g. for the id of a document of another record
+        """
+        number = _document_number(document_id)
+        index = self.load_index()
+        if number >= len(index) or index[number]["shard"] < 0:
+            return None
+        shard_number, frame, offset = index[number].tolist()
+        shard = self.shards[shard_number]
+        if shard.path.endswith(".parquet"):
+            import pyarrow.parquet as pq
+
+            rows = pq.ParquetFile(shard.path).read_row_group(frame)
+            row = rows.slice(offset, 1).to_pylist()[0]
+            if row["id"] != document_id:
+                return None
+            return msgspec.convert(row, self.document_type)
+        line = self._read_line(shard, frame, offset)
+        # the index goes by number only, the rest of the id has to match too
+        if _decoder(projection(("id",))).decode(line).id != document_id:
+            return None
+        return _decoder(self.document_type).decode(line)
+
+
+def read_documents(
+    output_path: str, fields: Sequence[str] | None = None
+) -> Iterator[Any]:
+    """Shorthand for iterating over a DocumentReader"""
+    return iter(DocumentReader(output_path, fields))
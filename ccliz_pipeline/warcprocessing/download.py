@@ -2,16 +2,18 @@ import gzip
 import logging as log
 import os
 import re
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from os import path
 from shutil import copyfileobj
-from typing import Literal
+from typing import Iterable, Iterator, Literal
 
 import requests
-import tqdm
+from requests.adapters import HTTPAdapter
 
 from .pipeline import CCRecord
 from .types import ArchiveIO, CCRecordStage
-from .utils import check_and_makedirs, check_file
+from .utils import check_and_makedirs
 
 process_segment_url_re = re.compile(
     r"crawl-data\/CC-MAIN-(\d{4}-\d{2})\/segments\/(\d+\.\d+)\/warc\/CC-MAIN-\d{14}-\d{14}-(\d{5})\.warc\.gz"
@@ -33,22 +35,142 @@ def process_segment_url(url: str) -> CCRecord:
 
 
 class HTTPArchiveIO(ArchiveIO):
+    """
+    Downloads CC source files over a pooled keep-alive session.
+
+    Files are streamed to a .part file next to the SOURCE path in chunks and
+    only renamed into place once complete. An existing .part file is resumed
+    with a Range request, and failed attempts are retried with exponential
+    backoff. A .part file the server has nothing past (416) is only taken as
+    complete if its size is the remote file's; otherwise it's started over.
+    """
+
     def __init__(
         self,
-        # record: CCRecord,
+        # kept for the old positional signature; files go to the SOURCE path
+        # of each record's own config
         CC_local_path: str = "CC/",
         CC_remote_path: str = "https://data.commoncrawl.org/",
+        *,
+        max_workers: int = 8,
+        chunk_size: int = 1 << 20,
+        retries: int = 5,
+        backoff: float = 1.0,
+        timeout: float = 60,
     ):
-        # self.record = record
         self.CC_local_path = CC_local_path
         self.CC_remote_path = CC_remote_path
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
     def _format_url(self, record: CCRecord) -> str:
-        return path.join(self.CC_remote_path, record["raw"])
+        return path.join(self.CC_remote_path, record.raw)
+
+    def _remote_size(self, url: str, resp: requests.Response) -> int | None:
+        # "bytes */<size>" of a 416 response, or the length a HEAD reports
+        content_range = resp.headers.get("Content-Range", "")
+        if content_range.startswith("bytes */"):
+            return int(content_range[len("bytes */") :])
+        head = self.session.head(url, timeout=self.timeout, allow_redirects=True)
+        head.raise_for_status()
+        length = head.headers.get("Content-Length")
+        return int(length) if length is not None else None
+
+    def _fetch(self, url: str, part_path: str):
+        offset = path.getsize(part_path) if path.exists(part_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with self.session.get(
+            url, headers=headers, stream=True, timeout=self.timeout
+        ) as resp:
+            if resp.status_code == 416:
+                # nothing past offset, which is only done if offset is the size
+                total = self._remote_size(url, resp)
+                if total != offset:
+                    os.remove(part_path)
+                    raise IOError(
+                        f"{part_path} has {offset} bytes but {url} has {total}, "
+                        "starting over"
+                    )
+                return
+            resp.raise_for_status()
+            if resp.status_code == 206:
+                total = int(resp.headers["Content-Range"].rsplit("/", 1)[1])
+                mode = "ab"
+            else:
+                # server ignored the range, start over
+                total = int(resp.headers.get("Content-Length", -1))
+                mode = "wb"
+            with open(part_path, mode) as f:
+                for chunk in resp.iter_content(self.chunk_size):
+                    f.write(chunk)
+        if total >= 0 and path.getsize(part_path) != total:
+            raise IOError(
+                f"Incomplete download of {url}: "
+                f"{path.getsize(part_path)} of {total} bytes"
+            )
+
+    def download(self, record: CCRecord) -> str:
+        if record.stage != CCRecordStage.VOID:
+            raise ValueError(f"Record {record.record_id} is already downloaded")
+        dest = record.get_path(CCRecordStage.SOURCE)
+        url = self._format_url(record)
+        if path.exists(dest):
+            log.info(f"Record {record.record_id} already downloaded")
+            record.update_stage(CCRecordStage.SOURCE)
+            return dest
+        os.makedirs(path.dirname(dest), exist_ok=True)
+        part_path = dest + ".part"
+        for attempt in range(self.retries + 1):
+            try:
+                log.info(f"Downloading record {record.record_id} from {url}")
+                self._fetch(url, part_path)
+                break
+            except (requests.RequestException, IOError) as e:
+                status = getattr(getattr(e, "response", None), "status_code", None)
+                retryable = status is None or status >= 500 or status in (408, 429)
+                if attempt == self.retries or not retryable:
+                    log.error(f"Error downloading record {record.record_id}")
+                    record.update_stage(CCRecordStage.ERROR)
+                    raise e
+                delay = self.backoff * 2**attempt
+                log.warning(f"{url}: {e}, retrying in {delay}s")
+                time.sleep(delay)
+        os.replace(part_path, dest)
+        record.update_stage(CCRecordStage.SOURCE)
+        return dest
 
-    def download(self, record: CCRecord):
-        # Download the file to the local path
-        req = requests.get(record["raw"], allow_redirects=True)
+    def download_many(
+        self, records: Iterable[CCRecord], max_workers: int | None = None
+    ) -> Iterator[CCRecord]:
+        """
+        Downloads records concurrently, yielding each one (at SOURCE or ERROR)
+        as it finishes. Only 2 * max_workers records are in flight at a time.
+        """
+        max_workers = max_workers or self.max_workers
+        records = iter(records)
+        pending: dict[Future, CCRecord] = {}
+        with ThreadPoolExecutor(max_workers) as executor:
+            while True:
+                while len(pending) < 2 * max_workers:
+                    record = next(records, None)
+                    if record is None:
+                        break
+                    pending[executor.submit(self.download, record)] = record
+                if not pending:
+                    return
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    record = pending.pop(future)
+                    if future.exception():
+                        log.error(f"{record.record_id}: {future.exception()}")
+                    yield record
 
 
 class LocalArchiveIO(ArchiveIO):
@@ -112,8 +234,7 @@ class LocalArchiveIO(ArchiveIO):
 def _copy_file_gzip(
     source, dest, delete: bool = False, overwrite: Literal["always", "never"] = "never"
 ):
-    source = check_file(source, overwrite)
-    dest = check_and_makedirs(dest)
+    dest = check_and_makedirs(dest, overwrite)
     with gzip.open(source, "rb") as f_in:
         with open(dest, "wb") as f_out:
             copyfileobj(f_in, f_out)
@@ -131,8 +252,8 @@ def stage_record(
         )
     try:
         log.info(f"Staging record {record.record_id}")
-        source_path = record.get_path(record, CCRecordStage.SOURCE)
-        staged_path = record.get_path(record, CCRecordStage.STAGED)
+        source_path = record.get_path(CCRecordStage.SOURCE)
+        staged_path = record.get_path(CCRecordStage.STAGED)
         dest = _copy_file_gzip(
             source_path, staged_path, delete=delete, overwrite=overwrite
         )
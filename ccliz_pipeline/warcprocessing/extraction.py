@@ -0,0 +1,156 @@
+import hashlib
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from typing import ClassVar
+
+import trafilatura as tf
+from resiliparse.extract.html2text import extract_plain_text
+from resiliparse.parse.encoding import bytes_to_str, detect_encoding
+from resiliparse.parse.html import HTMLTree
+
+
+def decode_html(body: bytes) -> str:
+    """
+    The payload of a response block as text: HTTP headers (if the block has
+    them) dropped, decoded with the encoding detected from the bytes
+    """
+    if body.startswith(b"HTTP/"):
+        end = body.find(b"\r\n\r\n")
+        body = body[end + 4 :] if end != -1 else b""
+    return bytes_to_str(body, detect_encoding(body))
+
+
+class Extractor(ABC):
+    """
+    Main text extraction from HTML. Subclasses implement extract_text on the
+    decoded page; calling an extractor on a raw response block decodes it
+    (see decode_html) once and extracts from that, except for
+    TrafilaturaExtractor, which is given the block as it is.
+
+    settings is a short, stable name for the extractor and its parameters,
+    used to key cached results (see ExtractionCache).
+    """
+
+    name: ClassVar[str]
+
+    @abstractmethod
+    def extract_text(self, html: str) -> str | None:
+        ...
+
+    def __call__(self, body: bytes) -> str | None:
+        return self.extract_text(decode_html(body))
+
+    @property
+    def settings(self) -> str:
+        digest = hashlib.blake2b(repr(self).encode(), digest_size=6).hexdigest()
+        return f"{self.name}-{digest}"
+
+
+@dataclass(frozen=True)
+class TrafilaturaExtractor(Extractor):
+    """
+    trafilatura.extract, with the settings the pipeline has always used. Called
+    on a response block, it gets the raw bytes, HTTP headers and all, as it
+    always has, and decodes them itself rather than through decode_html.
+    """
+
+    name: ClassVar[str] = "trafilatura"
+    include_comments: bool = False
+    include_tables: bool = False
+    favor_precision: bool = True
+    no_fallback: bool = True
+
+    def _extract(self, html: str | bytes) -> str | None:
+        return tf.extract(
+            html,
+            include_comments=self.include_comments,
+            include_tables=self.include_tables,
+            favor_precision=self.favor_precision,
+            no_fallback=self.no_fallback,
+        )
+
+    def extract_text(self, html: str) -> str | None:
+        if not html:
+            return None
+        return self._extract(html)
+
+    def __call__(self, body: bytes) -> str | None:
+        return self._extract(body)
+
+
+@dataclass(frozen=True)
+class ResiliparseExtractor(Extractor):
+    """
+    resiliparse's extract_plain_text with its main content heuristics, an
+    order of magnitude faster than trafilatura but less picky about
+    boilerplate
+    """
+
+    name: ClassVar[str] = "resiliparse"
+    main_content: bool = True
+    list_bullets: bool = True
+    alt_texts: bool = False
+    comments: bool = False
+
+    def extract_text(self, html: str) -> str | None:
+        if not html:
+            return None
+        text = extract_plain_text(
+            HTMLTree.parse(html),
+            preserve_formatting=True,
+            main_content=self.main_content,
+            list_bullets=self.list_bullets,
+            alt_texts=self.alt_texts,
+            links=False,
+            comments=self.comments,
+        )
+        return text or None
+
+
+@dataclass(frozen=True)
+class CascadeExtractor(Extractor):
+    """
+    primary first, fallback only when primary's output looks poor: nothing,
+    fewer than min_words words, or more than max_short_line_ratio of its lines
+    shorter than short_line_words words (menus and link lists left in)
+    """
+
+    name: ClassVar[str] = "cascade"
+    primary: Extractor = field(default_factory=ResiliparseExtractor)
+    fallback: Extractor = field(default_factory=TrafilaturaExtractor)
+    min_words: int = 50
+    short_line_words: int = 4
+    max_short_line_ratio: float = 0.5
+
+    def looks_poor(self, text: str | None) -> bool:
+        if not text:
+            return True
+        lines = [line.split() for line in text.splitlines() if line.strip()]
+        if sum(map(len, lines)) < self.min_words:
+            return True
+        short = sum(1 for words in lines if len(words) < self.short_line_words)
+        return short / len(lines) > self.max_short_line_ratio
+
+    def extract_text(self, html: str) -> str | None:
+        text = self.primary.extract_text(html)
+        if not self.looks_poor(text):
+            return text
+        return self.fallback.extract_text(html) or text
+
+
+EXTRACTORS: dict[str, type[Extractor]] = {
+    "trafilatura": TrafilaturaExtractor,
+    "resiliparse": ResiliparseExtractor,
+    "cascade": CascadeExtractor,
+}
+
+
+def get_extractor(extractor: "Extractor | str") -> Extractor:
+    """An extractor by name (with default settings), or the extractor itself"""
+    if isinstance(extractor, Extractor):
+        return extractor
+    if extractor not in EXTRACTORS:
+        raise ValueError(
+            f"Unknown extractor {extractor}, expected one of {list(EXTRACTORS)}"
+        )
+    return EXTRACTORS[extractor]()
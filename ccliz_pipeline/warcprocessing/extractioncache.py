@@ -0,0 +1,314 @@
+import hashlib
+import json
+import os
+import uuid
+import zlib
+from collections import OrderedDict
+from glob import glob
+from os import path
+from typing import Callable
+
+import numpy as np
+
+from .metrics import Metrics
+
+_MISSING = object()
+# stored in place of a None extraction result
+_NONE_MARKER = b"\x00"
+
+# 128 bit hash of a key, compared as (hi, lo)
+KEY_DTYPE = np.dtype([("hi", "<u8"), ("lo", "<u8")])
+# a record of a segment's .keys sidecar
+ENTRY_DTYPE = np.dtype(
+    [("hi", "<u8"), ("lo", "<u8"), ("offset", "<u8"), ("length", "<u4")]
+)
+
+
+def _key_hash(key: str) -> np.ndarray:
+    digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+    return np.frombuffer(digest, dtype=KEY_DTYPE)[0]
+
+
+def _read_sidecar(segment: str) -> np.ndarray | None:
+    # ENTRY_DTYPE records of a segment, from its .keys sidecar or the JSON
+    # lines .idx of stores written before there were .keys
+    stem = segment[: -len(".seg")]
+    if path.exists(stem + ".keys"):
+        with open(stem + ".keys", "rb") as f:
+            data = f.read()
+        # a torn record at the end of a crashed worker's sidecar is dropped
+        usable = len(data) - len(data) % ENTRY_DTYPE.itemsize
+        return np.frombuffer(data[:usable], dtype=ENTRY_DTYPE)
+    if not path.exists(stem + ".idx"):
+        return None
+    rows = []
+    with open(stem + ".idx") as f:
+        for line in f:
+            try:
+                key, offset, length = json.loads(line)
+            except ValueError:
+                break
+            key_hash = _key_hash(key)
+            rows.append((key_hash["hi"], key_hash["lo"], offset, length))
+    return np.array(rows, dtype=ENTRY_DTYPE)
+
+
+class ShardIndex:
+    """
+    Where the results of one shard of a store are: the entries of its
+    segments' sidecars, sorted by key hash and binary searched, and a dict of
+    the results put since it was read
+    """
+
+    def __init__(self, shard_dir: str):
+        segments, entries = [], []
+        for segment in glob(path.join(shard_dir, "*.seg")):
+            sidecar = _read_sidecar(segment)
+            if sidecar is not None:
+                segments.append(segment)
+                entries.append(sidecar)
+        self.segments = segments
+        counts = [len(e) for e in entries]
+        entries = np.concatenate(entries) if entries else np.empty(0, ENTRY_DTYPE)
+        order = np.argsort(entries, order=["hi", "lo"])
+        keys = np.empty(len(entries), dtype=KEY_DTYPE)
+        keys["hi"], keys["lo"] = entries["hi"][order], entries["lo"][order]
+        self.keys = keys
+        self.segment_numbers = np.repeat(
+            np.arange(len(segments), dtype=np.int32), counts
+        )[order]
+        self.offsets = entries["offset"][order]
+        self.lengths = entries["length"][order]
+        self.recent: dict[bytes, tuple[str, int, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.keys) + len(self.recent)
+
+    def get(self, key_hash: np.ndarray) -> tuple[str, int, int] | None:
+        """(segment path, offset, length) of the result, if the shard has it"""
+        found = self.recent.get(key_hash.tobytes())
+        if found is not None:
+            return found
+        i = int(np.searchsorted(self.keys, key_hash))
+        if i < len(self.keys) and self.keys[i] == key_hash:
+            return (
+                self.segments[self.segment_numbers[i]],
+                int(self.offsets[i]),
+                int(self.lengths[i]),
+            )
+        return None
+
+    def add(self, key_hash: np.ndarray, segment: str, offset: int, length: int):
+        self.recent[key_hash.tobytes()] = (segment, offset, length)
+
+
+# shard indexes of each cache_dir in this process, read when the shard is
+# first looked up and shared by every copy of a cache unpickled here, e.g.
+# one per task of a pool
+_process_indexes: dict[tuple[str, int], ShardIndex] = {}
+
+
+class ExtractionCache:
+    """
+    Cache of extraction results keyed by payload digest and extractor settings.
+    settings is the default for results that aren't given their own.
+
+    Lookups go through an in-memory LRU of up to memory_items results, then
+    an optional on-disk store under cache_dir. The store is split into
+    num_shards directories. Each process appends zlib-compressed results to
+    its own segment files and indexes them in a .keys sidecar of fixed size
+    binary records (128 bit key hash, offset, length), so several workers can
+    share one cache_dir. Segments roll over at segment_bytes. Once the store
+    passes max_disk_bytes, the oldest segments are deleted.
+
+    A shard's sidecars are read once per process, when a key of that shard is
+    first looked up, into a sorted array (see ShardIndex) shared by every
+    cache of the same cache_dir in the process; results that other processes
+    write after that aren't seen until a new process reads it.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str | None = None,
+        settings: str = "trafilatura",
+        memory_items: int = 10000,
+        max_disk_bytes: int | None = None,
+        num_shards: int = 16,
+        segment_bytes: int = 64 << 20,
+        compression_level: int = 3,
+    ):
+        self.cache_dir = cache_dir
+        self.settings = settings
+        self.memory_items = memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self.num_shards = num_shards
+        self.segment_bytes = segment_bytes
+        self.compression_level = compression_level
+        self.hits = 0
+        self.misses = 0
+        self._memory: OrderedDict[str, str | None] = OrderedDict()
+        self._open_segments: dict[int, tuple[str, int]] = {}
+
+    def __getstate__(self):
+        # reopened on the other side, the LRU isn't shipped around
+        state = self.__dict__.copy()
+        for name in ("_memory", "_open_segments"):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._memory = OrderedDict()
+        self._open_segments = {}
+
+    def _segment_paths(self) -> list[str]:
+        return sorted(
+            glob(path.join(self.cache_dir, "shard-*", "*.seg")), key=path.getmtime
+        )
+
+    def _shard_dir(self, shard: int) -> str:
+        return path.join(self.cache_dir, f"shard-{shard:03d}")
+
+    def _shard_index(self, shard: int) -> ShardIndex:
+        key = (path.abspath(self.cache_dir), shard)
+        index = _process_indexes.get(key)
+        if index is None:
+            index = _process_indexes[key] = ShardIndex(self._shard_dir(shard))
+        return index
+
+    def _forget_shard(self, shard: int):
+        # read again on the next lookup, e.g. once segments were evicted
+        _process_indexes.pop((path.abspath(self.cache_dir), shard), None)
+
+    def disk_bytes(self) -> int:
+        if self.cache_dir is None:
+            return 0
+        return sum(path.getsize(p) for p in self._segment_paths())
+
+    def _key(self, payload_digest: str, settings: str | None = None) -> str:
+        return f"{settings or self.settings}:{payload_digest}"
+
+    def _shard(self, key: str) -> int:
+        return zlib.crc32(key.encode()) % self.num_shards
+
+    def _remember(self, key: str, text: str | None):
+        self._memory[key] = text
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _read_disk(self, key: str):
+        if self.cache_dir is None:
+            return _MISSING
+        shard = self._shard(key)
+        found = self._shard_index(shard).get(_key_hash(key))
+        if found is None:
+            return _MISSING
+        segment, offset, length = found
+        try:
+            with open(segment, "rb") as f:
+                f.seek(offset)
+                data = zlib.decompress(f.read(length))
+        except (OSError, zlib.error):
+            # evicted (possibly by another worker) since the index was read
+            self._forget_shard(shard)
+            return _MISSING
+        return None if data == _NONE_MARKER else data.decode()
+
+    def get(self, payload_digest: str, settings: str | None = None):
+        """Cached result, or _MISSING; None is a valid cached result"""
+        key = self._key(payload_digest, settings)
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        text = self._read_disk(key)
+        if text is not _MISSING:
+            self._remember(key, text)
+        return text
+
+    def _segment_for(self, shard: int) -> str:
+        segment, size = self._open_segments.get(shard, (None, 0))
+        if segment is None or size >= self.segment_bytes:
+            shard_dir = self._shard_dir(shard)
+            os.makedirs(shard_dir, exist_ok=True)
+            segment = path.join(shard_dir, f"{uuid.uuid4().hex}.seg")
+            self._open_segments[shard] = (segment, 0)
+            self._evict()
+        return segment
+
+    def _evict(self):
+        if self.max_disk_bytes is None:
+            return
+        segments = self._segment_paths()
+        total = sum(path.getsize(p) for p in segments)
+        open_segments = {s for s, _ in self._open_segments.values()}
+        for segment in segments:
+            if total <= self.max_disk_bytes:
+                break
+            if segment in open_segments:
+                continue
+            total -= path.getsize(segment)
+            os.remove(segment)
+            stem = segment[: -len(".seg")]
+            for sidecar in (stem + ".keys", stem + ".idx"):
+                if path.exists(sidecar):
+                    os.remove(sidecar)
+            self._forget_shard(int(path.basename(path.dirname(segment))[6:]))
+
+    def put(
+        self, payload_digest: str, text: str | None, settings: str | None = None
+    ):
+        key = self._key(payload_digest, settings)
+        self._remember(key, text)
+        if self.cache_dir is None:
+            return
+        shard = self._shard(key)
+        key_hash = _key_hash(key)
+        if self._shard_index(shard).get(key_hash) is not None:
+            return
+        segment = self._segment_for(shard)
+        data = zlib.compress(
+            _NONE_MARKER if text is None else text.encode(), self.compression_level
+        )
+        with open(segment, "ab") as f:
+            offset = f.tell()
+            f.write(data)
+        entry = np.array(
+            [(key_hash["hi"], key_hash["lo"], offset, len(data))], dtype=ENTRY_DTYPE
+        )
+        with open(segment[: -len(".seg")] + ".keys", "ab") as f:
+            f.write(entry.tobytes())
+        self._shard_index(shard).add(key_hash, segment, offset, len(data))
+        self._open_segments[shard] = (segment, offset + len(data))
+
+    def extract(
+        self,
+        payload_digest: str,
+        raw_body: bytes,
+        extractor: Callable[[bytes], str | None],
+        settings: str | None = None,
+        metrics: Metrics | None = None,
+    ) -> str | None:
+        """
+        Cached result for the payload, or extractor(raw_body), cached. Results
+        are keyed by settings, by default the extractor's own (see
+        extraction.Extractor.settings), or self.settings if it has none.
+        Lookups are counted in extraction_cache_lookups{result} of metrics.
+        """
+        settings = settings or getattr(extractor, "settings", None)
+        text = self.get(payload_digest, settings)
+        hit = text is not _MISSING
+        if metrics is not None:
+            metrics.inc("extraction_cache_lookups", result="hit" if hit else "miss")
+        if hit:
+            self.hits += 1
+            return text
+        self.misses += 1
+        text = extractor(raw_body)
+        self.put(payload_digest, text, settings)
+        return text
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
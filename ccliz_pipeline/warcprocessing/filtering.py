@@ -0,0 +1,225 @@
+import logging as log
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Literal
+
+import msgspec
+import numpy as np
+from msgspec import Struct
+
+from .documentreader import DocumentReader, projection
+from .langid import language_path, read_languages
+from .metrics import Metrics
+from .output import (
+    DocumentWriter,
+    OutputFormat,
+    check_output,
+    open_output_writer,
+    output_path_for,
+    output_stem,
+)
+from .pipeline import CCRecord
+from .preprocessing import (
+    FEATURES,
+    RULES,
+    Rule,
+    compute_stats,
+    feature_array,
+    rule_masks,
+)
+from .types import CCRecordStage
+
+
+class FilterReport(Struct):
+    documents: int
+    passed: int
+    # documents failing each rule; a document can fail several
+    rejected: dict[str, int]
+    rules: dict[str, Rule]
+
+
+def check_rules(rules: dict[str, Rule]):
+    for name, rule in rules.items():
+        if rule.feature not in FEATURES:
+            raise ValueError(
+                f"Rule {name} is on unknown feature {rule.feature}, "
+                f"expected one of {list(FEATURES)}"
+            )
+
+
+def load_rules(file_path: str) -> dict[str, Rule]:
+    """Rules from a JSON object of name -> {"feature": ..., "min": ..., "max": ...}"""
+    with open(file_path, "rb") as f:
+        rules = msgspec.json.decode(f.read(), type=dict[str, Rule])
+    check_rules(rules)
+    return rules
+
+
+def filter_output(
+    input_path: str | list[str],
+    writer: DocumentWriter,
+    rules: dict[str, Rule] = RULES,
+    metrics: Metrics | None = None,
+) -> FilterReport:
+    """
+    Writes the documents of the output at input_path (or of each output, given
+    a list) that pass every rule to writer. Documents are scored a chunk at a
+    time: only their stats are decoded, into a feature array the rules are
+    applied to as masks, and the lines of the ones that pass are written on as
+    they are. Documents without stats have them computed from their text
+    first.
+    """
+    check_rules(rules)
+    metrics = metrics if metrics is not None else Metrics()
+    text_type = projection(("raw_text",))
+    documents = passed = 0
+    rejected = np.zeros(len(rules), dtype=np.int64)
+    input_paths = [input_path] if isinstance(input_path, str) else input_path
+    readers = [DocumentReader(p, fields=("stats",)) for p in input_paths]
+    batches = (b for reader in readers for b in reader.iter_line_batches())
+    for batch, lines in batches:
+        start = time.perf_counter()
+        stats = [
+            doc.stats
+            or compute_stats(msgspec.json.decode(line, type=text_type).raw_text)
+            for doc, line in zip(batch, lines)
+        ]
+        masks = rule_masks(feature_array(stats), rules)
+        keep = masks.all(axis=1)
+        rejected += len(batch) - masks.sum(axis=0)
+        metrics.observe("filter_batch_seconds", time.perf_counter() - start)
+        selected = [line for line, k in zip(lines, keep) if k]
+        writer.write_encoded(b"".join(selected), len(selected))
+        documents += len(batch)
+        passed += len(selected)
+    writer.flush()
+    report = FilterReport(
+        documents=documents,
+        passed=passed,
+        rejected=dict(zip(rules, rejected.tolist())),
+        rules=rules,
+    )
+    # the same counters as the inline rules of process_record
+    metrics.inc("documents_filtered", documents - passed)
+    for name, count in report.rejected.items():
+        metrics.inc("documents_rejected", count, rule=name)
+    return report
+
+
+def report_path(output_path: str) -> str:
+    return output_stem(output_path) + ".filter.json"
+
+
+def filter_record(
+    record: CCRecord,
+    rules: dict[str, Rule] = RULES,
+    input_format: OutputFormat = "jsonl",
+    output_format: OutputFormat | None = None,
+    overwrite: Literal["always", "never", "rename"] = "always",
+    target_shard_bytes: int | None = None,
+    compression_level: int | None = None,
+    metrics: Metrics | None = None,
+    languages: list[str] | None = None,
+) -> CCRecord:
+    """
+    Filters the PREPROCESSED output of a record (written in input_format) to
+    its FILTERED output, in output_format (input_format by default). For an
+    IDENTIFIED record, or given languages, the per-language outputs of those
+    languages (all of them by default) are read instead (see langid). A
+    FilterReport with the rules and how many documents each one rejected is
+    written next to the output (see report_path).
+
+    The PREPROCESSED output is left in place, so a FILTERED record can be
+    filtered again with other rules without re-extracting it; run
+    process_record without apply_rules to have it keep every document.
+    """
+    if record.stage not in (
+        CCRecordStage.PREPROCESSED,
+        CCRecordStage.IDENTIFIED,
+        CCRecordStage.FILTERED,
+    ):
+        raise ValueError(f"Record {record.record_id} is not preprocessed")
+    identified = record.stage == CCRecordStage.IDENTIFIED
+    record_metrics = Metrics()
+    started = time.perf_counter()
+    try:
+        record.update_stage(CCRecordStage.FILTERING)
+        output_format = output_format or input_format
+        if languages is not None or identified:
+            found = read_languages(record)
+            input_path = [
+                language_path(record, language, input_format)
+                for language in (found if languages is None else languages)
+                if found.get(language)
+            ]
+        else:
+            input_path = output_path_for(
+                record.get_path(CCRecordStage.PREPROCESSED), input_format
+            )
+        output_path = check_output(
+            output_path_for(record.get_path(CCRecordStage.FILTERED), output_format),
+            overwrite,
+        )
+        writer = open_output_writer(
+            output_path,
+            output_format,
+            compression_level,
+            target_shard_bytes=target_shard_bytes,
+        )
+        report = filter_output(input_path, writer, rules, record_metrics)
+        writer.close()
+        with open(report_path(output_path), "wb") as f:
+            f.write(msgspec.json.encode(report))
+    except Exception as e:
+        log.error(f"Error filtering record {record.record_id}: {e}")
+        record.update_stage(CCRecordStage.ERROR)
+        record_metrics.inc("records_filtered", result="error")
+        if metrics is not None:
+            metrics.merge(record_metrics)
+        return record
+    record_metrics.observe("filter_record_seconds", time.perf_counter() - started)
+    record_metrics.inc("records_filtered", result="filtered")
+    log.info(
+        f"Finished filtering record {record.record_id}: {report.passed} of "
+        f"{report.documents} documents passed, rejected by rule {report.rejected}"
+    )
+    if metrics is not None:
+        metrics.merge(record_metrics)
+    record.update_stage(CCRecordStage.FILTERED)
+    return record
+
+
+def _filter_record_worker(record: CCRecord, **kwargs) -> tuple[CCRecord, Metrics]:
+    metrics = Metrics()
+    try:
+        return filter_record(record, metrics=metrics, **kwargs), metrics
+    except Exception as e:
+        log.error(f"Error filtering record {record.record_id}: {e}")
+        record.update_stage(CCRecordStage.ERROR)
+        return record, metrics
+
+
+def filter_records(
+    records: list[CCRecord],
+    rules: dict[str, Rule] = RULES,
+    processes: int = 1,
+    metrics: Metrics | None = None,
+    **kwargs,
+) -> list[CCRecord]:
+    """
+    filter_record over many records on processes processes, e.g. to re-filter
+    a whole snapshot with new rules. Other keyword arguments go to
+    filter_record.
+    """
+    check_rules(rules)
+    run = partial(_filter_record_worker, rules=rules, **kwargs)
+    if processes > 1:
+        with ProcessPoolExecutor(processes) as executor:
+            results = list(executor.map(run, records))
+    else:
+        results = [run(record) for record in records]
+    for _, record_metrics in results:
+        if metrics is not None:
+            metrics.merge(record_metrics)
+    return [record for record, _ in results]
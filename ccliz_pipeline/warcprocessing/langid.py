@@ -0,0 +1,142 @@
+import logging as log
+import time
+import unicodedata
+from os import path
+from typing import Literal
+
+import msgspec
+from resiliparse.parse.lang import detect_fast
+
+from .documentreader import DocumentReader
+from .metrics import Metrics
+from .output import (
+    DocumentWriter,
+    OutputFormat,
+    check_output,
+    open_output_writer,
+    output_path_for,
+    output_stem,
+)
+from .pipeline import CCRecord
+from .types import CCRecordStage
+from .utils import check_and_makedirs
+
+UNKNOWN = "unknown"
+
+
+def identify_language(
+    text: str, cutoff: int = 1200, max_chars: int = 10000, min_chars: int = 20
+) -> tuple[str, float]:
+    """
+    (language, score) of text by resiliparse's detect_fast, on its first
+    max_chars characters. detect_fast gives an out-of-place rank, lower is
+    better; the score is 1 - rank / cutoff, and past cutoff, or for texts
+    shorter than min_chars, the language is "unknown" with a score of 0.
+    """
+    text = unicodedata.normalize("NFC", text[:max_chars])
+    if len(text.strip()) < min_chars:
+        return UNKNOWN, 0.0
+    language, rank = detect_fast(text, cutoff=cutoff)
+    if language == UNKNOWN or rank >= cutoff:
+        return UNKNOWN, 0.0
+    return language, 1 - rank / cutoff
+
+
+def language_path(
+    record: CCRecord, language: str, output_format: OutputFormat = "jsonl"
+) -> str:
+    """Output of the documents of record in language, at the IDENTIFIED stage"""
+    directory, extension = record.config["stage_converter"][CCRecordStage.IDENTIFIED]
+    return output_path_for(
+        path.join(
+            record.config["cc_path"], directory, language, record.record_id + extension
+        ),
+        output_format,
+    )
+
+
+def languages_path(record: CCRecord) -> str:
+    return output_stem(record.get_path(CCRecordStage.IDENTIFIED)) + ".languages.json"
+
+
+def read_languages(record: CCRecord) -> dict[str, int]:
+    """language -> documents of an IDENTIFIED record"""
+    with open(languages_path(record), "rb") as f:
+        return msgspec.json.decode(f.read(), type=dict[str, int])
+
+
+def identify_record(
+    record: CCRecord,
+    input_format: OutputFormat = "jsonl",
+    output_format: OutputFormat | None = None,
+    overwrite: Literal["always", "never", "rename"] = "always",
+    min_score: float = 0.0,
+    target_shard_bytes: int | None = None,
+    compression_level: int | None = None,
+    metrics: Metrics | None = None,
+    **kwargs,
+) -> CCRecord:
+    """
+    Sets language and language_score on every document of the PREPROCESSED
+    output of a record (written in input_format), and routes them into one
+    output per language (see language_path), in output_format (input_format
+    by default). Documents scoring below min_score go to "unknown". How many
+    documents each language got is written to languages_path(record).
+    Other keyword arguments go to identify_language.
+    """
+    if record.stage != CCRecordStage.PREPROCESSED:
+        raise ValueError(f"Record {record.record_id} is not preprocessed")
+    output_format = output_format or input_format
+    record_metrics = Metrics()
+    started = time.perf_counter()
+    writers: dict[str, DocumentWriter] = {}
+    try:
+        record.update_stage(CCRecordStage.IDENTIFYING)
+        input_path = output_path_for(
+            record.get_path(CCRecordStage.PREPROCESSED), input_format
+        )
+        for batch in DocumentReader(input_path).iter_batches():
+            start = time.perf_counter()
+            for document in batch:
+                language, score = identify_language(document.raw_text, **kwargs)
+                if score < min_score:
+                    language = UNKNOWN
+                document.language = language
+                document.language_score = score
+                writer = writers.get(language)
+                if writer is None:
+                    writer = writers[language] = open_output_writer(
+                        check_output(
+                            language_path(record, language, output_format),
+                            overwrite,
+                        ),
+                        output_format,
+                        compression_level,
+                        target_shard_bytes=target_shard_bytes,
+                    )
+                writer.write(document)
+            record_metrics.observe(
+                "language_batch_seconds", time.perf_counter() - start
+            )
+        counts = {
+            language: writer.close().documents
+            for language, writer in sorted(writers.items())
+        }
+        with open(check_and_makedirs(languages_path(record), "always"), "wb") as f:
+            f.write(msgspec.json.encode(counts))
+    except Exception as e:
+        log.error(f"Error identifying languages of {record.record_id}: {e}")
+        record.update_stage(CCRecordStage.ERROR)
+        record_metrics.inc("records_identified", result="error")
+        if metrics is not None:
+            metrics.merge(record_metrics)
+        return record
+    for language, documents in counts.items():
+        record_metrics.inc("documents_language", documents, language=language)
+    record_metrics.observe("identify_record_seconds", time.perf_counter() - started)
+    record_metrics.inc("records_identified", result="identified")
+    log.info(f"Finished identifying languages of {record.record_id}: {counts}")
+    if metrics is not None:
+        metrics.merge(record_metrics)
+    record.update_stage(CCRecordStage.IDENTIFIED)
+    return record
@@ -0,0 +1,584 @@
+"""
+Coordinates several hosts working on the same CC tree over a shared
+filesystem, without a server.
+
+    python -m ccliz_pipeline.warcprocessing.leases run --cc-path CC \\
+        --paths warc.paths.gz --node-index 0 --num-nodes 4
+    python -m ccliz_pipeline.warcprocessing.leases status --cc-path CC \\
+        [--paths warc.paths.gz]
+"""
+import argparse
+import hashlib
+import json
+import logging as log
+import os
+import socket
+import threading
+import time
+from collections import Counter
+from os import path
+from typing import Callable, Iterable, Iterator
+
+import msgspec
+from msgspec import Struct
+
+from .download import HTTPArchiveIO
+from .output import (
+    OutputFormat,
+    move_output,
+    output_path_for,
+    output_stem,
+    remove_output,
+)
+from .pipeline import CCRecord
+from .recordprocessing import process_record
+from .recordtable import RecordTable
+from .types import CCRecordStage, LocalConfig
+from .utils import stage_converter
+
+LEASE_SUFFIX = ".lease"
+DONE_SUFFIX = ".done"
+
+
+def shard_of(record_id: str, num_nodes: int) -> int:
+    """The node a record belongs to, the same on every host"""
+    digest = hashlib.blake2b(record_id.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little") % num_nodes
+
+
+class Lease(Struct):
+    record_id: str
+    stage: str
+    node: str
+    acquired: float
+
+
+class NodeStatus(Struct):
+    node: str
+    node_index: int
+    num_nodes: int
+    started: float
+    heartbeat: float
+    finished: bool = False
+    done: int = 0
+    failed: int = 0
+    reclaimed: int = 0  # expired leases of other nodes taken over
+    lost: int = 0  # leases taken over by other nodes while this one worked
+    running: list[str] = []
+
+
+def _write_atomic(file_path: str, data: bytes):
+    tmp_path = f"{file_path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, file_path)
+
+
+class LeaseQueue:
+    """
+    Hands out records to work on to one of num_nodes nodes sharing the CC tree
+    of config, each started with its own node_index.
+
+    Records are sharded across nodes by a hash of their id (see shard_of);
+    a node works through its own shard first. Taking a record on means
+    creating <record_id>.<stage>.lease in the directory of the stage it's
+    taken to, with O_EXCL, so exactly one node gets it. While the node works,
+    a heartbeat thread touches its leases every heartbeat_seconds. A lease
+    untouched for lease_seconds is expired and can be taken over, so the
+    records of a node that died are picked up again. Once a record is done,
+    <record_id>.<stage>.done is written and the lease removed. A node that
+    stalled for longer than lease_seconds may find its lease taken over; the
+    record is then left to the new owner and not marked done (see is_lost).
+
+    Every node also keeps a NodeStatus in <cc_path>/leases/nodes/, updated
+    with each heartbeat. With steal, a node that is through its own shard
+    takes on the shards of nodes that have no live status (dead, or not
+    started yet).
+    """
+
+    def __init__(
+        self,
+        config: LocalConfig,
+        node_index: int = 0,
+        num_nodes: int = 1,
+        node_id: str | None = None,
+        lease_seconds: float = 600.0,
+        heartbeat_seconds: float | None = None,
+        steal: bool = True,
+    ):
+        if not 0 <= node_index < num_nodes:
+            raise ValueError(f"node_index has to be below num_nodes ({num_nodes})")
+        self.config = config
+        self.node_index = node_index
+        self.num_nodes = num_nodes
+        self.node_id = node_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds or lease_seconds / 4
+        self.steal = steal
+        self.held: dict[str, CCRecordStage] = {}  # record id -> stage
+        self._lost: set[str] = set()  # record ids
+        self.status = NodeStatus(
+            node=self.node_id,
+            node_index=node_index,
+            num_nodes=num_nodes,
+            started=time.time(),
+            heartbeat=time.time(),
+        )
+        self._lock = threading.Lock()
+        # so the heartbeat doesn't check a lease while it's being released
+        self._leases_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def _marker_path(self, record_id: str, stage: CCRecordStage, suffix: str) -> str:
+        directory, _ = self.config["stage_converter"][stage]
+        return (
+            path.join(self.config["cc_path"], directory, record_id)
+            + f".{stage.name.lower()}{suffix}"
+        )
+
+    def lease_path(self, record_id: str, stage: CCRecordStage) -> str:
+        return self._marker_path(record_id, stage, LEASE_SUFFIX)
+
+    def done_path(self, record_id: str, stage: CCRecordStage) -> str:
+        return self._marker_path(record_id, stage, DONE_SUFFIX)
+
+    def status_path(self) -> str:
+        return status_path(self.config, self.node_id)
+
+    def is_done(self, record_id: str, stage: CCRecordStage) -> bool:
+        return path.exists(self.done_path(record_id, stage))
+
+    def _lease_owner(self, lease_path: str) -> tuple[str, float] | None:
+        # (node, mtime) of the lease at lease_path, None if there is none
+        try:
+            mtime = os.stat(lease_path).st_mtime
+            with open(lease_path, "rb") as f:
+                return msgspec.json.decode(f.read(), type=Lease).node, mtime
+        except FileNotFoundError:
+            return None
+        except msgspec.DecodeError:
+            # created and not written yet
+            return "", mtime
+
+    def _create_lease(self, record_id: str, stage: CCRecordStage) -> bool:
+        lease_path = self.lease_path(record_id, stage)
+        try:
+            fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "wb") as f:
+            lease = Lease(record_id, stage.name, self.node_id, time.time())
+            f.write(msgspec.json.encode(lease))
+        return True
+
+    def _take_over(self, lease_path: str, seen: tuple[str, float]) -> bool:
+        """
+        Moves the expired lease seen at lease_path aside; of the nodes trying
+        at once, one wins the rename. Another node may have taken the lease
+        over, or its owner touched it, since it was seen, so the lease moved
+        is checked again and put back if it isn't the one seen.
+        """
+        name = self.node_id.replace(os.sep, "_")
+        expired_path = f"{lease_path}.expired.{name}"
+        try:
+            os.rename(lease_path, expired_path)
+        except FileNotFoundError:
+            return False
+        if self._lease_owner(expired_path) == seen:
+            os.remove(expired_path)
+            return True
+        try:
+            # link rather than rename, so a lease made since isn't replaced
+            os.link(expired_path, lease_path)
+        except FileExistsError:
+            log.warning(f"Lease {lease_path} was replaced while put aside")
+        os.remove(expired_path)
+        return False
+
+    def acquire(self, record_id: str, stage: CCRecordStage) -> bool:
+        """Takes the record on for stage; False if it's done or someone has it"""
+        if self.is_done(record_id, stage):
+            return False
+        lease_path = self.lease_path(record_id, stage)
+        os.makedirs(path.dirname(lease_path), exist_ok=True)
+        if not self._create_lease(record_id, stage):
+            seen = self._lease_owner(lease_path)
+            if seen is None or time.time() - seen[1] <= self.lease_seconds:
+                return False
+            if not self._take_over(lease_path, seen):
+                return False
+            log.warning(f"Lease of {record_id} held by {seen[0]} expired, taking over")
+            with self._lock:
+                self.status.reclaimed += 1
+            return self.acquire(record_id, stage)
+        # finished by another node between the check and the lease
+        if self.is_done(record_id, stage):
+            os.remove(lease_path)
+            return False
+        with self._leases_lock, self._lock:
+            self.held[record_id] = stage
+            self.status.running.append(record_id)
+        return True
+
+    def is_lost(self, record_id: str) -> bool:
+        """
+        Whether the lease on record_id was taken over by another node since it
+        was acquired; long running work can check it and give up early
+        """
+        with self._lock:
+            return record_id in self._lost
+
+    def _check_lease(self, record_id: str, stage: CCRecordStage) -> bool:
+        # whether the lease is still this node's, touching it if so
+        lease_path = self.lease_path(record_id, stage)
+        owner = self._lease_owner(lease_path)
+        if owner is None:
+            # put aside by a node checking it for takeover; if it puts it
+            # back first, it's still ours
+            self._create_lease(record_id, stage)
+            owner = self._lease_owner(lease_path)
+        if owner is not None and owner[0] == self.node_id:
+            try:
+                os.utime(lease_path)
+            except FileNotFoundError:
+                pass
+            return True
+        with self._lock:
+            if record_id not in self._lost:
+                log.error(f"Lost lease of {record_id} on {self.node_id}")
+                self._lost.add(record_id)
+        return False
+
+    def if_held(
+        self, record_id: str, stage: CCRecordStage, action: Callable[[], object]
+    ) -> bool:
+        """
+        Runs action (e.g. moving an output into place) if the lease on
+        record_id is still this node's, with the lease checked and touched
+        right before and no heartbeat in between; returns whether it ran
+        """
+        with self._leases_lock:
+            if not self._check_lease(record_id, stage):
+                return False
+            action()
+            return True
+
+    def release(self, record_id: str, stage: CCRecordStage, done: bool) -> str:
+        """
+        Gives the record up, marking it done for stage first if it is and the
+        lease is still this node's; returns "done", "failed" or "lost"
+        """
+        lease_path = self.lease_path(record_id, stage)
+        with self._leases_lock:
+            kept = self._check_lease(record_id, stage)
+            if done and kept:
+                marker = {"node": self.node_id, "time": time.time()}
+                _write_atomic(
+                    self.done_path(record_id, stage), json.dumps(marker).encode()
+                )
+            outcome = "lost" if not kept else "done" if done else "failed"
+            with self._lock:
+                del self.held[record_id]
+                self._lost.discard(record_id)
+                self.status.running.remove(record_id)
+                setattr(self.status, outcome, getattr(self.status, outcome) + 1)
+            if kept:
+                try:
+                    os.remove(lease_path)
+                except FileNotFoundError:
+                    pass
+        return outcome
+
+    def heartbeat(self):
+        """Touches the held leases and writes the node's status"""
+        with self._leases_lock:
+            for record_id, stage in self.held.items():
+                self._check_lease(record_id, stage)
+        with self._lock:
+            self.status.heartbeat = time.time()
+            data = msgspec.json.encode(self.status)
+        os.makedirs(path.dirname(self.status_path()), exist_ok=True)
+        _write_atomic(self.status_path(), data)
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.heartbeat_seconds):
+            try:
+                self.heartbeat()
+            except OSError as e:
+                log.error(f"Heartbeat of {self.node_id} failed: {e}")
+
+    def start(self):
+        self.heartbeat()
+        self._thread = threading.Thread(target=self._heartbeat_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.heartbeat()
+
+    def dead_shards(self) -> set[int]:
+        """Shards without a node that's been heard from within lease_seconds"""
+        now = time.time()
+        alive = {
+            status.node_index
+            for status in read_node_statuses(self.config)
+            if status.num_nodes == self.num_nodes
+            and not status.finished
+            and now - status.heartbeat <= self.lease_seconds
+        }
+        return set(range(self.num_nodes)) - alive - {self.node_index}
+
+    def claims(
+        self, records: Iterable[CCRecord], stage: CCRecordStage
+    ) -> Iterator[CCRecord]:
+        """
+        Acquires and yields the records this node should work on next, its own
+        shard first; release each one before taking the next. Stops once
+        nothing is left that it could take.
+        """
+        records = list(records)
+        skipped: set[str] = set()
+        own = [
+            r
+            for r in records
+            if shard_of(r.record_id, self.num_nodes) == self.node_index
+        ]
+        while True:
+            others = []
+            if self.steal:
+                dead = self.dead_shards()
+                others = [
+                    r
+                    for r in records
+                    if shard_of(r.record_id, self.num_nodes) in dead
+                ]
+            claimed = False
+            for record in own + others:
+                if record.record_id in skipped:
+                    continue
+                if self.acquire(record.record_id, stage):
+                    claimed = True
+                    # a record failing here isn't tried again in this run
+                    skipped.add(record.record_id)
+                    yield record
+            if not claimed:
+                return
+
+    def run(
+        self,
+        records: Iterable[CCRecord],
+        run: Callable[[CCRecord], object],
+        stage: CCRecordStage,
+    ) -> Counter[str]:
+        """
+        Runs run on every record this node gets (see claims), counting a record
+        done if it ends up at stage; returns counts of done, failed and lost
+        records
+        """
+        counts: Counter[str] = Counter()
+        self.start()
+        try:
+            for record in self.claims(records, stage):
+                try:
+                    run(record)
+                except Exception as e:
+                    log.error(f"Error in {record.record_id} on {self.node_id}: {e}")
+                done = record.stage == stage
+                counts[self.release(record.record_id, stage, done)] += 1
+            self.status.finished = True
+        finally:
+            self.stop()
+        return counts
+
+
+def status_path(config: LocalConfig, node_id: str) -> str:
+    name = node_id.replace(os.sep, "_").replace(":", "_")
+    return path.join(config["cc_path"], "leases", "nodes", name + ".json")
+
+
+def read_node_statuses(config: LocalConfig) -> list[NodeStatus]:
+    directory = path.dirname(status_path(config, "_"))
+    statuses = []
+    if not path.isdir(directory):
+        return statuses
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(path.join(directory, name), "rb") as f:
+                statuses.append(msgspec.json.decode(f.read(), type=NodeStatus))
+        except (OSError, msgspec.DecodeError):
+            # being replaced right now
+            continue
+    return statuses
+
+
+def cluster_status(
+    config: LocalConfig,
+    lease_seconds: float = 600.0,
+    records: Iterable[CCRecord] | None = None,
+) -> dict:
+    """
+    Progress across all nodes: done records and live and expired leases per
+    stage (from the markers in the stage directories), the nodes' own
+    statuses, and with records, how many of them are done per stage
+    """
+    now = time.time()
+    stages: dict[str, Counter[str]] = {}
+    leases = []
+    directories = {directory for directory, _ in config["stage_converter"].values()}
+    for directory in sorted(d for d in directories if d):
+        for root, _, files in os.walk(path.join(config["cc_path"], directory)):
+            for name in files:
+                for suffix in (DONE_SUFFIX, LEASE_SUFFIX):
+                    if not name.endswith(suffix):
+                        continue
+                    stage = name[: -len(suffix)].rsplit(".", 1)[-1]
+                    counts = stages.setdefault(stage, Counter())
+                    if suffix == DONE_SUFFIX:
+                        counts["done"] += 1
+                        continue
+                    lease_path = path.join(root, name)
+                    try:
+                        age = now - os.stat(lease_path).st_mtime
+                        with open(lease_path, "rb") as f:
+                            lease = msgspec.json.decode(f.read(), type=Lease)
+                    except (OSError, msgspec.DecodeError):
+                        continue
+                    expired = age > lease_seconds
+                    counts["expired" if expired else "leased"] += 1
+                    leases.append(
+                        {
+                            "record_id": lease.record_id,
+                            "stage": stage,
+                            "node": lease.node,
+                            "age": round(age, 1),
+                            "expired": expired,
+                        }
+                    )
+    nodes = [
+        msgspec.to_builtins(status)
+        | {"alive": now - status.heartbeat <= lease_seconds and not status.finished}
+        for status in read_node_statuses(config)
+    ]
+    status = {
+        "stages": {stage: dict(counts) for stage, counts in stages.items()},
+        "leases": leases,
+        "nodes": nodes,
+    }
+    if records is not None:
+        records = list(records)
+        queue = LeaseQueue(config)
+        status["records"] = len(records)
+        for stage in stages:
+            done = sum(
+                queue.is_done(r.record_id, CCRecordStage[stage.upper()])
+                for r in records
+            )
+            status["stages"][stage]["remaining"] = len(records) - done
+    return status
+
+
+def _read_records(paths_file: str, config: LocalConfig) -> list[CCRecord]:
+    return list(RecordTable.from_paths(paths_file, config))
+
+
+def _download_and_process(
+    record: CCRecord,
+    archive_io: HTTPArchiveIO,
+    queue: LeaseQueue,
+    output_format: OutputFormat = "jsonl",
+    **kwargs,
+):
+    # from scratch to PREPROCESSED, streaming the source. The output is
+    # written to a path of this node's own and only moved into place while
+    # the lease is still held, so a node that stalled past its lease can't
+    # write over the output of the node that took the record over
+    if path.exists(record.get_path(CCRecordStage.SOURCE)):
+        record.update_stage(CCRecordStage.SOURCE)
+    else:
+        archive_io.download(record)
+    output_path = output_path_for(
+        record.get_path(CCRecordStage.PREPROCESSED), output_format
+    )
+    stem = output_stem(output_path)
+    node = queue.node_id.replace(os.sep, "_")
+    tmp_path = f"{stem}.{node}-tmp{output_path[len(stem):]}"
+    process_record(
+        record,
+        overwrite="always",
+        stream_source=True,
+        output_format=output_format,
+        output_path=tmp_path,
+        **kwargs,
+    )
+    if record.stage != CCRecordStage.PREPROCESSED:
+        return
+    moved = queue.if_held(
+        record.record_id,
+        CCRecordStage.PREPROCESSED,
+        lambda: move_output(tmp_path, output_path),
+    )
+    if not moved:
+        log.error(f"Lost lease of {record.record_id}, dropping its output")
+        remove_output(tmp_path)
+        record.update_stage(CCRecordStage.ERROR)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="work through this node's records")
+    run_parser.add_argument("--node-index", type=int, required=True)
+    run_parser.add_argument("--num-nodes", type=int, required=True)
+    run_parser.add_argument("--node-id")
+    run_parser.add_argument("--no-steal", action="store_true")
+    run_parser.add_argument("--output-format", default="jsonl")
+    run_parser.add_argument("--extractor", default="trafilatura")
+    status_parser = commands.add_parser("status", help="progress across nodes")
+    for sub in (run_parser, status_parser):
+        sub.add_argument("--cc-path", default="CC")
+        sub.add_argument("--paths", help="warc.paths(.gz) manifest")
+        sub.add_argument("--lease-seconds", type=float, default=600.0)
+    args = parser.parse_args()
+    log.basicConfig(level=log.INFO)
+    config = LocalConfig(
+        cc_path=args.cc_path, URL_Appendix="default", stage_converter=stage_converter
+    )
+    records = _read_records(args.paths, config) if args.paths else None
+
+    if args.command == "status":
+        status = cluster_status(config, args.lease_seconds, records)
+        print(json.dumps(status, indent=2))
+        return
+    if records is None:
+        parser.error("run needs --paths")
+    archive_io = HTTPArchiveIO()
+    queue = LeaseQueue(
+        config,
+        args.node_index,
+        args.num_nodes,
+        args.node_id,
+        args.lease_seconds,
+        steal=not args.no_steal,
+    )
+    counts = queue.run(
+        records,
+        lambda record: _download_and_process(
+            record,
+            archive_io,
+            queue,
+            output_format=args.output_format,
+            extractor=args.extractor,
+        ),
+        CCRecordStage.PREPROCESSED,
+    )
+    print(json.dumps({"node": queue.node_id, **counts}))
+
+
+if __name__ == "__main__":
+    main()
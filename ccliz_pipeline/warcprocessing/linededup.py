@@ -0,0 +1,333 @@
+import hashlib
+import logging as log
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable
+
+import msgspec
+import numpy as np
+import numpy.typing as npt
+from msgspec import Struct
+
+from ..utils.utils import normalize_text_
+from .documentreader import DocumentReader
+from .filtering import report_path
+from .output import (
+    OutputFormat,
+    move_output,
+    open_output_writer,
+    output_path_for,
+    output_stem,
+)
+from .pipeline import CCRecord
+from .preprocessing import compute_stats
+from .types import CCRecordStage
+
+# odd multipliers of the multiply-shift hash of each row of the sketch
+ROW_MULTIPLIERS = np.array(
+    [
+        0x9E3779B97F4A7C15,
+        0xC2B2AE3D27D4EB4F,
+        0x165667B19E3779F9,
+        0xD6E8FEB86659FD93,
+        0xFF51AFD7ED558CCD,
+        0xC4CEB9FE1A85EC53,
+        0x94D049BB133111EB,
+        0xBF58476D1CE4E5B9,
+    ],
+    dtype=np.uint64,
+)
+
+
+def line_hash(line: str) -> int | None:
+    """64 bit hash of the normalized line, None if nothing is left of it"""
+    normalized = normalize_text_(line)
+    if not normalized:
+        return None
+    digest = hashlib.blake2b(normalized.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def document_line_hashes(text: str) -> npt.NDArray[np.uint64]:
+    """The distinct line hashes of a document"""
+    hashes = {line_hash(line) for line in text.splitlines()}
+    hashes.discard(None)
+    return np.fromiter(hashes, dtype=np.uint64, count=len(hashes))
+
+
+class CountMinSketch:
+    """
+    Approximate counts of 64 bit hashes in a fixed depth x width table of
+    uint32 counters, whatever the number of distinct hashes. A count is never
+    under the true count, and over it by more than e / width of the total
+    with probability at most exp(-depth). Sketches with the same shape add up
+    with merge(), so they can be built on separate processes.
+    """
+
+    def __init__(self, width: int = 1 << 22, depth: int = 4):
+        if width & (width - 1) or not 1 < width < 1 << 32:
+            raise ValueError("width has to be a power of two, up to 2^31")
+        if not 0 < depth <= len(ROW_MULTIPLIERS):
+            raise ValueError(f"depth has to be from 1 to {len(ROW_MULTIPLIERS)}")
+        self.width = width
+        self.depth = depth
+        self.shift = np.uint64(64 - width.bit_length() + 1)
+        self.table = np.zeros((depth, width), dtype=np.uint32)
+        self.total = 0
+
+    @classmethod
+    def for_memory(cls, memory_bytes: int, depth: int = 4) -> "CountMinSketch":
+        """The widest sketch whose table fits in memory_bytes, up to 2^31"""
+        # two uint32 counters per row at least
+        if memory_bytes < depth * 8:
+            raise ValueError(
+                f"memory_bytes has to be at least {depth * 8} for a sketch of "
+                f"depth {depth}, got {memory_bytes}"
+            )
+        width = 1 << min(int(math.log2(memory_bytes // (depth * 4))), 31)
+        return cls(width, depth)
+
+    @property
+    def error_bound(self) -> float:
+        """How far counts may be over, with probability 1 - exp(-depth)"""
+        return math.e / self.width * self.total
+
+    def _columns(self, hashes: npt.NDArray[np.uint64]) -> npt.NDArray[np.uint64]:
+        # (depth, len(hashes)) column of each hash in each row, wrapping
+        # uint64 multiplication is the point
+        with np.errstate(over="ignore"):
+            return (hashes[None, :] * ROW_MULTIPLIERS[: self.depth, None]) >> (
+                self.shift
+            )
+
+    def add(self, hashes: npt.NDArray[np.uint64]):
+        for row, columns in enumerate(self._columns(hashes)):
+            np.add.at(self.table[row], columns, 1)
+        self.total += len(hashes)
+
+    def count(self, hashes: npt.NDArray[np.uint64]) -> npt.NDArray[np.uint32]:
+        columns = self._columns(hashes)
+        return np.min(
+            [self.table[row, columns[row]] for row in range(self.depth)], axis=0
+        )
+
+    def merge(self, other: "CountMinSketch") -> "CountMinSketch":
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError("can't merge sketches of different shapes")
+        self.table += other.table
+        self.total += other.total
+        return self
+
+    def save(self, file_path: str):
+        np.savez(file_path, table=self.table, total=self.total)
+
+    @classmethod
+    def load(cls, file_path: str) -> "CountMinSketch":
+        with np.load(file_path) as data:
+            depth, width = data["table"].shape
+            sketch = cls(width, depth)
+            sketch.table[:] = data["table"]
+            sketch.total = int(data["total"])
+        return sketch
+
+
+class LineDedupReport(Struct):
+    documents: int = 0
+    documents_emptied: int = 0  # every line was stripped, the document dropped
+    lines: int = 0
+    lines_removed: int = 0
+    bytes: int = 0  # of raw_text, utf-8
+    bytes_removed: int = 0
+
+    def merge(self, other: "LineDedupReport") -> "LineDedupReport":
+        for field in self.__struct_fields__:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+        return self
+
+
+def count_lines(
+    input_paths: Iterable[str], width: int = 1 << 22, depth: int = 4
+) -> CountMinSketch:
+    """First pass: counts every line in how many documents it occurs"""
+    sketch = CountMinSketch(width, depth)
+    for input_path in input_paths:
+        for batch in DocumentReader(input_path, fields=("raw_text",)).iter_batches():
+            hashes = [document_line_hashes(doc.raw_text) for doc in batch]
+            if hashes:
+                sketch.add(np.concatenate(hashes))
+    return sketch
+
+
+def strip_output(
+    input_path: str,
+    output_path: str,
+    sketch: CountMinSketch,
+    threshold: int,
+    output_format: OutputFormat = "jsonl",
+    **writer_kwargs,
+) -> LineDedupReport:
+    """
+    Second pass: writes the documents of input_path to output_path without
+    the lines that occur in at least threshold documents, with their stats
+    computed again. Documents left without any text are dropped.
+    """
+    report = LineDedupReport()
+    writer = open_output_writer(output_path, output_format, **writer_kwargs)
+    for batch in DocumentReader(input_path).iter_batches():
+        for document in batch:
+            lines = document.raw_text.splitlines()
+            hashes = [line_hash(line) for line in lines]
+            known = np.array([h for h in hashes if h is not None], dtype=np.uint64)
+            counts = iter(sketch.count(known).tolist())
+            kept = [
+                line
+                for line, h in zip(lines, hashes)
+                if h is None or next(counts) < threshold
+            ]
+            size = len(document.raw_text.encode())
+            report.documents += 1
+            report.lines += len(lines)
+            report.bytes += size
+            if len(kept) == len(lines):
+                writer.write(document)
+                continue
+            text = "\n".join(kept).strip()
+            report.lines_removed += len(lines) - len(kept)
+            report.bytes_removed += size - len(text.encode())
+            if not text:
+                report.documents_emptied += 1
+                continue
+            document.raw_text = text
+            document.stats = compute_stats(text)
+            writer.write(document)
+    writer.close()
+    return report
+
+
+def _record_output(record: CCRecord, output_format: OutputFormat) -> str | None:
+    if record.stage not in (CCRecordStage.PREPROCESSED, CCRecordStage.FILTERED):
+        return None
+    return output_path_for(record.get_path(record.stage), output_format)
+
+
+# per process sketch of the second pass, see _init_strip_worker
+_worker_state: dict = {}
+
+
+def _init_strip_worker(sketch: CountMinSketch):
+    # the sketch is sent once per worker instead of with every record
+    _worker_state["sketch"] = sketch
+
+
+def _strip_record_output(
+    input_path: str, threshold: int, output_format: OutputFormat, **writer_kwargs
+) -> LineDedupReport:
+    # written next to the output, then moved over it
+    stem = output_stem(input_path)
+    tmp_path = stem + ".lines-tmp" + input_path[len(stem) :]
+    report = strip_output(
+        input_path,
+        tmp_path,
+        _worker_state["sketch"],
+        threshold,
+        output_format,
+        **writer_kwargs,
+    )
+    move_output(tmp_path, input_path)
+    # the filter report counted the documents as they were
+    if os.path.exists(report_path(input_path)):
+        os.remove(report_path(input_path))
+    return report
+
+
+def _parts(items: list, parts: int) -> list[list]:
+    return [items[k::parts] for k in range(parts) if items[k::parts]]
+
+
+def deduplicate_lines(
+    records: list[CCRecord],
+    threshold: int = 10,
+    memory_bytes: int = 256 << 20,
+    depth: int = 4,
+    processes: int = 1,
+    output_format: OutputFormat = "jsonl",
+    sketch_path: str | None = None,
+    **writer_kwargs,
+) -> LineDedupReport:
+    """
+    CCNet-style removal of lines that repeat across a snapshot (cookie
+    banners, navigation, footers), over PREPROCESSED or FILTERED records.
+
+    The first pass counts in how many documents each normalize_text_-ed line
+    occurs, into a count-min sketch of memory_bytes per process; the
+    processes' sketches are added up. The second pass rewrites each record's
+    output (in output_format) in place, without the lines that occur in at
+    least threshold documents, with writer_kwargs (e.g. target_shard_bytes)
+    going to its writer. The sketches take (processes + 1) * memory_bytes
+    however large the snapshot. With sketch_path, the merged sketch is saved
+    there, e.g. to strip records of a later batch against the same counts.
+
+    Counts are taken from the outputs as they are, so run it once, before
+    filtering (process_record without apply_rules); stats are computed again
+    for every document that loses lines. A rewritten FILTERED output loses
+    its filter report (see filtering.report_path), and an LSH index segment
+    of it no longer matches its fingerprint, so deduplication indexes it
+    again (see deduplication.index_record). Returns the totals of what was
+    removed, also logged per record; records that fail, or that aren't
+    PREPROCESSED or FILTERED, are put at ERROR.
+    """
+    ready, input_paths = [], []
+    for record in records:
+        input_path = _record_output(record, output_format)
+        if input_path is None:
+            log.error(f"Record {record.record_id} is not preprocessed")
+            record.update_stage(CCRecordStage.ERROR)
+            continue
+        ready.append(record)
+        input_paths.append(input_path)
+    sketch = CountMinSketch.for_memory(memory_bytes, depth)
+    with ProcessPoolExecutor(processes) as executor:
+        for part in executor.map(
+            count_lines,
+            _parts(input_paths, processes),
+            [sketch.width] * processes,
+            [depth] * processes,
+        ):
+            sketch.merge(part)
+    log.info(
+        f"Counted {sketch.total} document lines, counts over by at most "
+        f"{sketch.error_bound:.1f} with probability {1 - math.exp(-depth):.3f}"
+    )
+    if sketch_path is not None:
+        sketch.save(sketch_path)
+
+    total = LineDedupReport()
+    with ProcessPoolExecutor(
+        processes, initializer=_init_strip_worker, initargs=(sketch,)
+    ) as executor:
+        futures = [
+            executor.submit(
+                _strip_record_output,
+                input_path,
+                threshold,
+                output_format,
+                **writer_kwargs,
+            )
+            for input_path in input_paths
+        ]
+        for record, future in zip(ready, futures):
+            try:
+                report = future.result()
+            except Exception as e:
+                log.error(f"Error deduplicating lines of {record.record_id}: {e}")
+                record.update_stage(CCRecordStage.ERROR)
+                continue
+            log.info(
+                f"Stripped {report.lines_removed} of {report.lines} lines, "
+                f"{report.bytes_removed} of {report.bytes} bytes, from "
+                f"{record.record_id}"
+            )
+            total.merge(report)
+    log.info(f"Line deduplication: {msgspec.to_builtins(total)}")
+    return total
@@ -0,0 +1,221 @@
+import os
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from typing import Iterator
+
+import msgspec
+
+# seconds, 10us to 100s in quarter decades
+DEFAULT_BUCKETS = tuple(10 ** (e / 4) for e in range(-20, 9))
+
+# metric names are prefixed with this in the Prometheus export
+PROMETHEUS_PREFIX = "ccliz_"
+
+Labels = tuple[tuple[str, str], ...]
+
+
+class Histogram:
+    """Counts of observations per bucket, with their sum"""
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.bounds = bounds
+        # one more for everything above the last bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other: "Histogram"):
+        if other.bounds != self.bounds:
+            raise ValueError("can't merge histograms with different buckets")
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket the q-quantile falls in"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    """
+    Counters and latency histograms of a run, cheap enough to update per
+    document.
+
+    Counters and histograms are identified by a name and optional labels, e.g.
+    inc("documents_rejected", rule="num_words"). Every worker keeps its own
+    Metrics and hands it back with its results, where it's merge()d into the
+    caller's, so nothing is shared between processes. Updates from different
+    threads are fine as long as they don't touch the same metric.
+
+    write_json() and write_prometheus() export a snapshot; counters get a
+    _total suffix and every name a ccliz_ prefix in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.counters: Counter[tuple[str, Labels]] = Counter()
+        self.histograms: dict[tuple[str, Labels], Histogram] = {}
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.merge_dict(state)
+
+    def inc(self, name: str, value: int = 1, **labels: str):
+        self.counters[name, tuple(sorted(labels.items()))] += value
+
+    def histogram(self, name: str, **labels: str) -> Histogram:
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        return histogram
+
+    def observe(self, name: str, value: float, **labels: str):
+        self.histogram(name, **labels).observe(value)
+
+    @contextmanager
+    def time(self, name: str, **labels: str) -> Iterator[None]:
+        """Observes how long the block took, in seconds, into histogram name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def get(self, name: str, **labels: str) -> int:
+        return self.counters[name, tuple(sorted(labels.items()))]
+
+    def merge(self, other: "Metrics") -> "Metrics":
+        self.counters.update(other.counters)
+        for key, histogram in other.histograms.items():
+            if key in self.histograms:
+                self.histograms[key].merge(histogram)
+            else:
+                self.histograms[key] = Histogram(histogram.bounds)
+                self.histograms[key].merge(histogram)
+        return self
+
+    def to_dict(self) -> dict:
+        return {
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.counters.items())
+            ],
+            "histograms": [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "bounds": list(h.bounds),
+                    "counts": h.counts,
+                    "sum": h.sum,
+                    "count": h.count,
+                }
+                for (name, labels), h in sorted(self.histograms.items())
+            ],
+        }
+
+    def merge_dict(self, data: dict) -> "Metrics":
+        """Merges in a to_dict() export, e.g. one read back from another host"""
+        for counter in data["counters"]:
+            self.counters[
+                counter["name"], tuple(sorted(counter["labels"].items()))
+            ] += counter["value"]
+        other = Metrics()
+        for h in data["histograms"]:
+            histogram = Histogram(tuple(h["bounds"]))
+            histogram.counts = list(h["counts"])
+            histogram.sum = h["sum"]
+            histogram.count = h["count"]
+            other.histograms[h["name"], tuple(sorted(h["labels"].items()))] = histogram
+        return self.merge(other)
+
+    def summary(self) -> dict[str, float]:
+        """Flat name{labels} -> value, with the mean and p99 of histograms, for logs"""
+        summary: dict[str, float] = {}
+        for (name, labels), value in sorted(self.counters.items()):
+            summary[name + _format_labels(labels, quote="")] = value
+        for (name, labels), h in sorted(self.histograms.items()):
+            key = name + _format_labels(labels, quote="")
+            summary[key + ".mean"] = h.sum / h.count if h.count else 0.0
+            summary[key + ".p99"] = h.quantile(0.99)
+        return summary
+
+    def to_prometheus(self) -> str:
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            metric = f"{PROMETHEUS_PREFIX}{name}_total"
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{_format_labels(labels)} {value}")
+        for (name, labels), h in sorted(self.histograms.items()):
+            metric = PROMETHEUS_PREFIX + name
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, count in zip(h.bounds + (float("inf"),), h.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:.6g}"
+                bucket_labels = _format_labels(labels + (("le", le),))
+                lines.append(f"{metric}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{metric}_sum{_format_labels(labels)} {h.sum}")
+            lines.append(f"{metric}_count{_format_labels(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, file_path: str):
+        _write_atomic(file_path, msgspec.json.encode(self.to_dict()))
+
+    def write_prometheus(self, file_path: str):
+        """Text format, for node_exporter's textfile collector and the like"""
+        _write_atomic(file_path, self.to_prometheus().encode())
+
+    def export(self, path_prefix: str):
+        """Writes <path_prefix>.json and <path_prefix>.prom"""
+        self.write_json(path_prefix + ".json")
+        self.write_prometheus(path_prefix + ".prom")
+
+
+def read_metrics(file_path: str) -> Metrics:
+    """Metrics from a write_json() file"""
+    with open(file_path, "rb") as f:
+        return Metrics().merge_dict(msgspec.json.decode(f.read()))
+
+
+def _format_labels(labels: Labels, quote: str = '"') -> str:
+    if not labels:
+        return ""
+    if quote:
+        labels = tuple(
+            (k, v.replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels
+        )
+    pairs = ",".join(f"{k}={quote}{v}{quote}" for k, v in labels)
+    return "{" + pairs + "}"
+
+
+def _write_atomic(file_path: str, data: bytes):
+    # readers (or a scraper) never see a half written file
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, file_path)
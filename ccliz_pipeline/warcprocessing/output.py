@@ -0,0 +1,424 @@
+import logging as log
+import os
+import typing
+from abc import ABC, abstractmethod
+from os import path
+from typing import Iterator, Literal
+
+import msgspec
+from msgspec import Struct
+from xopen import xopen
+
+from ..utils.io import append_bytes_to_file
+from .types import TextDocument
+from .utils import check_and_makedirs
+
+OutputFormat = Literal["jsonl", "jsonl.gz", "jsonl.zst", "parquet"]
+FORMAT_EXTENSIONS: dict[str, str] = {
+    "jsonl": ".jsonl",
+    "jsonl.gz": ".jsonl.gz",
+    "jsonl.zst": ".jsonl.zst",
+    "parquet": ".parquet",
+}
+
+encoder = msgspec.json.Encoder()
+
+
+class ShardInfo(Struct):
+    path: str
+    documents: int = 0
+    raw_bytes: int = 0  # as uncompressed jsonl
+    bytes: int = 0  # on disk
+    # where each flush starts on disk; for parquet, each flush is a row group
+    frames: list[int] = []
+
+
+class OutputManifest(Struct):
+    format: str
+    documents: int
+    raw_bytes: int
+    bytes: int
+    shards: list[ShardInfo]
+
+
+def output_stem(output_path: str) -> str:
+    """output_path without its format extension, shared by shards and manifest"""
+    for extension in sorted(FORMAT_EXTENSIONS.values(), key=len, reverse=True):
+        if output_path.endswith(extension):
+            return output_path[: -len(extension)]
+    return path.splitext(output_path)[0]
+
+
+def output_path_for(output_path: str, output_format: OutputFormat) -> str:
+    return output_stem(output_path) + FORMAT_EXTENSIONS[output_format]
+
+
+def manifest_path(output_path: str) -> str:
+    return output_stem(output_path) + ".manifest.json"
+
+
+def read_manifest(output_path: str) -> OutputManifest | None:
+    """Manifest of the output at output_path, whatever format it was written in"""
+    if not path.exists(manifest_path(output_path)):
+        return None
+    with open(manifest_path(output_path), "rb") as f:
+        return msgspec.json.decode(f.read(), type=OutputManifest)
+
+
+def output_fingerprint(output_path: str) -> list:
+    """
+    [path, size, mtime_ns] of the output's manifest, or of output_path itself
+    if it has none; changes whenever the output is written again
+    """
+    if path.exists(manifest_path(output_path)):
+        output_path = manifest_path(output_path)
+    stat = os.stat(output_path)
+    return [output_path, stat.st_size, stat.st_mtime_ns]
+
+
+def output_exists(output_path: str) -> bool:
+    """Whether there is an output at output_path, a single file or shards"""
+    stem = output_stem(output_path)
+    return any(
+        path.exists(p)
+        for p in (
+            output_path,
+            manifest_path(output_path),
+            f"{stem}-00000{output_path[len(stem):]}",
+        )
+    )
+
+
+def remove_output(output_path: str):
+    """Removes the output at output_path, its shards and manifest included"""
+    manifest = read_manifest(output_path)
+    for p in [s.path for s in manifest.shards] if manifest else []:
+        if path.exists(p):
+            os.remove(p)
+    for p in (output_path, manifest_path(output_path)):
+        if path.exists(p):
+            os.remove(p)
+
+
+def check_output(
+    output_path: str,
+    overwrite: Literal["always", "rename", "never"] = "rename",
+) -> str:
+    """
+    check_and_makedirs for outputs, which can be shards and a manifest rather
+    than a file at output_path: "always" removes all of the old output,
+    "never" raises FileExistsError and "rename" picks the first free
+    <stem>_<n> for the new one.
+    """
+    if output_exists(output_path):
+        match overwrite:
+            case "always":
+                remove_output(output_path)
+            case "never":
+                raise FileExistsError(f"Output {output_path} already exists")
+            case "rename":
+                stem = output_stem(output_path)
+                extension = output_path[len(stem) :]
+                number = 1
+                while output_exists(f"{stem}_{number}{extension}"):
+                    number += 1
+                output_path = f"{stem}_{number}{extension}"
+    return check_and_makedirs(output_path, overwrite)
+
+
+class DocumentWriter(ABC):
+    """
+    Writes TextDocuments to one or more shards of an output.
+
+    Documents are encoded as JSON lines into a buffer, which is written out as
+    one frame whenever it passes flush_bytes, on flush() and on close(). With
+    target_shard_bytes, a new shard is started once the current one is at least
+    that large on disk, and shards are named <stem>-00000<ext>, <stem>-00001<ext>
+    and so on; otherwise everything goes to output_path. close() writes the
+    last frame and a manifest of the shards next to them.
+
+    resume_shards continues an output from the shards recorded in a
+    checkpoint, truncating the last of them to its recorded size.
+    """
+
+    format: OutputFormat
+    supports_resume: bool = True
+
+    def __init__(
+        self,
+        output_path: str,
+        target_shard_bytes: int | None = None,
+        flush_bytes: int = 1500000,
+        resume_shards: list[ShardInfo] | None = None,
+    ):
+        self.output_path = output_path
+        self.target_shard_bytes = target_shard_bytes
+        self.flush_bytes = flush_bytes
+        self._stem = output_stem(output_path)
+        self._buffer = bytearray()
+        self._buffered_documents = 0
+        self.shards: list[ShardInfo] = []
+        if resume_shards:
+            self._resume(resume_shards)
+        self.raw_bytes = sum(s.raw_bytes for s in self.shards)
+
+    def _resume(self, shards: list[ShardInfo]):
+        if not self.supports_resume:
+            raise ValueError(f"{self.format} output can't be resumed")
+        self.shards = [
+            msgspec.structs.replace(s, frames=list(s.frames)) for s in shards
+        ]
+        with open(self.shards[-1].path, "r+b") as f:
+            f.truncate(self.shards[-1].bytes)
+        self._remove_stale_shards()
+
+    def shard_path(self, number: int) -> str:
+        if self.target_shard_bytes is None:
+            return self.output_path
+        return f"{self._stem}-{number:05d}{FORMAT_EXTENSIONS[self.format]}"
+
+    @property
+    def documents(self) -> int:
+        return sum(s.documents for s in self.shards) + self._buffered_documents
+
+    def write(self, document: TextDocument):
+        size = len(self._buffer)
+        encoder.encode_into(document, self._buffer, -1)
+        self._buffer.extend(b"\n")
+        self._buffered_documents += 1
+        self.raw_bytes += len(self._buffer) - size
+        if len(self._buffer) > self.flush_bytes:
+            self.flush()
+
+    def write_encoded(self, lines: bytes, documents: int):
+        """Writes already encoded, newline terminated JSON lines"""
+        self._buffer += lines
+        self._buffered_documents += documents
+        self.raw_bytes += len(lines)
+        if len(self._buffer) > self.flush_bytes:
+            self.flush()
+
+    def _current_shard(self) -> ShardInfo:
+        if not self.shards or (
+            self.target_shard_bytes is not None
+            and self.shards[-1].bytes >= self.target_shard_bytes
+        ):
+            if self.shards:
+                self._close_shard()
+            shard_path = self.shard_path(len(self.shards))
+            if path.exists(shard_path):
+                os.remove(shard_path)
+            self.shards.append(ShardInfo(path=shard_path))
+        return self.shards[-1]
+
+    def flush(self):
+        if not self._buffer:
+            return
+        shard = self._current_shard()
+        shard.frames.append(shard.bytes)
+        self._write_frame(shard.path, bytes(self._buffer))
+        shard.documents += self._buffered_documents
+        shard.raw_bytes += len(self._buffer)
+        shard.bytes = path.getsize(shard.path)
+        log.debug(f"{shard.path}: wrote {len(self._buffer)} bytes")
+        self._buffer.clear()
+        self._buffered_documents = 0
+
+    def sync(self):
+        """fsyncs the current shard, so everything flushed so far is on disk"""
+        if not self.shards:
+            return
+        fd = os.open(self.shards[-1].path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @abstractmethod
+    def _write_frame(self, shard_path: str, lines: bytes):
+        ...
+
+    def _close_shard(self):
+        pass
+
+    def _remove_stale_shards(self):
+        # left behind by an earlier, longer run into the same output
+        if self.target_shard_bytes is None:
+            return
+        number = len(self.shards)
+        while path.exists(stale := self.shard_path(number)):
+            os.remove(stale)
+            number += 1
+
+    def manifest(self) -> OutputManifest:
+        return OutputManifest(
+            format=self.format,
+            documents=sum(s.documents for s in self.shards),
+            raw_bytes=sum(s.raw_bytes for s in self.shards),
+            bytes=sum(s.bytes for s in self.shards),
+            shards=self.shards,
+        )
+
+    def close(self) -> OutputManifest:
+        self.flush()
+        if self.shards:
+            self._close_shard()
+        self._remove_stale_shards()
+        manifest = self.manifest()
+        tmp_path = manifest_path(self.output_path) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(msgspec.json.encode(manifest))
+        os.replace(tmp_path, manifest_path(self.output_path))
+        return manifest
+
+
+class JSONLWriter(DocumentWriter):
+    """
+    JSON lines, compressed according to the extension of the output (.gz or
+    .zst) through xopen. Each flush appends a separate gzip member or zstd
+    frame, so a shard cut at a flush is still a valid file.
+    """
+
+    def __init__(
+        self,
+        output_path: str,
+        output_format: OutputFormat = "jsonl",
+        compression_level: int | None = None,
+        **kwargs,
+    ):
+        self.format = output_format
+        self.compression_level = compression_level
+        super().__init__(output_path, **kwargs)
+
+    def _write_frame(self, shard_path: str, lines: bytes):
+        if self.compression_level is None:
+            append_bytes_to_file(shard_path, lines)
+        else:
+            append_bytes_to_file(
+                shard_path, lines, compresslevel=self.compression_level
+            )
+
+
+def _arrow_type(pa, tp):
+    if isinstance(tp, type) and issubclass(tp, Struct):
+        return pa.struct(
+            [(f.name, _arrow_type(pa, f.type)) for f in msgspec.structs.fields(tp)]
+        )
+    # Optional[X] -> X, nullable anyway
+    args = [a for a in typing.get_args(tp) if a is not type(None)]
+    if args:
+        return _arrow_type(pa, args[0])
+    return {int: pa.int64(), float: pa.float64(), bool: pa.bool_()}.get(
+        tp, pa.string()
+    )
+
+
+class ParquetWriter(DocumentWriter):
+    """
+    Parquet shards with one column per TextDocument field, header and stats as
+    struct columns. Every flush is written as a row group. Needs pyarrow.
+    A parquet file is only readable once closed, so it can't be resumed.
+    """
+
+    format = "parquet"
+    supports_resume = False
+
+    def __init__(
+        self,
+        output_path: str,
+        output_format: OutputFormat = "parquet",
+        compression_level: int | None = None,
+        **kwargs,
+    ):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError("parquet output needs pyarrow installed") from e
+        self._pa, self._pq = pa, pq
+        self._schema = pa.schema(list(_arrow_type(pa, TextDocument)))
+        self.compression_level = compression_level
+        self._parquet_writer = None
+        super().__init__(output_path, **kwargs)
+
+    def _write_frame(self, shard_path: str, lines: bytes):
+        if self._parquet_writer is None:
+            self._parquet_writer = self._pq.ParquetWriter(
+                shard_path,
+                self._schema,
+                compression="zstd",
+                compression_level=self.compression_level,
+            )
+        rows = msgspec.json.decode(b"[" + lines.rstrip(b"\n").replace(b"\n", b",") + b"]")
+        self._parquet_writer.write_table(
+            self._pa.Table.from_pylist(rows, schema=self._schema)
+        )
+
+    def _close_shard(self):
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+            self.shards[-1].bytes = path.getsize(self.shards[-1].path)
+
+
+def open_output_writer(
+    output_path: str,
+    output_format: OutputFormat = "jsonl",
+    compression_level: int | None = None,
+    **kwargs,
+) -> DocumentWriter:
+    """Writer for output_format; other keyword arguments go to DocumentWriter"""
+    writer_class = ParquetWriter if output_format == "parquet" else JSONLWriter
+    return writer_class(output_path, output_format, compression_level, **kwargs)
+
+
+def move_output(src_path: str, dest_path: str):
+    """
+    Moves the output at src_path, its shards and manifest, to dest_path in
+    place of whatever output is there, e.g. to replace an output with a
+    rewritten copy. The manifest is moved last, so until then readers still
+    see the old output's.
+    """
+    manifest = read_manifest(src_path)
+    if manifest is None:
+        os.replace(src_path, dest_path)
+        return
+    old = read_manifest(dest_path)
+    src_stem, dest_stem = output_stem(src_path), output_stem(dest_path)
+    for shard in manifest.shards:
+        moved = dest_stem + shard.path[len(src_stem) :]
+        os.replace(shard.path, moved)
+        shard.path = moved
+    moved_paths = {shard.path for shard in manifest.shards}
+    tmp_path = manifest_path(dest_path) + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(msgspec.json.encode(manifest))
+    os.replace(tmp_path, manifest_path(dest_path))
+    os.remove(manifest_path(src_path))
+    # an output without a manifest is the single file at dest_path
+    for old_path in [s.path for s in old.shards] if old else [dest_path]:
+        if old_path not in moved_paths and path.exists(old_path):
+            os.remove(old_path)
+
+
+def _parquet_lines(shard_path: str) -> Iterator[bytes]:
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(shard_path).iter_batches():
+        for row in batch.to_pylist():
+            yield encoder.encode(row) + b"\n"
+
+
+def iter_document_lines(output_path: str) -> Iterator[bytes]:
+    """
+    The JSON lines of an output in order, across all of its shards if it has a
+    manifest, otherwise of output_path itself
+    """
+    manifest = read_manifest(output_path)
+    shard_paths = [s.path for s in manifest.shards] if manifest else [output_path]
+    for shard_path in shard_paths:
+        if shard_path.endswith(".parquet"):
+            yield from _parquet_lines(shard_path)
+            continue
+        with xopen(shard_path, "rb") as f:
+            yield from f
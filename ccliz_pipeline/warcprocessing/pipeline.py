@@ -5,6 +5,13 @@ from typing import Optional
 from .types import CCRecordStage, CCRecordURL, LocalConfig
 from .utils import process_segment_url, stage_converter
 
+default_config = LocalConfig(
+    cc_path="CC",
+    # Downloader=None,
+    URL_Appendix="default",
+    stage_converter=stage_converter,
+)
+
 
 @dataclass
 class CCRecord:
@@ -21,12 +28,7 @@ class CCRecord:
     @staticmethod
     def create_from_URL(
         url: str,
-        config: LocalConfig = LocalConfig(
-            cc_path="CC",
-            # Downloader=None,
-            URL_Appendix="default",
-            stage_converter=stage_converter,
-        ),
+        config: LocalConfig = default_config,
         **kwargs,
     ) -> "CCRecord":
         """Creates a CCRecord from a URL"""
@@ -41,17 +43,18 @@ class CCRecord:
             **kwargs,
         )
 
-    def get_path(self, stage: Optional[CCRecordStage]) -> str:
+    def get_path(self, stage: Optional[CCRecordStage] = None) -> str:
         if not stage:
             stage = self.stage
         if not isinstance(stage, CCRecordStage):
             raise ValueError("stage must be of type CCRecordStage")
         if stage == CCRecordStage.ERROR:
             return self.get_path(self.stage_history[-1])
+        directory, extension = self.config["stage_converter"][stage]
         file_path = path.join(
             self.config["cc_path"],
-            self.config["stage_converter"][stage][0],
-            self.record_id + self.config + self.stage_converter[stage][1],
+            directory,
+            self.record_id + extension,
         )
         return file_path
 
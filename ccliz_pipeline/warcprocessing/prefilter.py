@@ -0,0 +1,83 @@
+import re
+from collections import Counter
+from typing import Iterable
+from urllib.parse import urlsplit
+
+from .types import WARCHeader
+
+
+class HeaderPrefilter:
+    """
+    Rejects records on their WARC headers alone, before the body is read.
+
+    Checks, in order: the identified payload type against allowed_payload_types
+    (None allows everything), content_length against the given bounds, the
+    target host (and its parent domains) against blocked_domains, and the
+    target URI against blocked_uri_patterns. Rejections are counted per reason
+    in self.rejected, everything checked in self.checked.
+    """
+
+    def __init__(
+        self,
+        allowed_payload_types: Iterable[str] | None = (
+            "text/html",
+            "application/xhtml+xml",
+        ),
+        min_content_length: int = 0,
+        max_content_length: int | None = 5_000_000,
+        blocked_domains: Iterable[str] = (),
+        blocked_uri_patterns: Iterable[str] = (),
+    ):
+        self.allowed_payload_types = (
+            frozenset(t.lower() for t in allowed_payload_types)
+            if allowed_payload_types is not None
+            else None
+        )
+        self.min_content_length = min_content_length
+        self.max_content_length = max_content_length
+        self.blocked_domains = frozenset(d.lower().strip(".") for d in blocked_domains)
+        patterns = list(blocked_uri_patterns)
+        self.blocked_uri_re = (
+            re.compile("|".join(f"(?:{p})" for p in patterns)) if patterns else None
+        )
+        self.checked = 0
+        self.rejected: Counter[str] = Counter()
+
+    def _blocked_host(self, uri: str) -> bool:
+        host = urlsplit(uri).hostname or ""
+        while host:
+            if host in self.blocked_domains:
+                return True
+            _, _, host = host.partition(".")
+        return False
+
+    def reject_reason(self, header: WARCHeader) -> str | None:
+        if self.allowed_payload_types is not None:
+            payload_type = header.identified_payload_type.split(";", 1)[0]
+            if payload_type.strip().lower() not in self.allowed_payload_types:
+                return "payload_type"
+        length = int(header.content_length)
+        if length < self.min_content_length:
+            return "content_too_short"
+        if self.max_content_length is not None and length > self.max_content_length:
+            return "content_too_long"
+        if self.blocked_domains and self._blocked_host(header.target_uri):
+            return "blocked_domain"
+        if self.blocked_uri_re and self.blocked_uri_re.search(header.target_uri):
+            return "blocked_uri"
+        return None
+
+    def check(self, header: WARCHeader) -> str | None:
+        """Counts the record and returns why it's rejected, None if it's kept"""
+        self.checked += 1
+        reason = self.reject_reason(header)
+        if reason:
+            self.rejected[reason] += 1
+        return reason
+
+    def __call__(self, header: WARCHeader) -> bool:
+        """Returns true if the record should be kept"""
+        return self.check(header) is None
+
+    def summary(self) -> dict[str, int]:
+        return {"checked": self.checked, **self.rejected}
@@ -1,7 +1,13 @@
 import re
+import string
+from typing import Iterable
 
-import trafilatura as tf
-from resiliparse.parse.encoding import bytes_to_str
+import msgspec
+import numpy as np
+from msgspec import Struct
+
+from .extraction import TrafilaturaExtractor
+from .types import DocumentStats, TextDocument
 
 hashtag_line_re = re.compile(r".*#\s*$", re.MULTILINE)
 
@@ -18,15 +24,12 @@ def count_hashtag_lines(text):
     return sum(1 for _ in matches)
 
 
-def preprocess_raw_bytes(body: bytes) -> str:
-    return tf.extract(
-        body,
-        # bytes_to_str(body),
-        include_comments=False,
-        include_tables=False,
-        favor_precision=True,
-        no_fallback=True,
-    )
+_default_extractor = TrafilaturaExtractor()
+
+
+def preprocess_raw_bytes(body: bytes) -> str | None:
+    """Main text of a response block with the default extractor (trafilatura)"""
+    return _default_extractor(body)
 
 
 """
@@ -42,43 +45,125 @@ documents that contain no cohe
 """
 
 
+STOP_WORDS = frozenset(["the", "be", "to", "of", "and", "that", "have", "with"])
+BULLETS = ("•", "●", "◦", "‣", "▪", "-", "*")
+ELLIPSES = ("...", "…")
+# stripped off words before they're matched against STOP_WORDS ("the," is "the")
+PUNCTUATION = string.punctuation + "“”‘’«»…"
+alpha_word_re = re.compile(r"\S*[^\W\d_]\S*")
+
+
+def compute_stats(s: str) -> DocumentStats:
+    """All the statistics the rules need, in one loop over the lines of s"""
+    num_words = num_lines = word_chars = alpha_words = 0
+    bullet_lines = ellipsis_lines = hashes = ellipses = 0
+    stop_words = set()
+    for line in s.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        num_lines += 1
+        if line.startswith(BULLETS):
+            bullet_lines += 1
+        if line.endswith(ELLIPSES):
+            ellipsis_lines += 1
+        hashes += line.count("#")
+        ellipses += line.count("...") + line.count("…")
+        words = line.split()
+        num_words += len(words)
+        word_chars += sum(map(len, words))
+        alpha_words += len(alpha_word_re.findall(line))
+        stop_words.update(
+            STOP_WORDS.intersection(w.strip(PUNCTUATION).lower() for w in words)
+        )
+    words = num_words or 1
+    lines = num_lines or 1
+    return DocumentStats(
+        num_words=num_words,
+        num_lines=num_lines,
+        mean_word_length=word_chars / words,
+        hash_ratio=hashes / words,
+        ellipsis_ratio=ellipses / words,
+        bullet_line_ratio=bullet_lines / lines,
+        ellipsis_line_ratio=ellipsis_lines / lines,
+        alpha_word_ratio=alpha_words / words,
+        stop_word_count=len(stop_words),
+    )
+
+
+def compute_stats_many(texts: Iterable[str]) -> list[DocumentStats]:
+    return [compute_stats(s) for s in texts]
+
+
+def annotate_documents(documents: Iterable[TextDocument]) -> list[TextDocument]:
+    """Fills in stats for every document that doesn't have them yet"""
+    documents = list(documents)
+    for doc in documents:
+        if doc.stats is None:
+            doc.stats = compute_stats(doc.raw_text)
+    return documents
+
+
+# columns of the feature arrays, in DocumentStats order
+FEATURES: tuple[str, ...] = DocumentStats.__struct_fields__
+
+
+class Rule(Struct, frozen=True):
+    """A document passes if its feature is within [min, max], either end open"""
+
+    feature: str
+    min: float | None = None
+    max: float | None = None
+
+
+# the Gopher rules quoted above; the one set both the inline rules of
+# process_record and the filter stage (see filtering) default to
+RULES: dict[str, Rule] = {
+    "num_words": Rule("num_words", 50, 100000),
+    "mean_word_length": Rule("mean_word_length", 3, 10),
+    "hash_ratio": Rule("hash_ratio", max=0.1),
+    "ellipsis_ratio": Rule("ellipsis_ratio", max=0.1),
+    "bullet_lines": Rule("bullet_line_ratio", max=0.9),
+    "ellipsis_lines": Rule("ellipsis_line_ratio", max=0.3),
+    "alpha_words": Rule("alpha_word_ratio", min=0.8),
+    "stop_words": Rule("stop_word_count", min=2),
+}
+
+
+def feature_array(stats: list[DocumentStats]) -> np.ndarray:
+    """(documents, FEATURES) float64 array of the stats"""
+    return np.array(
+        [msgspec.structs.astuple(s) for s in stats], dtype=np.float64
+    ).reshape(len(stats), len(FEATURES))
+
+
+def rule_masks(features: np.ndarray, rules: dict[str, Rule] = RULES) -> np.ndarray:
+    """(documents, rules) bool array, True where the document passes the rule"""
+    masks = np.ones((len(features), len(rules)), dtype=bool)
+    for column, rule in enumerate(rules.values()):
+        values = features[:, FEATURES.index(rule.feature)]
+        if rule.min is not None:
+            masks[:, column] &= values >= rule.min
+        if rule.max is not None:
+            masks[:, column] &= values <= rule.max
+    return masks
+
+
+def failed_rules(stats: DocumentStats, rules: dict[str, Rule] = RULES) -> list[str]:
+    masks = rule_masks(feature_array([stats]), rules)[0]
+    return [name for name, passed in zip(rules, masks) if not passed]
+
+
+def passes_rules(stats: DocumentStats, rules: dict[str, Rule] = RULES) -> bool:
+    return bool(rule_masks(feature_array([stats]), rules).all())
+
+
 def preprocessing_rules(s: str) -> bool:
     """returns true if passes rule"""
     if not s:
         return False
-    num_words = len(s.split())
-    if num_words < 20 or num_words > 100000:
-        # why
-        # print("num words not in range")
-        return False
-    if len(s) / num_words < 3 or len(s) / num_words > 10:
-        # print("mean word length not in range")
-        return False
-    if s.count("#") / num_words > 0.1:
-        # print("too many hashtags")
-        return False
-    if s.count("...") / num_words > 0.1:
-        # print("too many ellipses")
-        return False
-    if s.count("•") / num_words > 0.9:
-        # print("too many bullet points")
-        return False
-    if s.count("...") / num_words > 0.3:
-        # print("too many ellipses")
-        return False
-    if sum([1 for w in s.split() if not w.isalpha()]) / len(s.split()) > 0.8:
-        # print("too many non-alphabetic characters")
-        return False
-    # if (
-    #     sum(
-    #         [
-    #             1
-    #             for w in s.split()
-    #             if w in ["the", "be", "to", "of", "and", "that", "have", "with"]
-    #         ]
-    #     )
-    #     < 2
-    # ):
-    #     print("not enough stop words")
-    #     return False
-    return True
+    return passes_rules(compute_stats(s))
+
+
+def preprocessing_rules_many(texts: Iterable[str]) -> list[bool]:
+    return [bool(s) and passes_rules(compute_stats(s)) for s in texts]
@@ -0,0 +1,138 @@
+import os
+import zlib
+from os import path
+
+import numpy as np
+from fastwarc.stream_io import FileStream
+from fastwarc.warc import ArchiveIterator
+from msgspec import Struct
+
+CDX_HEADER = " CDX N V S a\n"
+
+
+class RecordIndex(Struct):
+    """
+    Byte ranges of the response records of one WARC file. Record n is the n-th
+    response record, the same numbering document ids use. For .warc.gz files
+    the offsets and lengths are of the gzip members holding the records.
+    """
+
+    offsets: list[int]
+    lengths: list[int]
+    uris: list[str]
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def split(self, parts: int) -> list[tuple[int, int]]:
+        """[start, end) record ranges of roughly equal size in bytes"""
+        if not self.offsets:
+            return []
+        ends = np.cumsum(self.lengths)
+        targets = ends[-1] * np.arange(1, parts) / parts
+        bounds = np.unique(
+            np.r_[0, np.searchsorted(ends, targets, side="right"), len(self)]
+        )
+        return [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) if a < b]
+
+
+def _warc_header_fields(data: bytes) -> dict[bytes, bytes]:
+    head = data[: data.find(b"\r\n\r\n")]
+    fields = {}
+    for line in head.split(b"\r\n")[1:]:
+        key, _, value = line.partition(b":")
+        fields[key.strip().lower()] = value.strip()
+    return fields
+
+
+def _index_gzip_members(warc_path: str, chunk_size: int = 1 << 20) -> RecordIndex:
+    # CC writes one gzip member per record, so member boundaries are record
+    # boundaries and each member can be decompressed on its own. Only the
+    # start of each member is kept, the rest is inflated to find where it ends
+    offsets, lengths, uris = [], [], []
+    member_start = position = 0  # position: file offset of the start of chunk
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    head = bytearray()
+    with open(warc_path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            while chunk:
+                out = decompressor.decompress(chunk, 1 << 16)
+                if len(head) < 1 << 16:
+                    head += out
+                if not decompressor.eof:
+                    position += len(chunk) - len(decompressor.unconsumed_tail)
+                    chunk = decompressor.unconsumed_tail
+                    continue
+                position += len(chunk) - len(decompressor.unused_data)
+                chunk = decompressor.unused_data
+                fields = _warc_header_fields(bytes(head))
+                if fields.get(b"warc-type") == b"response":
+                    offsets.append(member_start)
+                    lengths.append(position - member_start)
+                    uris.append(fields.get(b"warc-target-uri", b"-").decode())
+                member_start = position
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                head = bytearray()
+    return RecordIndex(offsets=offsets, lengths=lengths, uris=uris)
+
+
+def _index_uncompressed(warc_path: str) -> RecordIndex:
+    offsets, lengths, uris = [], [], []
+    previous_response = False
+    with FileStream(warc_path) as stream:
+        for document in ArchiveIterator(stream, parse_http=False):
+            if previous_response:
+                lengths.append(document.stream_pos - offsets[-1])
+            previous_response = document.headers["WARC-Type"] == "response"
+            if previous_response:
+                offsets.append(document.stream_pos)
+                uris.append(document.headers.get("WARC-Target-URI", "-"))
+    if previous_response:
+        lengths.append(path.getsize(warc_path) - offsets[-1])
+    return RecordIndex(offsets=offsets, lengths=lengths, uris=uris)
+
+
+def build_record_index(warc_path: str) -> RecordIndex:
+    if warc_path.endswith(".gz"):
+        return _index_gzip_members(warc_path)
+    return _index_uncompressed(warc_path)
+
+
+def record_index_path(warc_path: str) -> str:
+    return warc_path + ".cdx"
+
+
+def write_record_index(index: RecordIndex, index_path: str):
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(CDX_HEADER)
+        for n, (offset, length, uri) in enumerate(
+            zip(index.offsets, index.lengths, index.uris)
+        ):
+            f.write(f"{n} {offset} {length} {uri.replace(' ', '%20')}\n")
+    os.replace(tmp_path, index_path)
+
+
+def read_record_index(index_path: str) -> RecordIndex:
+    offsets, lengths, uris = [], [], []
+    with open(index_path) as f:
+        if f.readline() != CDX_HEADER:
+            raise ValueError(f"{index_path} is not a record index")
+        for line in f:
+            _, offset, length, uri = line.rstrip("\n").split(" ", 3)
+            offsets.append(int(offset))
+            lengths.append(int(length))
+            uris.append(uri)
+    return RecordIndex(offsets=offsets, lengths=lengths, uris=uris)
+
+
+def load_record_index(warc_path: str) -> RecordIndex:
+    """Reads the index next to warc_path, building and saving it first if needed"""
+    index_path = record_index_path(warc_path)
+    if path.exists(index_path) and path.getmtime(index_path) >= path.getmtime(
+        warc_path
+    ):
+        return read_record_index(index_path)
+    index = build_record_index(warc_path)
+    write_record_index(index, index_path)
+    return index
@@ -1,162 +1,886 @@
 import logging as log
 import multiprocessing as mp
+import threading
+import time
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    wait,
+)
+from concurrent.futures.process import BrokenProcessPool
 from functools import partial
-from os import makedirs, path
-from typing import BinaryIO, Literal
+from os import path, remove
+from queue import Full, Queue
+from typing import Callable, Deque, Iterable, Iterator, Literal
 
 import msgspec
 from fastwarc.stream_io import FileStream, GZipStream
 from fastwarc.warc import ArchiveIterator, WarcRecordType
-from tqdm import tqdm
 
+from .checkpoint import Checkpointer, load_checkpoint
+from .digestindex import DigestIndex
+from .extraction import Extractor, get_extractor
+from .extractioncache import ExtractionCache
+from .metrics import Metrics
+from .output import (
+    DocumentWriter,
+    JSONLWriter,
+    OutputFormat,
+    check_output,
+    open_output_writer,
+    output_path_for,
+    output_stem,
+)
 from .pipeline import CCRecord
-from .preprocessing import preprocess_raw_bytes, preprocessing_rules
-from .types import CCRecordStage, TextDocument
-from .utils import check_and_makedirs, check_file, make_warc_header
+from .prefilter import HeaderPrefilter
+from .preprocessing import (
+    compute_stats,
+    failed_rules,
+    preprocess_raw_bytes,
+)
+from .recordindex import load_record_index
+from .sandbox import ExtractionFailed, ExtractionSandbox
+from .types import CCRecordStage, TextDocument, WARCHeader
+from .utils import make_warc_header, make_warc_header_from_tuples
 
 encoder = msgspec.json.Encoder()
 
 
-def stream_from_cc_file(path_to_cc_file: str, streamHandler):
+def stream_from_cc_file(path_to_cc_file: str, streamHandler, offset: int = 0):
+    """
+    Calls streamHandler on a fastwarc stream of the file. offset seeks the
+    file to a record boundary first; for .gz files that has to be the start of
+    a gzip member (see recordindex).
+    """
+    file_stream = FileStream(path_to_cc_file)
+    if offset:
+        file_stream.seek(offset)
     if path_to_cc_file.endswith(".gz"):
-        with GZipStream(FileStream(path_to_cc_file)) as stream:
+        with GZipStream(file_stream) as stream:
             return streamHandler(stream)
-    with FileStream(path_to_cc_file) as stream:
+    with file_stream as stream:
         return streamHandler(stream)
 
 
-def warc_record_handler(document: WarcRecordType, id: int, record: CCRecord):
-    header = make_warc_header(document.headers)
-    body = preprocess_raw_bytes(document.reader.read())
-    if not preprocessing_rules(body):
-        # if id % 25 == 0:
-        #    print("failed preprocessing rules", body)
+def make_text_document(
+    header: WARCHeader,
+    raw_body: bytes,
+    document_id: str,
+    extraction_cache: ExtractionCache | None = None,
+    metrics: Metrics | None = None,
+    extraction_sandbox: ExtractionSandbox | None = None,
+    extractor: Callable[[bytes], str | None] = preprocess_raw_bytes,
+    apply_rules: bool = True,
+) -> TextDocument | None:
+    if extraction_sandbox is not None:
+        extract = partial(
+            extraction_sandbox.extract,
+            document_id=document_id,
+            uri=header.target_uri,
+            extractor=extractor,
+        )
+    else:
+        extract = extractor
+    start = time.perf_counter()
+    try:
+        if extraction_cache is not None:
+            body = extraction_cache.extract(
+                header.payload_digest,
+                raw_body,
+                extract,
+                getattr(extractor, "settings", None),
+                metrics,
+            )
+        else:
+            body = extract(raw_body)
+    except ExtractionFailed as e:
+        # given up on, the document is dropped and the file goes on
+        if metrics is not None:
+            metrics.inc("records_extraction_failed", reason=e.reason)
+        return None
+    extracted = time.perf_counter()
+    if metrics is not None:
+        metrics.observe("extract_seconds", extracted - start)
+    if not body:
+        if metrics is not None:
+            metrics.inc("records_empty")
+        return None
+    stats = compute_stats(body)
+    # without the rules, every document is kept for the filter stage
+    failed = failed_rules(stats) if apply_rules else []
+    passed = not failed
+    if metrics is not None:
+        metrics.observe("filter_seconds", time.perf_counter() - extracted)
+        metrics.inc("records_extracted")
+        if not passed:
+            metrics.inc("documents_filtered")
+            for rule in failed:
+                metrics.inc("documents_rejected", rule=rule)
+    if not passed:
         return None
-    document_id = path.join(record.record_id, str(id))
-    log.info(f"Created document {document_id} ")
     return TextDocument(
         id=document_id,
         header=header,
         raw_text=body,
         pipeline_status="raw",
+        stats=stats,
     )
 
 
-def handle_archive_stream(stream, filehandler: BinaryIO, record: CCRecord):
-    # ret = []
-    buffer = bytearray(2000000)
-    buffer.clear()
-    count_all = 0
-    count_passed = 0
-    for id, document in tqdm(
-        enumerate(
-            ArchiveIterator(
-                stream,
-                parse_http=False,
-                record_types=WarcRecordType.response,
-            )
-        )
+def warc_record_handler(
+    document: WarcRecordType,
+    id: int,
+    record: CCRecord,
+    digest_index: DigestIndex | None = None,
+    prefilter: HeaderPrefilter | None = None,
+    extraction_cache: ExtractionCache | None = None,
+    metrics: Metrics | None = None,
+    extraction_sandbox: ExtractionSandbox | None = None,
+    extractor: Callable[[bytes], str | None] = preprocess_raw_bytes,
+    apply_rules: bool = True,
+):
+    metrics = metrics if metrics is not None else Metrics()
+    metrics.inc("records_seen")
+    header = make_warc_header(document.headers)
+    if prefilter is not None and (reason := prefilter.check(header)):
+        metrics.inc("records_prefiltered", reason=reason)
+        return None
+    if digest_index is not None and digest_index.check_and_add(
+        header.payload_digest, record.record_id
+    ):
+        # byte-identical payload already extracted somewhere, skip the work
+        metrics.inc("records_duplicate")
+        return None
+    document_id = path.join(record.record_id, str(id))
+    start = time.perf_counter()
+    raw_body = document.reader.read()
+    metrics.observe("read_seconds", time.perf_counter() - start)
+    metrics.inc("bytes_read", len(raw_body))
+    return make_text_document(
+        header,
+        raw_body,
+        document_id,
+        extraction_cache,
+        metrics,
+        extraction_sandbox,
+        extractor,
+        apply_rules,
+    )
+
+
+def handle_archive_stream(
+    stream,
+    writer: DocumentWriter,
+    record: CCRecord,
+    digest_index: DigestIndex | None = None,
+    prefilter: HeaderPrefilter | None = None,
+    extraction_cache: ExtractionCache | None = None,
+    checkpointer: Checkpointer | None = None,
+    first_id: int = 0,
+    stop_id: int | None = None,
+    metrics: Metrics | None = None,
+    extraction_sandbox: ExtractionSandbox | None = None,
+    extractor: Callable[[bytes], str | None] = preprocess_raw_bytes,
+    apply_rules: bool = True,
+):
+    # first_id is the id of the first response record in the stream, stop_id
+    # the id to stop at, for streams seeked into the middle of a file
+    metrics = metrics if metrics is not None else Metrics()
+    skip_through = checkpointer.skip_through if checkpointer else -1
+    for id, document in enumerate(
+        ArchiveIterator(
+            stream,
+            parse_http=False,
+            record_types=WarcRecordType.response,
+        ),
+        checkpointer.first_id if checkpointer else first_id,
     ):
-        rec = warc_record_handler(document, id, record)
-        count_all += 1
+        if stop_id is not None and id >= stop_id:
+            break
+        if document.stream_pos <= skip_through:
+            # already written by the run we are resuming
+            continue
+        rec = warc_record_handler(
+            document,
+            id,
+            record,
+            digest_index,
+            prefilter,
+            extraction_cache,
+            metrics,
+            extraction_sandbox,
+            extractor,
+            apply_rules,
+        )
+        if not rec:
+            continue
+        start = time.perf_counter()
+        line = encoder.encode(rec) + b"\n"
+        metrics.observe("encode_seconds", time.perf_counter() - start)
+        writer.write_encoded(line, 1)
+        metrics.inc("documents_written")
+        metrics.inc("bytes_written", len(line))
+        if checkpointer:
+            checkpointer.save(document.stream_pos, id + 1, force=False)
+    writer.flush()
+
+
+# per process state of the extraction pool workers, see _init_extraction_worker
+_worker_state: dict = {}
 
+
+def _init_extraction_worker(state: dict):
+    _worker_state.update(state)
+
+
+def _handle_raw_batch(
+    batch: list[tuple[int, tuple, bytes]], record_id: str
+) -> tuple[bytes, int, Metrics]:
+    # runs in the extraction pool, returns the encoded jsonl lines of the batch
+    # and the metrics of extracting it
+    metrics = Metrics()
+    buffer = bytearray()
+    count_passed = 0
+    for id, header_tuples, raw_body in batch:
+        rec = make_text_document(
+            make_warc_header_from_tuples(header_tuples),
+            raw_body,
+            path.join(record_id, str(id)),
+            _worker_state.get("extraction_cache"),
+            metrics,
+            _worker_state.get("extraction_sandbox"),
+            _worker_state.get("extractor", preprocess_raw_bytes),
+            _worker_state.get("apply_rules", True),
+        )
         if not rec:
             continue
+        start = time.perf_counter()
         encoder.encode_into(rec, buffer, -1)
         buffer.extend(b"\n")
-        if len(buffer) > 1500000:
-            log.info(f"{record.record_id} ({id}): writing buffer", len(buffer))
-            count_passed += 1
+        metrics.observe("encode_seconds", time.perf_counter() - start)
+        count_passed += 1
+    return bytes(buffer), count_passed, metrics
 
-            filehandler.write(buffer)
-            buffer.clear()
 
+def _put_until(queue: Queue, item, stop: threading.Event) -> bool:
+    # blocking put that gives up once the consumer has gone away
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            continue
+    return False
 
-def managed_stream(
-    output_file: str,
-    path_to_cc_file: str,
-    snapshot: str,
-    segment: str,
-    overwrite: bool = True,
+
+def _read_raw_batches(
+    stream,
+    batches: Queue,
+    stop: threading.Event,
+    batch_size: int,
+    digest_index: DigestIndex | None = None,
+    prefilter: HeaderPrefilter | None = None,
+    checkpointer: Checkpointer | None = None,
+    metrics: Metrics | None = None,
+    record_id: str = "",
 ):
-    # write line by line to output_file
-    # mkdir if not exists
-    print(f"Writing to {output_file} with snapshot {snapshot} and segment {segment}\n")
-    output_path = path.join("CC", snapshot, segment)
-    if not path.exists(output_path):
-        makedirs(output_path)
-    # if overwrite, delete file else error
-    if path.exists(path.join(output_path, output_file)):
-        if overwrite:
-            print(f"Overwriting {output_file}")
-        else:
-            raise FileExistsError(f"{output_file} exists")
-    with open(path.join(output_path, output_file), "wb") as file:
-        stream_from_cc_file(
-            path_to_cc_file,
-            partial(
-                handle_archive_stream,
-                filehandler=file,
-                snapshot_date=snapshot,
-                segment=segment,
+    # batches go out as (records, stream_pos of the last record, its id)
+    metrics = metrics if metrics is not None else Metrics()
+    try:
+        batch = []
+        skip_through = checkpointer.skip_through if checkpointer else -1
+        for id, document in enumerate(
+            ArchiveIterator(
+                stream,
+                parse_http=False,
+                record_types=WarcRecordType.response,
             ),
-        )
+            checkpointer.first_id if checkpointer else 0,
+        ):
+            if document.stream_pos <= skip_through:
+                continue
+            metrics.inc("records_seen")
+            header_tuples = document.headers.astuples()
+            if prefilter is not None and (
+                reason := prefilter.check(make_warc_header_from_tuples(header_tuples))
+            ):
+                metrics.inc("records_prefiltered", reason=reason)
+                continue
+            if digest_index is not None and digest_index.check_and_add(
+                document.headers["WARC-Payload-Digest"], record_id
+            ):
+                metrics.inc("records_duplicate")
+                continue
+            start = time.perf_counter()
+            raw_body = document.reader.read()
+            metrics.observe("read_seconds", time.perf_counter() - start)
+            metrics.inc("bytes_read", len(raw_body))
+            batch.append((id, header_tuples, raw_body))
+            if len(batch) >= batch_size:
+                if not _put_until(batches, (batch, document.stream_pos, id), stop):
+                    return
+                batch = []
+        if batch and not _put_until(
+            batches, (batch, document.stream_pos, batch[-1][0]), stop
+        ):
+            return
+        _put_until(batches, None, stop)
+    except Exception as e:
+        _put_until(batches, e, stop)
 
 
-def batch_managed_streams(
-    output_file: str,
-    cc_files: list[str],
-    cc_segments_per_file: list[str],
-    cc_snapshot: str,
-    overwrite: bool = True,
+def handle_archive_stream_pipelined(
+    stream,
+    writer: DocumentWriter,
+    record: CCRecord,
+    executor: Executor,
+    workers: int | None = None,
+    batch_size: int = 64,
+    max_batches_in_flight: int | None = None,
+    digest_index: DigestIndex | None = None,
+    prefilter: HeaderPrefilter | None = None,
+    checkpointer: Checkpointer | None = None,
+    metrics: Metrics | None = None,
 ):
-    # dispatch managed_stream for each segment
-
-    with mp.Pool(
-        processes=mp.cpu_count() - 2,
-    ) as pool:
-        pool.starmap(
-            managed_stream,
-            [
+    """
+    Pipelined version of handle_archive_stream for a single large file.
+
+    A reader thread copies the headers and raw bodies off the ArchiveIterator
+    into batches, the batches are extracted, filtered and encoded on executor,
+    and the results are written to writer in the original order. The queue
+    between the reader and the pool and the number of batches submitted at once
+    are both bounded, so at most around 2 * max_batches_in_flight batches of raw
+    bodies are held in memory. max_batches_in_flight defaults to twice workers,
+    the number of processes executor was built with (or the CPU count).
+    With a checkpointer, a checkpoint is saved once at least 1.5MB has been
+    written since the last one.
+    The reader thread and every batch count into their own Metrics, which are
+    merged into metrics.
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    reader_metrics = Metrics()
+    max_batches_in_flight = max_batches_in_flight or 2 * (workers or mp.cpu_count())
+    batches: Queue = Queue(maxsize=max_batches_in_flight)
+    stop = threading.Event()
+    reader = threading.Thread(
+        target=_read_raw_batches,
+        args=(
+            stream,
+            batches,
+            stop,
+            batch_size,
+            digest_index,
+            prefilter,
+            checkpointer,
+            reader_metrics,
+            record.record_id,
+        ),
+        daemon=True,
+    )
+    # (future, stream_pos of the batch's last record, its id)
+    in_flight: Deque[tuple[Future, int, int]] = deque()
+
+    def write_oldest():
+        future, last_pos, last_id = in_flight.popleft()
+        lines, passed, batch_metrics = future.result()
+        writer.write_encoded(lines, passed)
+        metrics.merge(batch_metrics)
+        metrics.inc("documents_written", passed)
+        metrics.inc("bytes_written", len(lines))
+        if checkpointer:
+            checkpointer.save(last_pos, last_id + 1, force=False)
+
+    reader.start()
+    try:
+        while (item := batches.get()) is not None:
+            if isinstance(item, Exception):
+                raise item
+            batch, last_pos, last_id = item
+            in_flight.append(
                 (
-                    output_file,
-                    cc_file,
-                    overwrite,
-                    cc_snapshot,
-                    cc_segment,
+                    executor.submit(_handle_raw_batch, batch, record.record_id),
+                    last_pos,
+                    last_id,
                 )
-                for cc_file, cc_segment in zip(cc_files, cc_segments_per_file)
-            ],
-        )
+            )
+            while len(in_flight) >= max_batches_in_flight:
+                write_oldest()
+        while in_flight:
+            write_oldest()
+        writer.flush()
+    finally:
+        stop.set()
+        for future, _, _ in in_flight:
+            future.cancel()
+        reader.join()
+        metrics.merge(reader_metrics)
+
+
+def _process_record_range(
+    source_file_path: str,
+    part_path: str,
+    record: CCRecord,
+    offset: int,
+    start_id: int,
+    stop_id: int,
+    digest_index: DigestIndex | None = None,
+    prefilter: HeaderPrefilter | None = None,
+    extraction_cache: ExtractionCache | None = None,
+    extraction_sandbox: ExtractionSandbox | None = None,
+    extractor: Callable[[bytes], str | None] = preprocess_raw_bytes,
+    apply_rules: bool = True,
+) -> tuple[HeaderPrefilter | None, Metrics]:
+    # returns this worker's copy of the prefilter and its metrics, so the
+    # counts can be merged
+    metrics = Metrics()
+    stream_from_cc_file(
+        source_file_path,
+        partial(
+            handle_archive_stream,
+            writer=JSONLWriter(part_path),
+            record=record,
+            digest_index=digest_index,
+            prefilter=prefilter,
+            extraction_cache=extraction_cache,
+            first_id=start_id,
+            stop_id=stop_id,
+            metrics=metrics,
+            extraction_sandbox=extraction_sandbox,
+            extractor=extractor,
+            apply_rules=apply_rules,
+        ),
+        offset,
+    )
+    if digest_index is not None:
+        digest_index.flush()
+    return prefilter, metrics
+
+
+def process_record_split(
+    record: CCRecord,
+    source_file_path: str,
+    writer: DocumentWriter,
+    split_workers: int,
+    ranges_per_worker: int = 4,
+    digest_index: DigestIndex | None = None,
+    prefilter: HeaderPrefilter | None = None,
+    extraction_cache: ExtractionCache | None = None,
+    metrics: Metrics | None = None,
+    extraction_sandbox: ExtractionSandbox | None = None,
+    extractor: Callable[[bytes], str | None] = preprocess_raw_bytes,
+    apply_rules: bool = True,
+):
+    """
+    Processes one file on split_workers processes, using its record index
+    (built next to it on first use) to cut it into [start, end) ranges of
+    response records. Each range is written to its own jsonl part file, and
+    the parts are fed to writer in order, so the output is the same as a serial
+    run's. There are ranges_per_worker ranges per worker, so a slow range
+    doesn't leave the others idle at the end.
+    Each worker checks digests against its own copy of the digest index, so
+    duplicates between ranges of the same file aren't caught.
+    """
+    index = load_record_index(source_file_path)
+    ranges = index.split(split_workers * ranges_per_worker)
+    log.info(
+        f"{record.record_id}: {len(index)} records in {len(ranges)} ranges "
+        f"on {split_workers} workers"
+    )
+    stem = output_stem(writer.output_path)
+    part_paths = [f"{stem}.part{k}.jsonl" for k in range(len(ranges))]
+    try:
+        with ProcessPoolExecutor(split_workers) as executor:
+            futures = [
+                executor.submit(
+                    _process_record_range,
+                    source_file_path,
+                    part_path,
+                    record,
+                    index.offsets[start],
+                    start,
+                    end,
+                    digest_index,
+                    prefilter,
+                    extraction_cache,
+                    extraction_sandbox,
+                    extractor,
+                    apply_rules,
+                )
+                for part_path, (start, end) in zip(part_paths, ranges)
+            ]
+            for part_path, future in zip(part_paths, futures):
+                worker_prefilter, worker_metrics = future.result()
+                if metrics is not None:
+                    metrics.merge(worker_metrics)
+                if prefilter is not None:
+                    prefilter.checked += worker_prefilter.checked
+                    prefilter.rejected.update(worker_prefilter.rejected)
+                if not path.exists(part_path):
+                    # nothing in the range passed
+                    continue
+                with open(part_path, "rb") as part:
+                    while lines := part.readlines(1 << 20):
+                        writer.write_encoded(b"".join(lines), len(lines))
+    finally:
+        for part_path in part_paths:
+            if path.exists(part_path):
+                remove(part_path)
 
 
 def process_record(
-    record: CCRecord, overwrite: Literal["always", "never", "rename"] = "rename"
+    record: CCRecord,
+    overwrite: Literal["always", "never", "rename"] = "rename",
+    stream_source: bool = False,
+    extraction_workers: int = 0,
+    digest_index: DigestIndex | None = None,
+    prefilter: HeaderPrefilter | None = None,
+    extraction_cache: ExtractionCache | None = None,
+    checkpoint: bool = True,
+    split_workers: int = 0,
+    output_format: OutputFormat = "jsonl",
+    target_shard_bytes: int | None = None,
+    compression_level: int | None = None,
+    metrics: Metrics | None = None,
+    extraction_sandbox: ExtractionSandbox | None = None,
+    extractor: Extractor | str = "trafilatura",
+    apply_rules: bool = True,
+    output_path: str | None = None,
 ):
-    if record.stage != CCRecordStage.STAGED:
-        raise ValueError(f"Record {record.record_id} is not staged")
+    """
+    Extracts the response records of a staged WARC into the PREPROCESSED jsonl.
+    With stream_source, takes a SOURCE record instead and decompresses the
+    .warc.gz on the fly, skipping the STAGED copy entirely.
+    With extraction_workers, the file itself is split across that many
+    processes (see handle_archive_stream_pipelined).
+    With split_workers, the file is instead cut into record ranges that are
+    read and extracted independently by that many processes (see
+    process_record_split). Checkpoints aren't kept in that mode.
+    With a digest_index, responses whose payload digest was already seen, in
+    another record or earlier in this one, are skipped before extraction, and
+    the new digests are flushed to it once the record is done. Digests are
+    kept with the record that first had them, so running a record again
+    doesn't drop its documents as duplicates of its last run.
+    With a prefilter, records are rejected on their headers before the body is
+    read at all.
+    extractor chooses how the main text is extracted from the HTML, by name
+    ("trafilatura", "resiliparse" or "cascade") or as an extraction.Extractor.
+    Documents that fail the rules (see preprocessing.RULES) are dropped on the
+    spot; without apply_rules, every extracted document is kept, with its
+    stats, for the filter stage (see filtering.filter_record) to decide on.
+    With an extraction_cache, extraction results are looked up by payload
+    digest first, so reruns with different rules don't have to re-extract.
+    With an extraction_sandbox, extraction runs on a separate process with a
+    time and memory limit per document, and documents that hit them are
+    skipped (see sandbox.ExtractionSandbox).
+    With checkpoint, progress is saved next to the output at every flush, and
+    if a checkpoint from an earlier, interrupted run is found, its output is
+    truncated to the checkpoint and processing picks up from there.
+    output_format, target_shard_bytes and compression_level choose how the
+    output is written (see output.DocumentWriter); the default is a single
+    uncompressed jsonl at the PREPROCESSED path. A manifest of the shards is
+    written next to the output. parquet output can't be checkpointed.
+    With output_path, the output (and its checkpoint) goes there instead of
+    the PREPROCESSED path, e.g. to be moved into place later (see leases).
+    Counters and timings of the record are logged once it's done, and merged
+    into metrics if given (see metrics.Metrics).
+    """
+    input_stage = CCRecordStage.SOURCE if stream_source else CCRecordStage.STAGED
+    if extraction_workers and split_workers:
+        raise ValueError("extraction_workers and split_workers are exclusive")
+    checkpoint = checkpoint and not split_workers and output_format != "parquet"
+    if record.stage != input_stage:
+        raise ValueError(
+            f"Record {record.record_id} is not {input_stage.name.lower()}"
+        )
+    extractor = get_extractor(extractor)
+    record_metrics = Metrics()
+    started = time.perf_counter()
     try:
         record.update_stage(CCRecordStage.PREPROCESSING)
         log.info(f"Processing record {record.record_id}")
-        source_file_path = check_file(record.get_path(CCRecordStage.STAGED), overwrite)
-        processed_file_path = check_and_makedirs(
-            record.get_path(CCRecordStage.PREPROCESSED)
+        source_file_path = record.get_path(input_stage)
+        checkpoint_path = (
+            output_path or record.get_path(CCRecordStage.PREPROCESSED)
+        ) + ".ckpt"
+        resume_from = load_checkpoint(checkpoint_path) if checkpoint else None
+        if resume_from and (
+            resume_from.output_format != output_format
+            or not all(path.exists(shard.path) for shard in resume_from.shards)
+        ):
+            resume_from = None
+        if resume_from:
+            log.info(f"Resuming record {record.record_id} from {resume_from}")
+            output_path = resume_from.output_path
+        else:
+            output_path = check_output(
+                output_path
+                or output_path_for(
+                    record.get_path(CCRecordStage.PREPROCESSED), output_format
+                ),
+                overwrite,
+            )
+        writer = open_output_writer(
+            output_path,
+            output_format,
+            compression_level,
+            target_shard_bytes=target_shard_bytes,
+            resume_shards=resume_from.shards if resume_from else None,
+        )
+        # checkpoints hold stream positions, which are only file offsets for
+        # uncompressed files; .gz files are reread from the start and skipped
+        seek_to = (
+            resume_from.input_offset
+            if resume_from and not source_file_path.endswith(".gz")
+            else 0
+        )
+        checkpointer = (
+            Checkpointer(
+                checkpoint_path,
+                writer,
+                resume_from,
+                seeked=bool(seek_to),
+                min_interval_bytes=1500000,
+            )
+            if checkpoint
+            else None
         )
-        with open(processed_file_path, "wb") as file:
+        if split_workers:
+            process_record_split(
+                record,
+                source_file_path,
+                writer,
+                split_workers,
+                digest_index=digest_index,
+                prefilter=prefilter,
+                extraction_cache=extraction_cache,
+                metrics=record_metrics,
+                extraction_sandbox=extraction_sandbox,
+                extractor=extractor,
+                apply_rules=apply_rules,
+            )
+        elif extraction_workers:
+            # each worker gets its own copy of the cache, writing its own
+            # segment files, and its own sandbox process; hits and misses
+            # come back in the batches' metrics
+            with ProcessPoolExecutor(
+                extraction_workers,
+                initializer=_init_extraction_worker,
+                initargs=(
+                    {
+                        "extraction_cache": extraction_cache,
+                        "extraction_sandbox": extraction_sandbox,
+                        "extractor": extractor,
+                        "apply_rules": apply_rules,
+                    },
+                ),
+            ) as executor:
+                stream_from_cc_file(
+                    source_file_path,
+                    partial(
+                        handle_archive_stream_pipelined,
+                        writer=writer,
+                        record=record,
+                        executor=executor,
+                        workers=extraction_workers,
+                        digest_index=digest_index,
+                        prefilter=prefilter,
+                        checkpointer=checkpointer,
+                        metrics=record_metrics,
+                    ),
+                    seek_to,
+                )
+        else:
             stream_from_cc_file(
                 source_file_path,
                 partial(
                     handle_archive_stream,
-                    filehandler=file,
+                    writer=writer,
                     record=record,
+                    digest_index=digest_index,
+                    prefilter=prefilter,
+                    extraction_cache=extraction_cache,
+                    checkpointer=checkpointer,
+                    metrics=record_metrics,
+                    extraction_sandbox=extraction_sandbox,
+                    extractor=extractor,
+                    apply_rules=apply_rules,
                 ),
+                seek_to,
             )
-        # print("stage", record.stage)
+        manifest = writer.close()
     except Exception as e:
         log.error(f"Error processing record {record.record_id}: {e}")
         record.update_stage(CCRecordStage.ERROR)
+        record_metrics.inc("records_processed", result="error")
+        if metrics is not None:
+            metrics.merge(record_metrics)
         return record
     else:
-        log.info(f"Finished processing record {record.record_id}")
+        if checkpointer:
+            checkpointer.remove()
+        if prefilter is not None:
+            log.info(f"{record.record_id}: prefilter {prefilter.summary()}")
+        if extraction_cache is not None:
+            # counted by whichever process extracted, see make_text_document
+            hits = record_metrics.get("extraction_cache_lookups", result="hit")
+            misses = record_metrics.get("extraction_cache_lookups", result="miss")
+            log.info(
+                f"{record.record_id}: extraction cache hit rate "
+                f"{hits / max(hits + misses, 1):.2%}"
+            )
+        if digest_index is not None and not split_workers:
+            digest_index.flush()
+            log.info(
+                f"{record.record_id}: digest index hit rate {digest_index.hit_rate:.2%}"
+            )
+        record_metrics.observe("record_seconds", time.perf_counter() - started)
+        record_metrics.inc("records_processed", result="preprocessed")
+        record_metrics.inc("output_bytes", manifest.bytes)
+        log.info(
+            f"Finished processing record {record.record_id}: "
+            f"{manifest.documents} documents in {len(manifest.shards)} shards, "
+            f"{manifest.bytes} bytes ({manifest.raw_bytes} uncompressed)"
+        )
+        log.info(f"{record.record_id}: {record_metrics.summary()}")
+        if metrics is not None:
+            metrics.merge(record_metrics)
         record.update_stage(CCRecordStage.PREPROCESSED)
         return record
+
+
+def _process_record_worker(record: CCRecord, **kwargs) -> tuple[CCRecord, Metrics]:
+    # process_record only guards the processing itself, anything raised before
+    # that (e.g. a record at the wrong stage) still has to come back as ERROR
+    metrics = Metrics()
+    try:
+        return process_record(record, metrics=metrics, **kwargs), metrics
+    except Exception as e:
+        log.error(f"Error processing record {record.record_id}: {e}")
+        record.update_stage(CCRecordStage.ERROR)
+        metrics.inc("records_processed", result="error")
+        return record, metrics
+
+
+def _run_isolated(
+    worker: Callable,
+    records: list[CCRecord],
+    processes: int,
+    max_restarts: int,
+    metrics: Metrics,
+) -> Iterator[CCRecord]:
+    # every record on a pool of its own, at most processes at a time, to find
+    # the ones that kill their worker; only those are charged a restart
+    restarts = dict.fromkeys((record.record_id for record in records), 0)
+    queue = list(records)
+    running: dict[Future, tuple[CCRecord, ProcessPoolExecutor]] = {}
+    try:
+        while queue or running:
+            while queue and len(running) < processes:
+                record = queue.pop()
+                executor = ProcessPoolExecutor(1)
+                running[executor.submit(worker, record)] = (record, executor)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                record, executor = running.pop(future)
+                executor.shutdown(wait=False)
+                try:
+                    record, worker_metrics = future.result()
+                except BrokenProcessPool:
+                    restarts[record.record_id] += 1
+                    if restarts[record.record_id] <= max_restarts:
+                        queue.append(record)
+                        continue
+                    log.error(f"Worker died processing record {record.record_id}")
+                    record.update_stage(CCRecordStage.ERROR)
+                    metrics.inc("records_processed", result="error")
+                    yield record
+                    continue
+                metrics.merge(worker_metrics)
+                yield record
+    finally:
+        for _, executor in running.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def process_records(
+    records: Iterable[CCRecord],
+    processes: int | None = None,
+    max_files_per_worker: int | None = 16,
+    max_in_flight: int | None = None,
+    max_pool_restarts: int = 1,
+    metrics: Metrics | None = None,
+    **kwargs,
+) -> Iterator[CCRecord]:
+    """
+    Runs process_record over records on a pool of worker processes.
+
+    Records are handed out one at a time as workers free up, so slow files don't
+    hold up the rest, and at most max_in_flight records are submitted at once so
+    arbitrarily large iterables stay bounded in memory. Workers are replaced after
+    max_files_per_worker files. Yields each record (with its final stage,
+    PREPROCESSED or ERROR) in completion order.
+
+    If a worker dies outright (segfault, OOM kill) the pool is rebuilt, and the
+    records that were in flight are run again each on a worker of its own (see
+    _run_isolated), so only the record that killed it is retried, up to
+    max_pool_restarts times, before being marked ERROR.
+    The metrics of every worker's records are merged into metrics, if given.
+    Uses spawn when max_files_per_worker is set, so call it from under
+    `if __name__ == "__main__":` in scripts.
+    Any other keyword arguments (overwrite, stream_source, ...) are passed on to
+    process_record.
+    """
+    processes = processes or max(1, mp.cpu_count() - 2)
+    max_in_flight = max_in_flight or 2 * processes
+    worker = partial(_process_record_worker, **kwargs)
+    records = iter(records)
+    pending: dict[Future, CCRecord] = {}
+
+    metrics = metrics if metrics is not None else Metrics()
+
+    def finished(future: Future) -> CCRecord:
+        record, worker_metrics = future.result()
+        metrics.merge(worker_metrics)
+        return record
+
+    executor = ProcessPoolExecutor(processes, max_tasks_per_child=max_files_per_worker)
+    try:
+        while True:
+            while len(pending) < max_in_flight:
+                record = next(records, None)
+                if record is None:
+                    break
+                pending[executor.submit(worker, record)] = record
+            if not pending:
+                return
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            broken: list[CCRecord] = []
+            for future in done:
+                record = pending.pop(future)
+                try:
+                    yield finished(future)
+                except BrokenProcessPool:
+                    broken.append(record)
+            if not broken:
+                continue
+
+            # the pool is unusable now, so everything still in flight goes with it
+            for future, record in pending.items():
+                if future.done() and not future.exception():
+                    yield finished(future)
+                else:
+                    broken.append(record)
+            pending.clear()
+            executor.shutdown(wait=False, cancel_futures=True)
+            yield from _run_isolated(
+                worker, broken, processes, max_pool_restarts, metrics
+            )
+            executor = ProcessPoolExecutor(
+                processes, max_tasks_per_child=max_files_per_worker
+            )
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
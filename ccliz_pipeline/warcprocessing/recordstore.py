@@ -0,0 +1,310 @@
+import os
+import socket
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Iterable, Iterator
+
+from .pipeline import CCRecord
+from .types import CCRecordStage, LocalConfig
+from .utils import process_segment_url, stage_converter
+
+# stages a record is only in while a worker is on it
+IN_PROGRESS_STAGES = (
+    CCRecordStage.PREPROCESSING,
+    CCRecordStage.IDENTIFYING,
+    CCRecordStage.FILTERING,
+    CCRecordStage.DEDUPLICATING,
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    record_id TEXT PRIMARY KEY,
+    raw TEXT NOT NULL,
+    stage INTEGER NOT NULL,
+    previous_stage INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    updated REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS records_by_stage ON records (stage, record_id);
+"""
+
+
+class StoredRecord:
+    """One row of the store, without the config and history a CCRecord carries"""
+
+    __slots__ = ("record_id", "raw", "stage", "previous_stage", "attempts")
+
+    def __init__(
+        self,
+        record_id: str,
+        raw: str,
+        stage: int,
+        previous_stage: int | None,
+        attempts: int,
+    ):
+        self.record_id = record_id
+        self.raw = raw
+        self.stage = CCRecordStage(stage)
+        self.previous_stage = (
+            CCRecordStage(previous_stage) if previous_stage is not None else None
+        )
+        self.attempts = attempts
+
+    def to_record(self, config: LocalConfig) -> CCRecord:
+        snapshot, segment, file_num = self.record_id.split("/")
+        return CCRecord(
+            snapshot=snapshot,
+            segment=segment,
+            file_num=file_num,
+            raw=self.raw,
+            record_id=self.record_id,
+            config=config,
+            stage=self.stage,
+            stage_history=[self.previous_stage] if self.previous_stage else [],
+        )
+
+    def __repr__(self):
+        return f"StoredRecord({self.record_id}, {self.stage.name}, {self.attempts})"
+
+
+def _owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class RecordStore:
+    """
+    Stage of every record, kept in a SQLite database at db_path.
+
+    Rows only hold the record id, its URL, its stage and the stage before it,
+    so the store stays small for hundreds of thousands of records. Every
+    change is a single indexed UPDATE, made conditional on the stage the
+    caller expects the record to be in, so several processes (each with their
+    own RecordStore on the same file) can share it. claim() hands out the
+    next records at a stage, marking them as owned (and optionally moving
+    them to an in-progress stage) in one transaction, so no record is handed
+    out twice.
+
+    Records claimed by a process that is gone (or, on other hosts, not
+    updated for stale_after seconds) are put back at the stage they were
+    claimed from when the store is opened, see recover().
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        config: LocalConfig = LocalConfig(
+            cc_path="CC",
+            URL_Appendix="default",
+            stage_converter=stage_converter,
+        ),
+        stale_after: float | None = 6 * 60 * 60,
+        timeout: float = 60.0,
+    ):
+        self.db_path = db_path
+        self.config = config
+        self.stale_after = stale_after
+        self.timeout = timeout
+        self._connect()
+        self.recover()
+
+    def _connect(self):
+        self._db = sqlite3.connect(
+            self.db_path, timeout=self.timeout, isolation_level=None
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_db"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._connect()
+
+    def close(self):
+        self._db.close()
+
+    @contextmanager
+    def _transaction(self):
+        # IMMEDIATE takes the write lock up front, so a claim can't interleave
+        # with another process's claim between its SELECT and UPDATE
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+    def add(
+        self, urls: Iterable[str], stage: CCRecordStage = CCRecordStage.VOID
+    ) -> int:
+        """Adds records by URL, skipping ones already in the store"""
+        rows = []
+        now = time.time()
+        for url in urls:
+            parsed = process_segment_url(url)
+            record_id = (
+                f"{parsed['snapshot']}/{parsed['segment']}/{parsed['file_num']}"
+            )
+            rows.append((record_id, parsed["raw"], stage.value, now))
+        with self._transaction():
+            before = self._db.total_changes
+            self._db.executemany(
+                "INSERT OR IGNORE INTO records (record_id, raw, stage, updated) "
+                "VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            return self._db.total_changes - before
+
+    def get(self, record_id: str) -> StoredRecord | None:
+        row = self._db.execute(
+            "SELECT record_id, raw, stage, previous_stage, attempts "
+            "FROM records WHERE record_id = ?",
+            (record_id,),
+        ).fetchone()
+        return StoredRecord(*row) if row else None
+
+    def transition(
+        self,
+        record_id: str,
+        from_stage: CCRecordStage,
+        to_stage: CCRecordStage,
+    ) -> bool:
+        """Moves a record from from_stage to to_stage; False if it wasn't there"""
+        cursor = self._db.execute(
+            "UPDATE records SET stage = ?, previous_stage = stage, updated = ?, "
+            "owner = NULL WHERE record_id = ? AND stage = ?",
+            (to_stage.value, time.time(), record_id, from_stage.value),
+        )
+        return cursor.rowcount == 1
+
+    def save(self, record: CCRecord, claimed_as: CCRecordStage) -> bool:
+        """
+        Stores the stage a record claimed as claimed_as ended up in (e.g.
+        PREPROCESSED or ERROR) and releases it; False if it was taken away in
+        the meantime. The stage it was claimed from stays its previous stage,
+        which is where a failed record is retried from.
+        """
+        cursor = self._db.execute(
+            "UPDATE records SET stage = ?, updated = ?, owner = NULL, "
+            "attempts = CASE WHEN ? THEN attempts ELSE 0 END "
+            "WHERE record_id = ? AND stage = ?",
+            (
+                record.stage.value,
+                time.time(),
+                record.stage == CCRecordStage.ERROR,
+                record.record_id,
+                claimed_as.value,
+            ),
+        )
+        return cursor.rowcount == 1
+
+    def claim(
+        self,
+        stage: CCRecordStage,
+        limit: int,
+        to_stage: CCRecordStage | None = None,
+    ) -> list[CCRecord]:
+        """
+        The next limit unclaimed records at stage, owned by this process until
+        saved, and moved to to_stage (e.g. STAGED to PREPROCESSING) in the
+        store if given. The records themselves are still at stage, ready to be
+        handed to the function that moves them on; save them with claimed_as
+        set to to_stage, or to stage if there was none.
+        """
+        with self._transaction():
+            rows = self._db.execute(
+                "SELECT record_id, raw, stage, previous_stage, attempts "
+                "FROM records WHERE stage = ? AND owner IS NULL "
+                "ORDER BY record_id LIMIT ?",
+                (stage.value, limit),
+            ).fetchall()
+            self._db.executemany(
+                "UPDATE records SET stage = ?, previous_stage = stage, "
+                "attempts = attempts + 1, owner = ?, updated = ? "
+                "WHERE record_id = ?",
+                [
+                    ((to_stage or stage).value, _owner(), time.time(), row[0])
+                    for row in rows
+                ],
+            )
+        return [StoredRecord(*row).to_record(self.config) for row in rows]
+
+    def retry(self, max_attempts: int) -> int:
+        """
+        Puts ERROR records that have failed fewer than max_attempts times in a
+        row back at the stage they failed from; returns how many
+        """
+        cursor = self._db.execute(
+            "UPDATE records SET stage = previous_stage, updated = ? "
+            "WHERE stage = ? AND attempts < ? AND owner IS NULL "
+            "AND previous_stage IS NOT NULL",
+            (time.time(), CCRecordStage.ERROR.value, max_attempts),
+        )
+        return cursor.rowcount
+
+    def records(
+        self, stage: CCRecordStage, limit: int | None = None
+    ) -> Iterator[StoredRecord]:
+        cursor = self._db.execute(
+            "SELECT record_id, raw, stage, previous_stage, attempts "
+            "FROM records WHERE stage = ? ORDER BY record_id LIMIT ?",
+            (stage.value, -1 if limit is None else limit),
+        )
+        return (StoredRecord(*row) for row in cursor)
+
+    def counts(self) -> dict[CCRecordStage, int]:
+        rows = self._db.execute(
+            "SELECT stage, count(*) FROM records GROUP BY stage"
+        ).fetchall()
+        return {CCRecordStage(stage): count for stage, count in rows}
+
+    def __len__(self) -> int:
+        return self._db.execute("SELECT count(*) FROM records").fetchone()[0]
+
+    def recover(self) -> int:
+        """
+        Releases records claimed by a dead process, putting the ones left at
+        an in-progress stage back at the stage they were claimed from; returns
+        how many
+        """
+        host = socket.gethostname()
+        now = time.time()
+        stale = []
+        rows = self._db.execute(
+            "SELECT record_id, owner, updated FROM records WHERE owner IS NOT NULL"
+        ).fetchall()
+        for record_id, owner, updated in rows:
+            owner_host, _, pid = owner.rpartition(":")
+            if owner_host == host:
+                if not _pid_alive(int(pid)):
+                    stale.append(record_id)
+            elif self.stale_after is not None and now - updated > self.stale_after:
+                stale.append(record_id)
+        if not stale:
+            return 0
+        in_progress = ", ".join(str(s.value) for s in IN_PROGRESS_STAGES)
+        with self._transaction():
+            self._db.executemany(
+                "UPDATE records SET stage = CASE WHEN stage IN "
+                f"({in_progress}) THEN previous_stage ELSE stage END, "
+                "owner = NULL, updated = ? WHERE record_id = ?",
+                [(now, record_id) for record_id in stale],
+            )
+        return len(stale)
@@ -0,0 +1,306 @@
+from typing import Iterable, Iterator
+
+import numpy as np
+import numpy.typing as npt
+from numpy.lib.stride_tricks import sliding_window_view
+from xopen import xopen
+
+from .pipeline import CCRecord, default_config
+from .types import LocalConfig
+
+RAW_FORMAT = (
+    "crawl-data/CC-MAIN-{}/segments/{}/warc/CC-MAIN-{:014d}-{:014d}-{:05d}.warc.gz"
+)
+# a WARC path is HEAD, the segment (digits.digits), then TAIL; D is any digit
+HEAD = b"crawl-data/CC-MAIN-DDDD-DD/segments/"
+TAIL = b"/warc/CC-MAIN-DDDDDDDDDDDDDD-DDDDDDDDDDDDDD-DDDDD.warc.gz"
+DOT = ord(".")
+
+
+def _byte_range(template: bytes) -> tuple[np.ndarray, np.ndarray]:
+    # lowest and highest byte allowed at each position of template
+    chars = np.frombuffer(template, dtype=np.uint8)
+    digits = chars == ord("D")
+    return np.where(digits, ord("0"), chars), np.where(digits, ord("9"), chars)
+
+
+Columns = tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+
+def _gather(buf: np.ndarray, starts: np.ndarray, width: int) -> np.ndarray:
+    # (len(starts), width) bytes of buf from each start; buf ends in padding
+    return sliding_window_view(buf, width)[np.maximum(starts, 0)]
+
+
+def _matches(chars: np.ndarray, template: bytes) -> np.ndarray:
+    low, high = _byte_range(template)
+    return ((chars >= low) & (chars <= high)).all(axis=1)
+
+
+def _to_int(digits: np.ndarray, dtype) -> np.ndarray:
+    powers = 10 ** np.arange(digits.shape[1] - 1, -1, -1, dtype=np.uint64)
+    return ((digits - ord("0")).astype(np.uint64) @ powers).astype(dtype)
+
+
+def _parse_lines(lines: bytes) -> Columns:
+    """
+    Snapshot and segment names (as bytes), start and end timestamps and file
+    numbers of the WARC paths on lines, all at once as arrays of the lines'
+    bytes rather than a regex per line
+    """
+    buf = np.frombuffer(lines + b"\n", dtype=np.uint8)
+    ends = np.flatnonzero(buf == ord("\n"))
+    starts = np.r_[0, ends[:-1] + 1]
+    ends = ends - (buf[np.maximum(ends - 1, 0)] == ord("\r"))
+    starts, ends = starts[ends > starts], ends[ends > starts]
+    lengths = ends - starts - len(HEAD) - len(TAIL)
+    width = max(int(lengths.max(initial=1)), 1)
+    buf = np.concatenate([buf, np.zeros(max(width, len(TAIL)), dtype=np.uint8)])
+    segments = _gather(buf, starts + len(HEAD), width)
+    in_segment = np.arange(width) < lengths[:, None]
+    segments[~in_segment] = 0
+    is_digit = (segments >= ord("0")) & (segments <= ord("9"))
+    dots = segments == DOT
+    head = _gather(buf, starts, len(HEAD))
+    tail = _gather(buf, ends - len(TAIL), len(TAIL))
+    valid = (
+        (lengths >= 3)
+        & _matches(head, HEAD)
+        & _matches(tail, TAIL)
+        & ((is_digit | dots) == in_segment).all(axis=1)
+        & (dots.sum(axis=1) == 1)
+        & ~dots[:, 0]
+        & ~dots[np.arange(len(starts)), np.maximum(lengths - 1, 0)]
+    )
+    if not valid.all():
+        bad = np.flatnonzero(~valid)[0]
+        line = lines[starts[bad] : ends[bad]].decode(errors="replace")
+        raise ValueError(f"Could not process {line}")
+    # at fixed positions of HEAD and TAIL
+    return (
+        np.ascontiguousarray(head[:, 19:26], dtype=np.uint8).view("S7").ravel(),
+        np.ascontiguousarray(segments, dtype=np.uint8).view(f"S{width}").ravel(),
+        _to_int(tail[:, 14:28], np.uint64),
+        _to_int(tail[:, 29:43], np.uint64),
+        _to_int(tail[:, 44:49], np.uint32),
+    )
+
+
+def _intern(values: npt.NDArray[np.bytes_], dtype) -> tuple[list[str], np.ndarray]:
+    pool, index = np.unique(values, return_inverse=True)
+    return [v.decode() for v in pool.tolist()], index.astype(dtype)
+
+
+class RecordTable:
+    """
+    The WARC files of one or more warc.paths manifests as columns: snapshot
+    and segment as indices into lists of their distinct names, file number and
+    the two timestamps of the file name as integers, which is all a path is
+    made of. Planning over a snapshot's ~100k files takes a few MB, and
+    filter() and sample() are array operations; CCRecords are only made when
+    a row is taken out, by table[n] or by iterating over the table.
+    """
+
+    def __init__(
+        self,
+        snapshots: list[str],
+        segments: list[str],
+        snapshot_index: npt.NDArray[np.uint16],
+        segment_index: npt.NDArray[np.uint32],
+        file_nums: npt.NDArray[np.uint32],
+        start_times: npt.NDArray[np.uint64],
+        end_times: npt.NDArray[np.uint64],
+        config: LocalConfig = default_config,
+    ):
+        self.snapshots = snapshots
+        self.segments = segments
+        self.snapshot_index = snapshot_index
+        self.segment_index = segment_index
+        self.file_nums = file_nums
+        self.start_times = start_times
+        self.end_times = end_times
+        self.config = config
+
+    @classmethod
+    def _from_columns(cls, columns: Columns, config: LocalConfig) -> "RecordTable":
+        snapshot_names, segment_names, start_times, end_times, file_nums = columns
+        snapshots, snapshot_index = _intern(snapshot_names, np.uint16)
+        segments, segment_index = _intern(segment_names, np.uint32)
+        return cls(
+            snapshots,
+            segments,
+            snapshot_index,
+            segment_index,
+            file_nums,
+            start_times,
+            end_times,
+            config,
+        )
+
+    @classmethod
+    def from_paths(
+        cls,
+        file_path: str,
+        config: LocalConfig = default_config,
+        chunk_bytes: int = 1 << 20,
+    ) -> "RecordTable":
+        """
+        Reads a warc.paths manifest, gzipped or not, chunk_bytes at a time.
+        Raises ValueError on a line that isn't a WARC path.
+        """
+        chunks = []
+        rest = b""
+        with xopen(file_path, "rb") as f:
+            while block := f.read(chunk_bytes):
+                block = rest + block
+                end = block.rfind(b"\n") + 1
+                chunks.append(_parse_lines(block[:end]))
+                rest = block[end:]
+        chunks.append(_parse_lines(rest))
+        columns = tuple(np.concatenate(column) for column in zip(*chunks))
+        return cls._from_columns(columns, config)
+
+    @classmethod
+    def from_urls(
+        cls, urls: Iterable[str], config: LocalConfig = default_config
+    ) -> "RecordTable":
+        return cls._from_columns(_parse_lines("\n".join(urls).encode()), config)
+
+    @classmethod
+    def concat(cls, tables: list["RecordTable"]) -> "RecordTable":
+        """One table of all rows of tables, e.g. of several snapshots"""
+        if not tables:
+            raise ValueError("nothing to concatenate")
+        snapshots = sorted({s for t in tables for s in t.snapshots})
+        segments = sorted({s for t in tables for s in t.segments})
+        snapshot_pos = {s: i for i, s in enumerate(snapshots)}
+        segment_pos = {s: i for i, s in enumerate(segments)}
+
+        def remap(pool: list[str], index: np.ndarray, pos: dict[str, int]):
+            lookup = np.array([pos[s] for s in pool], dtype=index.dtype)
+            return lookup[index] if len(pool) else index
+
+        return cls(
+            snapshots,
+            segments,
+            np.concatenate(
+                [remap(t.snapshots, t.snapshot_index, snapshot_pos) for t in tables]
+            ),
+            np.concatenate(
+                [remap(t.segments, t.segment_index, segment_pos) for t in tables]
+            ),
+            np.concatenate([t.file_nums for t in tables]),
+            np.concatenate([t.start_times for t in tables]),
+            np.concatenate([t.end_times for t in tables]),
+            tables[0].config,
+        )
+
+    def __len__(self) -> int:
+        return len(self.file_nums)
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the columns, without the (shared) name lists"""
+        return sum(
+            column.nbytes
+            for column in (
+                self.snapshot_index,
+                self.segment_index,
+                self.file_nums,
+                self.start_times,
+                self.end_times,
+            )
+        )
+
+    def take(self, rows: npt.ArrayLike) -> "RecordTable":
+        """The table of rows (indices or a bool mask), sharing the name lists"""
+        rows = np.asarray(rows)
+        return RecordTable(
+            self.snapshots,
+            self.segments,
+            self.snapshot_index[rows],
+            self.segment_index[rows],
+            self.file_nums[rows],
+            self.start_times[rows],
+            self.end_times[rows],
+            self.config,
+        )
+
+    def record_id(self, row: int) -> str:
+        return (
+            f"{self.snapshots[self.snapshot_index[row]]}/"
+            f"{self.segments[self.segment_index[row]]}/"
+            f"{self.file_nums[row]:05d}"
+        )
+
+    def raw(self, row: int) -> str:
+        """The path of the WARC file of row, as in the manifest"""
+        return RAW_FORMAT.format(
+            self.snapshots[self.snapshot_index[row]],
+            self.segments[self.segment_index[row]],
+            int(self.start_times[row]),
+            int(self.end_times[row]),
+            int(self.file_nums[row]),
+        )
+
+    def record(self, row: int) -> CCRecord:
+        snapshot = self.snapshots[self.snapshot_index[row]]
+        segment = self.segments[self.segment_index[row]]
+        file_num = f"{self.file_nums[row]:05d}"
+        return CCRecord(
+            snapshot=snapshot,
+            segment=segment,
+            file_num=file_num,
+            raw=self.raw(row),
+            record_id=f"{snapshot}/{segment}/{file_num}",
+            config=self.config,
+        )
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self.record(int(key) if key >= 0 else len(self) + int(key))
+        if isinstance(key, slice):
+            key = np.arange(len(self))[key]
+        return self.take(key)
+
+    def __iter__(self) -> Iterator[CCRecord]:
+        for row in range(len(self)):
+            yield self.record(row)
+
+    def _names_mask(
+        self, names: str | Iterable[str], pool: list[str], index: np.ndarray
+    ) -> npt.NDArray[np.bool_]:
+        names = {names} if isinstance(names, str) else set(names)
+        wanted = [i for i, name in enumerate(pool) if name in names]
+        return np.isin(index, wanted)
+
+    def filter(
+        self,
+        snapshots: str | Iterable[str] | None = None,
+        segments: str | Iterable[str] | None = None,
+        files: tuple[int, int] | None = None,
+    ) -> "RecordTable":
+        """
+        Rows of any of snapshots, any of segments and with a file number in
+        [start, stop) of files; None lets everything through.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if snapshots is not None:
+            mask &= self._names_mask(snapshots, self.snapshots, self.snapshot_index)
+        if segments is not None:
+            mask &= self._names_mask(segments, self.segments, self.segment_index)
+        if files is not None:
+            start, stop = files
+            mask &= (self.file_nums >= start) & (self.file_nums < stop)
+        return self.take(mask)
+
+    def sample(self, n: int | float, seed: int | None = None) -> "RecordTable":
+        """
+        n rows, or a fraction n of them given a float, drawn at random
+        without replacement; they stay in table order.
+        """
+        if isinstance(n, float):
+            n = round(n * len(self))
+        rng = np.random.default_rng(seed)
+        rows = rng.choice(len(self), size=min(n, len(self)), replace=False)
+        return self.take(np.sort(rows))
@@ -0,0 +1,217 @@
+import json
+import logging as log
+import multiprocessing as mp
+import os
+import resource
+import time
+from typing import Callable
+
+from .preprocessing import preprocess_raw_bytes
+
+
+class ExtractionFailed(Exception):
+    """
+    Extraction of a document was given up on. reason is "timeout", "memory"
+    (MemoryError under the address space limit), "crashed" (the process died)
+    or "error" (the extractor raised).
+    """
+
+    def __init__(self, reason: str, message: str = ""):
+        super().__init__(f"extraction {reason}" + (f": {message}" if message else ""))
+        self.reason = reason
+
+
+def _rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # peak instead of current where there's no /proc, in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _sandbox_main(
+    conn,
+    parent_conn,
+    extractor: Callable[[bytes], str | None],
+    memory_limit: int,
+):
+    # body of the sandbox process: (extractor if it changed, raw body) in,
+    # (status, text, rss) out. The parent's end is closed here, so closing it
+    # there ends the loop
+    parent_conn.close()
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    while True:
+        try:
+            new_extractor, raw_body = conn.recv()
+        except (EOFError, OSError):
+            return
+        if new_extractor is not None:
+            extractor = new_extractor
+        try:
+            reply = ("ok", extractor(raw_body), _rss_bytes())
+        except MemoryError:
+            reply = ("memory", None, _rss_bytes())
+        except Exception as e:
+            reply = ("error", repr(e), _rss_bytes())
+        conn.send(reply)
+
+
+class ExtractionSandbox:
+    """
+    Runs extractor on a separate process, so a pathological page can be cut
+    off instead of stalling the whole file.
+
+    Every document gets timeout seconds; past that, the process is killed and
+    ExtractionFailed("timeout") raised. The process runs with its address space
+    limited to memory_limit_bytes (RLIMIT_AS, counting what it inherits from
+    its parent), so an extraction that blows up gets a MemoryError instead of
+    taking the host down. It's replaced after max_documents documents, or once
+    its RSS after a document passes max_rss_bytes, to get rid of whatever
+    trafilatura and lxml have accumulated.
+
+    Extractions taking at least slow_seconds are logged, and appended as JSON
+    lines of {id, uri, bytes, seconds, outcome} to slow_log_path if given.
+
+    The process is started on first use, by fork where available so it
+    doesn't have to import the extractor again. Pickled copies (e.g. for pool
+    workers) start their own.
+    """
+
+    def __init__(
+        self,
+        extractor: Callable[[bytes], str | None] = preprocess_raw_bytes,
+        timeout: float = 30.0,
+        memory_limit_bytes: int | None = 4 << 30,
+        max_documents: int | None = 10000,
+        max_rss_bytes: int | None = 1 << 30,
+        slow_seconds: float = 5.0,
+        slow_log_path: str | None = None,
+    ):
+        self.extractor = extractor
+        self.timeout = timeout
+        self.memory_limit_bytes = memory_limit_bytes
+        self.max_documents = max_documents
+        self.max_rss_bytes = max_rss_bytes
+        self.slow_seconds = slow_seconds
+        self.slow_log_path = slow_log_path
+        self.restarts = 0
+        self._process = None
+        self._conn = None
+        self._documents = 0
+        self._child_extractor = extractor
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_process=None, _conn=None, _documents=0, restarts=0)
+        return state
+
+    def __del__(self):
+        self.close()
+
+    def _start(self):
+        context = mp.get_context(
+            "fork" if "fork" in mp.get_all_start_methods() else "spawn"
+        )
+        self._conn, child_conn = context.Pipe()
+        self._process = context.Process(
+            target=_sandbox_main,
+            args=(
+                child_conn,
+                self._conn,
+                self.extractor,
+                self.memory_limit_bytes or 0,
+            ),
+            daemon=True,
+        )
+        self._process.start()
+        child_conn.close()
+        self._documents = 0
+        self._child_extractor = self.extractor
+
+    def _stop(self, kill: bool = False):
+        if self._process is None:
+            return
+        self._conn.close()
+        if kill:
+            self._process.kill()
+        self._process.join(timeout=5)
+        if self._process.is_alive():
+            self._process.kill()
+            self._process.join()
+        self._process = None
+        self._conn = None
+
+    def close(self):
+        if getattr(self, "_process", None) is not None:
+            self._stop()
+
+    def extract(
+        self,
+        raw_body: bytes,
+        document_id: str = "",
+        uri: str = "",
+        extractor: Callable[[bytes], str | None] | None = None,
+    ) -> str | None:
+        """
+        extractor(raw_body), self.extractor's without one, or ExtractionFailed
+        if it had to be given up on
+        """
+        if self._process is None:
+            self._start()
+        extractor = extractor or self.extractor
+        # the extractor is only sent over when it changes
+        changed = extractor if extractor != self._child_extractor else None
+        self._child_extractor = extractor
+        start = time.perf_counter()
+        status, result, rss = "crashed", None, 0
+        try:
+            self._conn.send((changed, raw_body))
+            if self._conn.poll(self.timeout):
+                status, result, rss = self._conn.recv()
+            else:
+                status = "timeout"
+        except (EOFError, OSError):
+            pass
+        elapsed = time.perf_counter() - start
+        self._documents += 1
+        if status in ("timeout", "crashed", "memory") or (
+            self.max_documents is not None and self._documents >= self.max_documents
+        ):
+            self._stop(kill=status != "ok")
+            self.restarts += 1
+        elif self.max_rss_bytes is not None and rss > self.max_rss_bytes:
+            log.debug(f"Extraction sandbox at {rss} bytes RSS, replacing it")
+            self._stop()
+            self.restarts += 1
+        if elapsed >= self.slow_seconds:
+            self._log_slow(document_id, uri, len(raw_body), elapsed, status)
+        if status != "ok":
+            raise ExtractionFailed(status, result if status == "error" else "")
+        return result
+
+    def __call__(self, raw_body: bytes) -> str | None:
+        return self.extract(raw_body)
+
+    def _log_slow(
+        self, document_id: str, uri: str, size: int, elapsed: float, outcome: str
+    ):
+        log.warning(
+            f"Slow extraction of {document_id or '?'} ({uri}, {size} bytes): "
+            f"{elapsed:.2f}s, {outcome}"
+        )
+        if self.slow_log_path is None:
+            return
+        line = json.dumps(
+            {
+                "id": document_id,
+                "uri": uri,
+                "bytes": size,
+                "seconds": round(elapsed, 4),
+                "outcome": outcome,
+            }
+        )
+        # one write per line, so lines from several workers don't interleave
+        with open(self.slow_log_path, "a") as f:
+            f.write(line + "\n")
@@ -0,0 +1,361 @@
+import logging as log
+import multiprocessing as mp
+import os
+import time
+from collections import Counter
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from functools import partial
+from typing import Callable, Literal
+
+from .download import HTTPArchiveIO, stage_record
+from .filtering import Rule, filter_record
+from .langid import identify_record
+from .metrics import Metrics
+from .pipeline import CCRecord
+from .recordprocessing import process_record
+from .recordstore import RecordStore
+from .types import CCRecordStage
+
+
+@dataclass
+class StageSpec:
+    """
+    One step of the scheduler: run takes a record at input_stage and moves it
+    on (with update_stage) to output_stage, or to ERROR / raises on failure.
+    The stage runs on its own pool of worker threads or processes.
+    claim_stage is the in-progress stage records are held at in the store
+    while they're worked on, if the step has one. Once max_waiting records
+    are sitting at output_stage, waiting for the next step, no new records
+    are started. With metrics, run is also passed a metrics keyword argument,
+    a Metrics to count into, which is merged into the scheduler's.
+    """
+
+    name: str
+    input_stage: CCRecordStage
+    output_stage: CCRecordStage
+    run: Callable[[CCRecord], object]
+    workers: int = 1
+    executor: Literal["thread", "process"] = "thread"
+    claim_stage: CCRecordStage | None = None
+    max_waiting: int | None = None
+    metrics: bool = False
+
+
+def _run_stage(
+    run: Callable[..., object], record: CCRecord, with_metrics: bool = False
+) -> tuple[CCRecord, Metrics]:
+    # runs on the stage's workers; failures come back as the record at ERROR
+    metrics = Metrics()
+    stage = record.stage
+    try:
+        if with_metrics:
+            run(record, metrics=metrics)
+        else:
+            run(record)
+    except Exception as e:
+        log.error(f"Error in {record.record_id} at {stage.name}: {e}")
+        if record.stage != CCRecordStage.ERROR:
+            record.update_stage(CCRecordStage.ERROR)
+    else:
+        if record.stage == stage:
+            log.error(f"{record.record_id} didn't leave {stage.name}")
+            record.update_stage(CCRecordStage.ERROR)
+    return record, metrics
+
+
+def _preprocess(
+    record: CCRecord,
+    remove_input: bool = False,
+    metrics: Metrics | None = None,
+    **kwargs,
+):
+    input_path = record.get_path()
+    process_record(record, metrics=metrics, **kwargs)
+    if remove_input and record.stage == CCRecordStage.PREPROCESSED:
+        os.remove(input_path)
+
+
+class StageScheduler:
+    """
+    Moves the records of a RecordStore through stages on their own worker
+    pools at the same time, so downloads, staging and extraction overlap
+    instead of running as separate passes.
+
+    Each round it puts failed records back for another try (up to
+    max_attempts in a row, after that they stay at ERROR), claims as many
+    records for every stage as it has free workers and room downstream, and
+    saves the stage each finished record ended up in. Later stages are
+    filled first, so records already on scratch disk are worked off before
+    new ones are fetched. When a worker process dies and takes its pool down,
+    every record that was on the pool runs again on a process of its own;
+    only one that kills that one too is put at ERROR.
+
+    Every record's time in a stage and the stage it ended up in are counted in
+    self.metrics, along with whatever the stages count themselves. With
+    metrics_path, they're exported (see Metrics.export) every metrics_interval
+    seconds and once done.
+    """
+
+    def __init__(
+        self,
+        store: RecordStore,
+        stages: list[StageSpec],
+        max_attempts: int = 3,
+        poll_interval: float = 1.0,
+        max_tasks_per_child: int | None = 16,
+        metrics_path: str | None = None,
+        metrics_interval: float = 60.0,
+    ):
+        self.store = store
+        self.stages = stages
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.max_tasks_per_child = max_tasks_per_child
+        self.metrics = Metrics()
+        self.metrics_path = metrics_path
+        self.metrics_interval = metrics_interval
+        self._exported = 0.0
+
+    def _make_executor(self, spec: StageSpec) -> Executor:
+        if spec.executor == "process":
+            return ProcessPoolExecutor(
+                spec.workers, max_tasks_per_child=self.max_tasks_per_child
+            )
+        return ThreadPoolExecutor(spec.workers, thread_name_prefix=spec.name)
+
+    def _free_slots(
+        self, spec: StageSpec, running: int, counts: dict[CCRecordStage, int]
+    ) -> int:
+        slots = spec.workers - running
+        if spec.max_waiting is not None:
+            waiting = counts.get(spec.output_stage, 0) + running
+            slots = min(slots, spec.max_waiting - waiting)
+        return slots
+
+    def _export_metrics(self, force: bool = False):
+        if self.metrics_path is None:
+            return
+        if force or time.monotonic() - self._exported >= self.metrics_interval:
+            self.metrics.export(self.metrics_path)
+            self._exported = time.monotonic()
+
+    def run(self, until_idle: bool = True) -> dict[CCRecordStage, int]:
+        """
+        Runs until no stage has anything left to do (or forever, polling for
+        new records, without until_idle); returns the final stage counts
+        """
+        executors = {spec.name: self._make_executor(spec) for spec in self.stages}
+        # future -> (stage, record, executor it runs on, when it was submitted)
+        in_flight: dict[Future, tuple[StageSpec, CCRecord, Executor, float]] = {}
+        # single process pools of records that were on a pool when it broke
+        isolated: set[Executor] = set()
+        running: Counter[str] = Counter()
+        try:
+            while True:
+                retried = self.store.retry(self.max_attempts)
+                if retried:
+                    log.info(f"Retrying {retried} failed records")
+                counts = self.store.counts()
+                for spec in reversed(self.stages):
+                    slots = self._free_slots(spec, running[spec.name], counts)
+                    if slots <= 0:
+                        continue
+                    for record in self.store.claim(
+                        spec.input_stage, slots, spec.claim_stage
+                    ):
+                        executor = executors[spec.name]
+                        future = executor.submit(
+                            _run_stage, spec.run, record, spec.metrics
+                        )
+                        in_flight[future] = (
+                            spec,
+                            record,
+                            executor,
+                            time.perf_counter(),
+                        )
+                        running[spec.name] += 1
+                self._export_metrics()
+                if not in_flight:
+                    if until_idle:
+                        break
+                    time.sleep(self.poll_interval)
+                    continue
+
+                done, _ = wait(
+                    in_flight, timeout=self.poll_interval, return_when=FIRST_COMPLETED
+                )
+                for future in done:
+                    spec, record, executor, submitted = in_flight.pop(future)
+                    running[spec.name] -= 1
+                    alone = executor in isolated
+                    if alone:
+                        executor.shutdown(wait=False)
+                        isolated.discard(executor)
+                    try:
+                        record, stage_metrics = future.result()
+                        self.metrics.merge(stage_metrics)
+                    except BrokenProcessPool as e:
+                        # a worker died outright, the rest of its pool with it
+                        if executors[spec.name] is executor:
+                            executor.shutdown(wait=False)
+                            executors[spec.name] = self._make_executor(spec)
+                        if not alone:
+                            # any record of the pool could have killed it, so
+                            # each one runs again on a pool of its own, without
+                            # being charged another attempt
+                            log.warning(
+                                f"{spec.name} pool broke, running "
+                                f"{record.record_id} again on its own"
+                            )
+                            single = ProcessPoolExecutor(1)
+                            isolated.add(single)
+                            retry = single.submit(
+                                _run_stage, spec.run, record, spec.metrics
+                            )
+                            in_flight[retry] = (spec, record, single, submitted)
+                            running[spec.name] += 1
+                            continue
+                        log.error(f"{record.record_id} killed its worker: {e}")
+                        record.update_stage(CCRecordStage.ERROR)
+                    self.metrics.observe(
+                        "stage_seconds",
+                        time.perf_counter() - submitted,
+                        stage=spec.name,
+                    )
+                    self.metrics.inc(
+                        "stage_records",
+                        stage=spec.name,
+                        result=record.stage.name.lower(),
+                    )
+                    self.store.save(record, spec.claim_stage or spec.input_stage)
+                    log.debug(f"{spec.name}: {record.record_id} -> {record.stage.name}")
+        finally:
+            for executor in isolated:
+                executor.shutdown(wait=False, cancel_futures=True)
+            for executor in executors.values():
+                executor.shutdown(wait=True, cancel_futures=True)
+        self._export_metrics(force=True)
+        counts = self.store.counts()
+        log.info(f"Stage counts: { {s.name: n for s, n in counts.items()} }")
+        return counts
+
+
+def default_stages(
+    archive_io: HTTPArchiveIO | None = None,
+    download_workers: int = 8,
+    stage_workers: int = 2,
+    preprocess_workers: int | None = None,
+    stream_source: bool = False,
+    max_waiting: int | None = None,
+    remove_inputs: bool = False,
+    identify_languages: bool = False,
+    filter_rules: dict[str, Rule] | None = None,
+    filter_workers: int = 1,
+    filter_languages: list[str] | None = None,
+    **process_kwargs,
+) -> list[StageSpec]:
+    """
+    Download (with archive_io, on threads), staging (on threads, skipped with
+    stream_source) and extraction (on preprocess_workers processes, one file
+    each). At most max_waiting files, by default two per preprocess worker,
+    are kept downloaded or staged ahead of extraction. With remove_inputs,
+    the .warc.gz is deleted once staged and the file extraction read from
+    once it's done.
+    With identify_languages, a language stage (on filter_workers processes)
+    takes PREPROCESSED records on to IDENTIFIED, split up by language (see
+    langid.identify_record). With filter_rules, a filter stage (on processes)
+    takes them on to FILTERED (see filtering.filter_record), keeping only the
+    filter_languages if given.
+    Other keyword arguments go to process_record, e.g. extraction_workers to
+    split each file across processes of its own.
+    """
+    preprocess_workers = preprocess_workers or max(1, mp.cpu_count() - 2)
+    max_waiting = max_waiting or 2 * preprocess_workers
+    stages = []
+    if archive_io is not None:
+        stages.append(
+            StageSpec(
+                name="download",
+                input_stage=CCRecordStage.VOID,
+                output_stage=CCRecordStage.SOURCE,
+                run=archive_io.download,
+                workers=download_workers,
+                max_waiting=max_waiting,
+            )
+        )
+    if not stream_source:
+        stages.append(
+            StageSpec(
+                name="stage",
+                input_stage=CCRecordStage.SOURCE,
+                output_stage=CCRecordStage.STAGED,
+                run=partial(stage_record, overwrite="always", delete=remove_inputs),
+                workers=stage_workers,
+                max_waiting=max_waiting,
+            )
+        )
+    stages.append(
+        StageSpec(
+            name="preprocess",
+            input_stage=(
+                CCRecordStage.SOURCE if stream_source else CCRecordStage.STAGED
+            ),
+            output_stage=CCRecordStage.PREPROCESSED,
+            run=partial(
+                _preprocess,
+                remove_input=remove_inputs,
+                stream_source=stream_source,
+                **process_kwargs,
+            ),
+            workers=preprocess_workers,
+            executor="process",
+            claim_stage=CCRecordStage.PREPROCESSING,
+            metrics=True,
+        )
+    )
+    output_format = process_kwargs.get("output_format", "jsonl")
+    if identify_languages:
+        stages.append(
+            StageSpec(
+                name="langid",
+                input_stage=CCRecordStage.PREPROCESSED,
+                output_stage=CCRecordStage.IDENTIFIED,
+                run=partial(identify_record, input_format=output_format),
+                workers=filter_workers,
+                executor="process",
+                claim_stage=CCRecordStage.IDENTIFYING,
+                metrics=True,
+            )
+        )
+    if filter_rules is not None:
+        stages.append(
+            StageSpec(
+                name="filter",
+                input_stage=(
+                    CCRecordStage.IDENTIFIED
+                    if identify_languages
+                    else CCRecordStage.PREPROCESSED
+                ),
+                output_stage=CCRecordStage.FILTERED,
+                run=partial(
+                    filter_record,
+                    rules=filter_rules,
+                    input_format=output_format,
+                    languages=filter_languages,
+                ),
+                workers=filter_workers,
+                executor="process",
+                claim_stage=CCRecordStage.FILTERING,
+                metrics=True,
+            )
+        )
+    return stages
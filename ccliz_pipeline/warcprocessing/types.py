@@ -21,11 +21,27 @@ class WARCHeader(Struct):
     warc_type: str
 
 
+class DocumentStats(Struct):
+    # Gopher-style quality statistics, see preprocessing.compute_stats
+    num_words: int
+    num_lines: int  # non-empty lines
+    mean_word_length: float
+    hash_ratio: float  # "#" per word
+    ellipsis_ratio: float  # "..." or "…" per word
+    bullet_line_ratio: float  # lines starting with a bullet point
+    ellipsis_line_ratio: float  # lines ending with an ellipsis
+    alpha_word_ratio: float  # words with at least one alphabetic character
+    stop_word_count: int  # distinct gopher stop words present
+
+
 class TextDocument(Struct):
     id: str  # "CC/YYYY-mm/[0000-9999]/[integer]"
     header: WARCHeader
     raw_text: str  # "raw" text (only minimal processing)
     pipeline_status: str  # "raw",
+    stats: Optional[DocumentStats] = None
+    language: Optional[str] = None  # ISO 639-1, or "unknown", see langid
+    language_score: Optional[float] = None  # 0 to 1, higher is surer
 
 
 class CCRecordURL(TypedDict):
@@ -47,6 +63,10 @@ class CCRecordStage(Enum):
     DEDUPLICATED = auto()
     FINAL = auto()
     ERROR = auto()
+    # after ERROR so the values of the stages above (kept in record stores)
+    # don't change; comes between PREPROCESSED and FILTERING
+    IDENTIFYING = auto()
+    IDENTIFIED = auto()
 
 
 class ArchiveIO(Protocol):
@@ -15,6 +15,9 @@ stage_converter = {
     CCRecordStage.STAGED: ("staging", ".warc"),
     CCRecordStage.PREPROCESSING: ("staging", ".warc"),
     CCRecordStage.PREPROCESSED: ("local/prepared", ".jsonl"),
+    CCRecordStage.IDENTIFYING: ("local/prepared", ".jsonl"),
+    # one directory per language below this, see langid.language_path
+    CCRecordStage.IDENTIFIED: ("local/languages", ".jsonl"),
     CCRecordStage.FILTERING: ("local/prepared", ".jsonl"),
     CCRecordStage.FILTERED: ("local/filtered", ".jsonl"),
     CCRecordStage.DEDUPLICATING: ("local/filtered", ".jsonl"),
@@ -28,8 +31,11 @@ def process_html(str: str):
 
 
 def make_warc_header(record: WarcHeaderMap) -> WARCHeader:
-    rectuple = record.astuples()
+    return make_warc_header_from_tuples(record.astuples())
 
+
+def make_warc_header_from_tuples(rectuple: tuple[tuple[str, str], ...]) -> WARCHeader:
+    """Same as make_warc_header, for headers already copied out of fastwarc"""
     return WARCHeader(
         warc_record_id=UUID(rectuple[2][1][1:-1]),
         iso_timestamp=rectuple[1][1],
@@ -38,7 +44,7 @@ def make_warc_header(record: WarcHeaderMap) -> WARCHeader:
         ip_address=rectuple[7][1],
         target_uri=rectuple[8][1],
         content_type=rectuple[4][1],
-        content_length=rectuple[3][1],
+        content_length=int(rectuple[3][1]),
         identified_payload_type=rectuple[11][1],
         warc_type=rectuple[0][1],
     )
@@ -70,8 +76,11 @@ def _rename_file(filePath):
             return newPath
 
 
-def check_and_makedirs(path_with_extension: str) -> str:
-    file_path = check_file(path_with_extension)
+def check_and_makedirs(
+    path_with_extension: str,
+    overwrite: Literal["always", "rename", "never"] = "rename",
+) -> str:
+    file_path = check_file(path_with_extension, overwrite)
     if not path.exists(path.dirname(file_path)):
         makedirs(path.dirname(file_path))
     return file_path
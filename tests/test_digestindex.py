@@ -0,0 +1,56 @@
+import multiprocessing as mp
+import os
+
+from ccliz_pipeline.warcprocessing.digestindex import DigestIndex
+
+
+def _digest(n: int) -> str:
+    return f"md5:{n:032x}"
+
+
+def _worker(index_dir: str, worker: int, records: int, per_record: int):
+    # every worker flushes its own shard per record, as process_record does
+    index = DigestIndex(index_dir, fanout=4)
+    for record in range(records):
+        owner = f"w{worker}/{record}"
+        first = (worker * records + record) * per_record
+        for k in range(per_record):
+            index.check_and_add(_digest(first + k), owner)
+        index.flush()
+
+
+def test_shards_are_merged_on_flush(tmp_path):
+    index = DigestIndex(str(tmp_path), fanout=4)
+    for record in range(200):
+        for k in range(10):
+            assert not index.check_and_add(_digest(record * 10 + k), str(record))
+        index.flush()
+    shards = len(index._shard_paths())
+    # at most fanout - 1 per tier once merged
+    assert shards < 4 * 5
+    assert len(index) == 2000
+    assert len(index._shards) == shards
+    # every digest is still there, and still its record's
+    assert all(_digest(n) in index for n in range(2000))
+    assert not index.check_and_add(_digest(15), "1")
+    assert index.check_and_add(_digest(15), "2")
+    assert not os.path.exists(tmp_path / "compact.lock")
+
+
+def test_concurrent_flushes_lose_nothing(tmp_path):
+    context = mp.get_context("spawn")
+    workers = [
+        context.Process(target=_worker, args=(str(tmp_path), w, 40, 25))
+        for w in range(4)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+    index = DigestIndex(str(tmp_path), fanout=4)
+    assert len(index) == 4 * 40 * 25
+    assert all(_digest(n) in index for n in range(4 * 40 * 25))
+    assert index.compact()
+    assert len(index._shard_paths()) == 1
+    assert len(index) == 4 * 40 * 25
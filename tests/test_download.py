@@ -0,0 +1,137 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from ccliz_pipeline.warcprocessing.download import HTTPArchiveIO
+from ccliz_pipeline.warcprocessing.pipeline import CCRecord
+from ccliz_pipeline.warcprocessing.types import CCRecordStage, LocalConfig
+from ccliz_pipeline.warcprocessing.utils import stage_converter
+
+URL = (
+    "crawl-data/CC-MAIN-2023-50/segments/1700679099281.67/warc/"
+    "CC-MAIN-20231128083443-20231128113443-00000.warc.gz"
+)
+BODY = bytes(range(256)) * 1000
+
+
+class CCStandIn(BaseHTTPRequestHandler):
+    """Serves BODY with Range support; fails or cuts short the first requests"""
+
+    failures = 0  # answered with 503
+    cut_after = None  # bytes sent of the next body before the connection drops
+    requests: list[str | None] = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(BODY)))
+        self.end_headers()
+
+    def do_GET(self):
+        cls = type(self)
+        cls.requests.append(self.headers.get("Range"))
+        if cls.failures:
+            cls.failures -= 1
+            self.send_error(503)
+            return
+        start = 0
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"][len("bytes=") :].rstrip("-"))
+            if start >= len(BODY):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(BODY)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(BODY) - 1}/{len(BODY)}"
+            )
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(BODY) - start))
+        self.end_headers()
+        body = BODY[start:]
+        if cls.cut_after is not None:
+            body, cls.cut_after = body[: cls.cut_after], None
+            self.close_connection = True
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    CCStandIn.failures, CCStandIn.cut_after, CCStandIn.requests = 0, None, []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), CCStandIn)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _record(cc_path: str) -> CCRecord:
+    config = LocalConfig(
+        cc_path=cc_path, URL_Appendix="default", stage_converter=stage_converter
+    )
+    return CCRecord.create_from_URL(URL, config)
+
+
+def _part(record: CCRecord, data: bytes) -> str:
+    part_path = record.get_path(CCRecordStage.SOURCE) + ".part"
+    os.makedirs(os.path.dirname(part_path), exist_ok=True)
+    with open(part_path, "wb") as f:
+        f.write(data)
+    return part_path
+
+
+def _downloaded(record: CCRecord) -> bytes:
+    with open(record.get_path(CCRecordStage.SOURCE), "rb") as f:
+        return f.read()
+
+
+def test_resumes_a_partial_download(tmp_path, server):
+    record = _record(str(tmp_path))
+    _part(record, BODY[:1000])
+    HTTPArchiveIO(CC_remote_path=server, backoff=0).download(record)
+    assert record.stage == CCRecordStage.SOURCE
+    assert _downloaded(record) == BODY
+    assert CCStandIn.requests == ["bytes=1000-"]
+
+
+def test_retries_after_errors(tmp_path, server):
+    record = _record(str(tmp_path))
+    CCStandIn.failures = 2
+    CCStandIn.cut_after = 5000
+    HTTPArchiveIO(CC_remote_path=server, chunk_size=1000, backoff=0).download(record)
+    assert _downloaded(record) == BODY
+    # two 503s, a body cut short, then the rest of it
+    assert CCStandIn.requests == [None, None, None, "bytes=5000-"]
+
+
+def test_complete_part_file_is_kept(tmp_path, server):
+    record = _record(str(tmp_path))
+    _part(record, BODY)
+    HTTPArchiveIO(CC_remote_path=server, backoff=0).download(record)
+    assert _downloaded(record) == BODY
+    assert CCStandIn.requests == [f"bytes={len(BODY)}-"]
+
+
+def test_oversized_part_file_starts_over(tmp_path, server):
+    record = _record(str(tmp_path))
+    _part(record, BODY + b"garbage")
+    HTTPArchiveIO(CC_remote_path=server, backoff=0).download(record)
+    assert _downloaded(record) == BODY
+    assert CCStandIn.requests == [f"bytes={len(BODY) + 7}-", None]
+
+
+def test_gives_up_after_retries(tmp_path, server):
+    record = _record(str(tmp_path))
+    CCStandIn.failures = 10
+    with pytest.raises(IOError):
+        HTTPArchiveIO(CC_remote_path=server, retries=2, backoff=0).download(record)
+    assert record.stage == CCRecordStage.ERROR
+    assert len(CCStandIn.requests) == 3
@@ -0,0 +1,140 @@
+import multiprocessing as mp
+import os
+import time
+from collections import Counter
+
+from ccliz_pipeline.warcprocessing.leases import LeaseQueue, shard_of
+from ccliz_pipeline.warcprocessing.pipeline import CCRecord
+from ccliz_pipeline.warcprocessing.types import CCRecordStage, LocalConfig
+from ccliz_pipeline.warcprocessing.utils import stage_converter
+
+URL = (
+    "crawl-data/CC-MAIN-2023-50/segments/1700679099281.67/warc/"
+    "CC-MAIN-20231128083443-20231128113443-{:05d}.warc.gz"
+)
+STAGE = CCRecordStage.PREPROCESSED
+
+
+def _config(cc_path: str) -> LocalConfig:
+    return LocalConfig(
+        cc_path=cc_path, URL_Appendix="default", stage_converter=stage_converter
+    )
+
+
+def _records(cc_path: str, count: int) -> list[CCRecord]:
+    config = _config(cc_path)
+    return [CCRecord.create_from_URL(URL.format(k), config) for k in range(count)]
+
+
+def _node(cc_path: str, index: int, nodes: int, count: int, die_after: int = 0):
+    # one node of a cluster; logs every record it runs, dies holding its
+    # die_after-th lease if given
+    queue = LeaseQueue(
+        _config(cc_path), index, nodes, f"node{index}", 1.0, heartbeat_seconds=0.2
+    )
+    runs = 0
+
+    def run(record: CCRecord):
+        nonlocal runs
+        runs += 1
+        with open(os.path.join(cc_path, "runs.log"), "a") as f:
+            f.write(f"{record.record_id} node{index}\n")
+        if runs == die_after:
+            os._exit(1)
+        time.sleep(0.01)
+        record.update_stage(STAGE)
+
+    queue.run(_records(cc_path, count), run, STAGE)
+
+
+def _runs(cc_path: str) -> Counter:
+    with open(os.path.join(cc_path, "runs.log")) as f:
+        return Counter(line.split()[0] for line in f)
+
+
+def test_claims_are_exclusive(tmp_path):
+    cc_path = str(tmp_path)
+    context = mp.get_context("spawn")
+    nodes = [context.Process(target=_node, args=(cc_path, k, 3, 24)) for k in range(3)]
+    for node in nodes:
+        node.start()
+    for node in nodes:
+        node.join()
+    queue = LeaseQueue(_config(cc_path))
+    records = _records(cc_path, 24)
+    assert _runs(cc_path) == Counter(r.record_id for r in records)
+    assert all(queue.is_done(r.record_id, STAGE) for r in records)
+    leases = [queue.lease_path(r.record_id, STAGE) for r in records]
+    assert not any(os.path.exists(p) for p in leases)
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    config = _config(str(tmp_path))
+    a = LeaseQueue(config, node_id="a", lease_seconds=1.0)
+    b = LeaseQueue(config, node_id="b", lease_seconds=1.0)
+    record_id = _records(str(tmp_path), 1)[0].record_id
+    assert a.acquire(record_id, STAGE)
+    assert not b.acquire(record_id, STAGE)
+    past = time.time() - 10
+    os.utime(a.lease_path(record_id, STAGE), (past, past))
+    assert b.acquire(record_id, STAGE)
+    assert b.status.reclaimed == 1
+    # a stalled past its lease: its work doesn't count
+    a.heartbeat()
+    assert a.is_lost(record_id)
+    assert a.release(record_id, STAGE, done=True) == "lost"
+    assert not a.is_done(record_id, STAGE)
+    assert b.release(record_id, STAGE, done=True) == "done"
+    assert b.is_done(record_id, STAGE)
+
+
+def test_takeover_puts_back_a_fresh_lease(tmp_path):
+    config = _config(str(tmp_path))
+    a, b, c = (LeaseQueue(config, node_id=n, lease_seconds=1.0) for n in "abc")
+    record_id = _records(str(tmp_path), 1)[0].record_id
+    lease_path = a.lease_path(record_id, STAGE)
+    assert a.acquire(record_id, STAGE)
+    past = time.time() - 10
+    os.utime(lease_path, (past, past))
+    # b sees a's expired lease, but c takes it over before b's rename
+    seen = b._lease_owner(lease_path)
+    assert c.acquire(record_id, STAGE)
+    assert not b._take_over(lease_path, seen)
+    assert c._lease_owner(lease_path)[0] == "c"
+    assert not b.acquire(record_id, STAGE)
+
+
+def test_dead_node_shard_is_stolen(tmp_path):
+    cc_path = str(tmp_path)
+    records = _records(cc_path, 12)
+    assert {shard_of(r.record_id, 2) for r in records} == {0, 1}
+    context = mp.get_context("spawn")
+    dying = context.Process(target=_node, args=(cc_path, 1, 2, 12, 2))
+    dying.start()
+    dying.join()
+    assert dying.exitcode == 1
+    # node 1's status and its lease expire
+    time.sleep(1.5)
+    queue = LeaseQueue(_config(cc_path), 0, 2, "node0", 1.0, heartbeat_seconds=0.2)
+    counts = queue.run(records, lambda r: r.update_stage(STAGE), STAGE)
+    assert queue.status.reclaimed == 1
+    assert all(queue.is_done(r.record_id, STAGE) for r in records)
+    # node 1 finished its first record and died on its second
+    assert counts["done"] == len(records) - 1
+
+
+def test_only_the_holder_commits(tmp_path):
+    config = _config(str(tmp_path))
+    a = LeaseQueue(config, node_id="a", lease_seconds=1.0)
+    b = LeaseQueue(config, node_id="b", lease_seconds=1.0)
+    record_id = _records(str(tmp_path), 1)[0].record_id
+    committed = []
+    assert a.acquire(record_id, STAGE)
+    past = time.time() - 10
+    os.utime(a.lease_path(record_id, STAGE), (past, past))
+    assert b.acquire(record_id, STAGE)
+    # a stalled past its lease and finishes after b took over
+    assert not a.if_held(record_id, STAGE, lambda: committed.append("a"))
+    assert b.if_held(record_id, STAGE, lambda: committed.append("b"))
+    assert committed == ["b"]
+    assert a.is_lost(record_id)
@@ -0,0 +1,43 @@
+import os
+import time
+
+from ccliz_pipeline.warcprocessing.pipeline import CCRecord
+from ccliz_pipeline.warcprocessing.recordstore import RecordStore
+from ccliz_pipeline.warcprocessing.scheduler import StageScheduler, StageSpec
+from ccliz_pipeline.warcprocessing.types import CCRecordStage, LocalConfig
+from ccliz_pipeline.warcprocessing.utils import stage_converter
+
+URL = (
+    "crawl-data/CC-MAIN-2023-50/segments/1700679099281.67/warc/"
+    "CC-MAIN-20231128083443-20231128113443-{:05d}.warc.gz"
+)
+
+
+def _stage(record: CCRecord):
+    # record 3 takes its worker process down with it, and the pool with the
+    # records still running on it
+    if record.file_num == "00003":
+        os._exit(1)
+    time.sleep(0.5)
+    record.update_stage(CCRecordStage.STAGED)
+
+
+def test_only_the_record_that_kills_its_worker_fails(tmp_path):
+    config = LocalConfig(
+        cc_path=str(tmp_path), URL_Appendix="default", stage_converter=stage_converter
+    )
+    store = RecordStore(str(tmp_path / "records.db"), config)
+    store.add(URL.format(k) for k in range(6))
+    spec = StageSpec(
+        name="stage",
+        input_stage=CCRecordStage.VOID,
+        output_stage=CCRecordStage.STAGED,
+        run=_stage,
+        workers=3,
+        executor="process",
+    )
+    counts = StageScheduler(store, [spec], max_attempts=1, poll_interval=0.1).run()
+    assert counts == {CCRecordStage.STAGED: 5, CCRecordStage.ERROR: 1}
+    assert [r.record_id for r in store.records(CCRecordStage.ERROR)] == [
+        "2023-50/1700679099281.67/00003"
+    ]